@@ -0,0 +1,155 @@
+"""
+Out-of-band control of a running Synchronized Trigger Server (STS).
+
+An AdminChannel is a duplex multiprocessing.Pipe (a socket pair on Unix):
+the server end is given to sync_trigger_server (admin argument), which
+waits for it in the same select as its sockets. A command therefore
+wakes the server at once, even while it waits for a connection, and
+requests are not slowed down: the main loop only checks whether the
+channel is among the ready sockets.
+When the server runs in the process of the controller (eg STServerThread),
+the command is handed over in memory and only a wake-up marker goes
+through the pipe, as with a self-pipe: any callable can then be set.
+
+Commands are sent from the control end, in any thread or process
+sharing the channel (eg the parent of a STServerProcess), and get a reply:
+    - stop: stop the server, as STS_QUIT would
+    - set_callback: replace the callback of a channel (or callback2),
+      without restarting the server. Over a process boundary (eg
+      STServerProcess), the callback is pickled: it must be eg a
+      module-level function or class instance.
+    - reset_stats: reset latency histograms (see metrics_address) and
+      counters of the status handler (eg StatusSlot.reset_counters)
+    - dump_metrics: return the latency histograms, as text or in the
+      Prometheus format (see polos.metrics)
+Commands carry an id, repeated in their reply, so that the late reply of
+a timed out command is dropped instead of being taken for the next one.
+
+>>> admin = AdminChannel()                                    #doctest: +SKIP
+>>> server = STServerProcess(admin=admin)                     #doctest: +SKIP
+>>> server.start()                                            #doctest: +SKIP
+>>> admin.set_callback(3, GPIOTrigger(17))                    #doctest: +SKIP
+>>> admin.stop()                                              #doctest: +SKIP
+"""
+import os
+import time
+import logging
+from threading import Lock
+from multiprocessing import Pipe, RawValue
+
+from .server import STS_CALLBACK_1
+
+logger = logging.getLogger('polos')
+
+ADMIN_STOP = 'stop'
+ADMIN_SET_CALLBACK = 'set_callback'
+ADMIN_RESET_STATS = 'reset_stats'
+ADMIN_DUMP_METRICS = 'dump_metrics'
+ADMIN_COMMANDS = (ADMIN_STOP, ADMIN_SET_CALLBACK, ADMIN_RESET_STATS,
+                  ADMIN_DUMP_METRICS)
+
+ADMIN_REPLY_OK = 'ok'
+ADMIN_REPLY_ERROR = 'error'
+
+class AdminError(Exception): pass
+
+class AdminChannel:
+    """
+    Control channel of a server. Commands wait for the reply of the
+    server, for at most timeout seconds, and raise AdminError if the
+    server failed to run them or did not answer.
+    """
+    TIMEOUT = 1. # second
+
+    def __init__(self):
+        self.server_end, self.control_end = Pipe()
+        self.lock = Lock() # one command at a time
+        # Set by the server when it starts serving, in its process
+        self.server_pid = RawValue('q', 0)
+        self.pending = None # command of an in-process server
+        self.command_id = 0
+
+    def fileno(self):
+        """ Descriptor of the server end, for select """
+        return self.server_end.fileno()
+
+    def attach(self):
+        """ Server side: called once by the server before serving """
+        self.server_pid.value = os.getpid()
+
+    def send_command(self, command, *args, timeout=TIMEOUT):
+        """ Send the given command and return the result of the server """
+        assert(command in ADMIN_COMMANDS)
+        with self.lock:
+            self.command_id += 1
+            message = (self.command_id, command, args)
+            if self.server_pid.value == os.getpid():
+                # Same process: nothing to pickle, just wake the server up
+                self.pending = message
+                self.control_end.send(None)
+            else:
+                self.control_end.send(message)
+            ts_end = time.monotonic() + timeout
+            while True:
+                if not self.control_end.poll(max(0, ts_end - \
+                                                 time.monotonic())):
+                    raise AdminError('No reply of the server to %s' % \
+                                     command)
+                reply_id, status, result = self.control_end.recv()
+                if reply_id == self.command_id:
+                    break
+                logger.warning('Dropping late reply of admin command %d',
+                               reply_id)
+        if status != ADMIN_REPLY_OK:
+            raise AdminError('Server could not %s: %s' % (command, result))
+        return result
+
+    def stop(self, timeout=TIMEOUT):
+        self.send_command(ADMIN_STOP, timeout=timeout)
+
+    def set_callback(self, channel, callback, command=STS_CALLBACK_1,
+                     timeout=TIMEOUT):
+        """
+        Replace the callback of the given channel, for the given command:
+        STS_CALLBACK_1 (default) or STS_CALLBACK_2 (channel is then
+        ignored). A channel without callback (None) gets error replies
+        (see sync_trigger_server).
+        """
+        self.send_command(ADMIN_SET_CALLBACK, command, channel, callback,
+                          timeout=timeout)
+
+    def reset_stats(self, timeout=TIMEOUT):
+        self.send_command(ADMIN_RESET_STATS, timeout=timeout)
+
+    def dump_metrics(self, metrics_format='text', timeout=TIMEOUT):
+        """ Return the latency histograms, 'text' or 'prometheus' """
+        return self.send_command(ADMIN_DUMP_METRICS, metrics_format,
+                                 timeout=timeout)
+
+    def serve(self, handlers):
+        """
+        Server side: run the pending command with the handler of the same
+        name in the given dict, and reply with its result. Errors are
+        replied to the controller, not raised.
+        Return False if the control end was closed.
+        """
+        try:
+            message = self.server_end.recv()
+        except EOFError:
+            return False
+        if message is None:
+            message, self.pending = self.pending, None
+            if message is None: # already run, on a previous wake-up
+                return True
+        command_id, command, args = message
+        try:
+            reply = (command_id, ADMIN_REPLY_OK, handlers[command](*args))
+        except Exception as e:
+            logger.warning('Admin command %s failed: %r', command, e)
+            reply = (command_id, ADMIN_REPLY_ERROR, repr(e))
+        self.server_end.send(reply)
+        return True
+
+    def close(self):
+        self.server_end.close()
+        self.control_end.close()
@@ -0,0 +1,269 @@
+"""
+Loopback load and latency benchmark of the Synchronized Trigger Server.
+
+run_benchmark starts each server implementation (see SERVER_MODES) on
+localhost and drives it with 1 to N concurrent ST_NTPClient clients, each
+in its own process, sending probes one after the other for a given
+duration. It reports, for each mode and number of clients:
+    - round-trip latency quantiles (p50, p99, p999), mean and max, in second
+    - throughput, in requests per second, and number of lost probes
+    - CPU use of the server and of all clients, in CPU seconds per second
+
+Results are lists of dicts, saved as JSON (save_results), and can be
+compared with a baseline (compare_results).
+
+Note: servers answer one TCP connection at a time, so that concurrent
+clients use UDP (the default transport), except for the 'supervisor'
+mode which shares the port between worker processes.
+CPU use is read from /proc, on Linux only (None elsewhere).
+"""
+import os
+import sys
+import time
+import json
+import platform
+import logging
+from multiprocessing import Process, Queue, Barrier
+
+import numpy as np
+
+from .server import STServerProcess, STServerThread, ST_NTPClient
+from .server import STSTimeoutError, STS_TRANSPORT_UDP, STS_TRANSPORT_TCP
+from .server import STS_WIRE_V1
+from .supervisor import STServerSupervisor
+
+logger = logging.getLogger('polos')
+
+SERVER_MODES = ('thread', 'process', 'async', 'supervisor')
+RESULT_LATENCIES = ('p50', 'p99', 'p999', 'mean', 'max')
+STARTUP_TIME = 0.3 # second, to let servers bind their port
+CLIENT_TIMEOUT = 30 # second, to get client results beyond the duration
+
+def get_cpu_time(pid=None):
+    """
+    Return the CPU time (user + system) used by the given process, or by
+    the current one if pid is None, in second. None if unavailable.
+    """
+    if pid is None:
+        return time.process_time()
+    try:
+        with open('/proc/%d/stat' % pid) as fin:
+            # Skip the command name, which may hold spaces
+            fields = fin.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime are fields 14 and 15 of stat(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class BenchServer:
+    """ Server of the given mode (see SERVER_MODES), to start and stop """
+
+    def __init__(self, mode, port, nb_workers=2):
+        assert(mode in SERVER_MODES)
+        self.mode = mode
+        self.port = port
+        if mode == 'thread':
+            self.server = STServerThread(port=port, udp=True,
+                                         receive_timeout=0.5)
+        elif mode == 'process':
+            self.server = STServerProcess(port=port, udp=True,
+                                          receive_timeout=0.5)
+        elif mode == 'async':
+            self.server = STServerThread(port=port, udp=True,
+                                         receive_timeout=0.5,
+                                         async_callbacks=True)
+        else:
+            self.server = STServerSupervisor(port=port, udp=True,
+                                             nb_workers=nb_workers,
+                                             receive_timeout=0.5)
+
+    def start(self):
+        self.server.start()
+        time.sleep(STARTUP_TIME)
+
+    def get_cpu_time(self):
+        """ Return the CPU time used by the server, in second """
+        if self.mode in ('thread', 'async'):
+            # Clients run in other processes
+            return get_cpu_time()
+        elif self.mode == 'process':
+            return get_cpu_time(self.server.pid)
+        cpu_times = [get_cpu_time(worker.pid) \
+                     for worker in self.server.workers]
+        return None if None in cpu_times else sum(cpu_times)
+
+    def stop(self):
+        if self.mode == 'supervisor':
+            self.server.stop()
+            return
+        client = ST_NTPClient()
+        try:
+            client.connect('localhost', self.port)
+            client.shutdown_server()
+        finally:
+            client.close()
+        self.server.join(timeout=1)
+
+
+def run_client(port, transport, duration, nb_warmup, barrier, results):
+    """
+    Client process: send nb_warmup probes, wait for the others, then send
+    probes one after the other for the given duration. Put (round-trip
+    times in ns, number of lost probes, elapsed time, CPU time) in results.
+    """
+    client = ST_NTPClient(transport=transport, wire_format=STS_WIRE_V1)
+    client.connect('localhost', port)
+    client.socket.setblocking(False)
+    for _ in range(nb_warmup):
+        try:
+            client.single_request()
+        except STSTimeoutError:
+            pass
+    # Preallocated for the fastest possible loopback (~5 us per request)
+    round_trips = np.zeros(int(duration * 1e6 / 5) + 1, dtype=np.int64)
+    nb_requests = 0
+    nb_lost = 0
+    barrier.wait()
+
+    cpu_start = time.process_time()
+    ts_start = time.perf_counter_ns()
+    ts_end = ts_start + round(duration * 1e9)
+    ts_request = ts_start
+    while ts_request < ts_end and nb_requests < len(round_trips):
+        try:
+            client.single_request()
+        except STSTimeoutError:
+            nb_lost += 1
+            ts_request = time.perf_counter_ns()
+            continue
+        ts_reply = time.perf_counter_ns()
+        round_trips[nb_requests] = ts_reply - ts_request
+        nb_requests += 1
+        ts_request = ts_reply
+    elapsed = (time.perf_counter_ns() - ts_start) / 1e9
+    cpu_time = time.process_time() - cpu_start
+    client.close()
+    results.put((round_trips[:nb_requests], nb_lost, elapsed, cpu_time))
+
+def run_load(server, nb_clients, duration, transport=STS_TRANSPORT_UDP,
+             nb_warmup=100):
+    """
+    Drive the given started BenchServer with nb_clients concurrent clients.
+    Return a result dict.
+    """
+    barrier = Barrier(nb_clients + 1)
+    results = Queue()
+    clients = [Process(target=run_client,
+                       args=(server.port, transport, duration, nb_warmup,
+                             barrier, results)) \
+               for _ in range(nb_clients)]
+    for client in clients:
+        client.start()
+    barrier.wait(timeout=CLIENT_TIMEOUT)
+    server_cpu_start = server.get_cpu_time()
+    ts_start = time.perf_counter()
+    client_results = [results.get(timeout=duration + CLIENT_TIMEOUT) \
+                      for _ in clients]
+    elapsed = time.perf_counter() - ts_start
+    server_cpu_end = server.get_cpu_time()
+    for client in clients:
+        client.join()
+
+    round_trips = np.concatenate([r[0] for r in client_results]) / 1e9
+    nb_requests = len(round_trips)
+    result = {'mode' : server.mode, 'transport' : transport,
+              'nb_clients' : nb_clients, 'duration' : elapsed,
+              'nb_requests' : nb_requests,
+              'nb_lost' : sum(r[1] for r in client_results),
+              'throughput' : sum(len(r[0]) / r[2] for r in client_results),
+              'client_cpu' : sum(r[3] for r in client_results) / elapsed}
+    if nb_requests > 0:
+        p50, p99, p999 = np.percentile(round_trips, [50, 99, 99.9])
+        result.update(p50=p50, p99=p99, p999=p999,
+                      mean=round_trips.mean(), max=round_trips.max())
+    else:
+        result.update({latency : None for latency in RESULT_LATENCIES})
+    if server_cpu_start is not None and server_cpu_end is not None:
+        result['server_cpu'] = (server_cpu_end - server_cpu_start) / elapsed
+    else:
+        result['server_cpu'] = None
+    return result
+
+def run_benchmark(modes=SERVER_MODES, nb_clients=(1, 2, 4), duration=2.,
+                  port=8990, transport=STS_TRANSPORT_UDP, nb_workers=2):
+    """
+    Benchmark each server mode with each number of clients.
+    A new server is started for each mode, on the given port.
+    Return a list of result dicts (see run_load).
+    """
+    results = []
+    for mode in modes:
+        if transport == STS_TRANSPORT_TCP and mode != 'supervisor' and \
+           max(nb_clients) > 1:
+            logger.warning('Skipping %s mode: concurrent TCP clients '\
+                           'require the supervisor mode', mode)
+            continue
+        server = BenchServer(mode, port, nb_workers)
+        server.start()
+        try:
+            for nb in nb_clients:
+                result = run_load(server, nb, duration, transport)
+                logger.info('%s', format_result(result))
+                results.append(result)
+        finally:
+            server.stop()
+    return results
+
+def format_result(result):
+    """ Return a one-line summary of a result """
+    return '%-10s %3d clients: %9.0f req/s, p50 %s, p99 %s, p999 %s, '\
+           'server CPU %s' % \
+           (result['mode'], result['nb_clients'], result['throughput'],
+            *['%8.1f us' % (result[q] * 1e6) if result[q] is not None \
+              else 'NA' for q in ('p50', 'p99', 'p999')],
+            '%.2f' % result['server_cpu'] \
+            if result['server_cpu'] is not None else 'NA')
+
+def get_environment():
+    """ Return a description of the host, saved with results """
+    return {'python' : sys.version.split()[0],
+            'platform' : platform.platform(),
+            'nb_cpus' : os.cpu_count()}
+
+def save_results(results, filename):
+    with open(filename, 'w') as fout:
+        json.dump({'environment' : get_environment(), 'results' : results},
+                  fout, indent=1)
+
+def load_results(filename):
+    with open(filename) as fin:
+        return json.load(fin)['results']
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    Compare results with baseline ones, matched by mode, transport and
+    number of clients.
+    Return a list of regressions: (result key, metric, baseline value,
+    value), for latencies higher or throughput lower than the baseline by
+    more than the given relative tolerance.
+    """
+    def key(result):
+        return result['mode'], result['transport'], result['nb_clients']
+    baseline = {key(result) : result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get(key(result))
+        if reference is None:
+            continue
+        for latency in ('p50', 'p99', 'p999'):
+            if result[latency] is not None and \
+               reference[latency] is not None and \
+               result[latency] > reference[latency] * (1 + tolerance):
+                regressions.append((key(result), latency, reference[latency],
+                                    result[latency]))
+        if result['throughput'] < reference['throughput'] * (1 - tolerance):
+            regressions.append((key(result), 'throughput',
+                                reference['throughput'],
+                                result['throughput']))
+    return regressions
@@ -0,0 +1,237 @@
+"""
+Clock model of a Synchronized Trigger Server (STS) shared by all processes
+of a host.
+
+A ClockPublisher writes the parameters of a ClockModel (offset, drift and
+their covariance) in a small block of multiprocessing.shared_memory,
+eg on each update of a ClockSync (see its publisher argument, and script
+polos_clock_share). Any process of the host can then attach a
+ClockReader to it by name and convert local time.time_ns() values to
+server time, without probing the server itself.
+
+Like the status board (see polos.statusboard), the record has a single
+writer and is guarded by a sequence lock: the writer makes the sequence
+number odd, updates the record, then makes it even again. Readers copy
+the fields they need and retry if the sequence number was odd or changed
+meanwhile. Conversions only read a few words of shared memory: they take
+well under a microsecond.
+
+Block layout:
+    - header: CLOCK_SHARE_HEADER (magic, version, record size), padded to
+      CLOCK_SHARE_HEADER_SIZE
+    - record: CLOCK_DTYPE
+
+>>> publisher = ClockPublisher()                                #doctest: +SKIP
+>>> clock_sync = ClockSync('server', publisher=publisher)       #doctest: +SKIP
+>>> clock_sync.start()                                          #doctest: +SKIP
+>>> # In another process:
+>>> reader = ClockReader(publisher.name)                        #doctest: +SKIP
+>>> reader.to_server_time(time.time_ns())                       #doctest: +SKIP
+"""
+import os
+import time
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+CLOCK_SHARE_MAGIC = b'PLCK'
+CLOCK_SHARE_VERSION = 1
+CLOCK_SHARE_HEADER = struct.Struct('<4sHHI')
+CLOCK_SHARE_HEADER_SIZE = 64 # record aligned on a cache line
+CLOCK_SHARE_DEFAULT_NAME = 'polos_clock'
+
+# Model of ClockModel: server = local + offset + drift * (local - t_ref),
+# with offset in ns here. Integer fields are 0 until the first update.
+CLOCK_DTYPE = np.dtype([('seq', '<i8'), ('t_ref', '<i8'), ('offset', '<f8'),
+                        ('drift', '<f8'), ('var_offset', '<f8'),
+                        ('cov', '<f8'), ('var_drift', '<f8'),
+                        ('pid', '<i8'), ('ts_published', '<i8'),
+                        ('nb_updates', '<i8')])
+# Index of fields in the block, in 8-byte words
+CLOCK_WORDS = {name : (CLOCK_SHARE_HEADER_SIZE + \
+                       CLOCK_DTYPE.fields[name][1]) // 8 \
+               for name in CLOCK_DTYPE.names}
+# Leading fields of the record: seq, t_ref, offset, drift,
+# then var_offset, cov, var_drift
+CLOCK_CONVERSION = struct.Struct('<qqdd')
+CLOCK_MODEL = struct.Struct('<qqddddd')
+
+# Names of the blocks created by this process (or its parent, if forked),
+# which must stay registered to the resource tracker when attached to
+_created_names = set()
+
+class ClockBusyError(Exception): pass
+
+class ClockNotPublishedError(Exception): pass
+
+def _open_block(name):
+    """ Attach to the existing clock block of the given name """
+    shm = shared_memory.SharedMemory(name=name)
+    if shm.name not in _created_names:
+        # Other processes must not destroy the block when they exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    magic, version, record_size, _ = \
+        CLOCK_SHARE_HEADER.unpack_from(shm.buf, 0)
+    if magic != CLOCK_SHARE_MAGIC:
+        shm.close()
+        raise ValueError('%s is not a shared clock' % name)
+    if version != CLOCK_SHARE_VERSION or record_size != CLOCK_DTYPE.itemsize:
+        shm.close()
+        raise ValueError('%s: unsupported shared clock version %d' % \
+                         (name, version))
+    return shm
+
+
+class ClockPublisher:
+    """
+    Writer of a shared clock model. Creates the shared memory block of the
+    given name (given by the system if None).
+    Only one process must publish to a given block. The creator must call
+    close(unlink=True) when done.
+    """
+    def __init__(self, name=None):
+        size = CLOCK_SHARE_HEADER_SIZE + CLOCK_DTYPE.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=size)
+        CLOCK_SHARE_HEADER.pack_into(self.shm.buf, 0, CLOCK_SHARE_MAGIC,
+                                     CLOCK_SHARE_VERSION,
+                                     CLOCK_DTYPE.itemsize, 0)
+        _created_names.add(self.shm.name)
+        self.name = self.shm.name
+        self.words = self.shm.buf.cast('q')
+        self.floats = self.shm.buf.cast('d')
+        self.nb_updates = 0
+
+    def publish(self, model):
+        """ Publish the current parameters of the given ClockModel """
+        t_ref, offset, drift, var_offset, cov, var_drift = model.params
+        self.publish_params(t_ref, offset * 1e9, drift, var_offset, cov,
+                            var_drift)
+
+    def publish_params(self, t_ref, offset, drift, var_offset=0., cov=0.,
+                       var_drift=0.):
+        """
+        Publish the given model: server = local + offset
+        + drift * (local - t_ref), with t_ref, local and server times in ns,
+        offset in ns and drift in second per second. Variances are those
+        of ClockModel, in second.
+        """
+        words = self.words
+        floats = self.floats
+        self.nb_updates += 1
+        words[CLOCK_WORDS['seq']] += 1
+        words[CLOCK_WORDS['t_ref']] = t_ref
+        floats[CLOCK_WORDS['offset']] = offset
+        floats[CLOCK_WORDS['drift']] = drift
+        floats[CLOCK_WORDS['var_offset']] = var_offset
+        floats[CLOCK_WORDS['cov']] = cov
+        floats[CLOCK_WORDS['var_drift']] = var_drift
+        words[CLOCK_WORDS['pid']] = os.getpid()
+        words[CLOCK_WORDS['nb_updates']] = self.nb_updates
+        words[CLOCK_WORDS['ts_published']] = time.time_ns()
+        words[CLOCK_WORDS['seq']] += 1
+
+    def close(self, unlink=False):
+        # Views must be released before closing the shared memory
+        self.words.release()
+        self.floats.release()
+        self.shm.close()
+        if unlink:
+            _created_names.discard(self.shm.name)
+            self.shm.unlink()
+
+
+class ClockReader:
+    """
+    Reader of the shared clock model of the given name, published by a
+    ClockPublisher of any process of the host.
+    Conversions raise ClockNotPublishedError before the first update,
+    and ClockBusyError if the model stays locked by its writer for
+    READ_TIMEOUT.
+    """
+    READ_TIMEOUT = 0.1 # second
+
+    def __init__(self, name=CLOCK_SHARE_DEFAULT_NAME):
+        self.shm = _open_block(name)
+        self.name = self.shm.name
+        self.words = self.shm.buf.cast('q')
+        self.to_server_time = self._make_converter()
+
+    def _make_converter(self):
+        """
+        Return the conversion function, a closure over the shared memory,
+        which avoids attribute lookups: this is the hot path.
+        """
+        unpack = CLOCK_CONVERSION.unpack_from
+        buf = self.shm.buf
+        words = self.words
+        iseq = CLOCK_WORDS['seq']
+        read_params = self.read_params
+        def to_server_time(local_ns):
+            """ Convert the given local time to server time, both in ns """
+            seq, t_ref, offset, drift = unpack(buf, CLOCK_SHARE_HEADER_SIZE)
+            if seq & 1 or seq == 0 or words[iseq] != seq:
+                t_ref, offset, drift, _, _, _ = read_params()
+            return local_ns + round(offset + drift * (local_ns - t_ref))
+        return to_server_time
+
+    def is_ready(self):
+        return self.words[CLOCK_WORDS['nb_updates']] > 0
+
+    def server_time(self):
+        """ Return the current server time, in ns """
+        return self.to_server_time(time.time_ns())
+
+    def get_offset(self, local_ns=None):
+        """ Return the offset in second, at the given local time """
+        if local_ns is None:
+            local_ns = time.time_ns()
+        return (self.to_server_time(local_ns) - local_ns) / 1e9
+
+    def get_uncertainty(self, local_ns=None):
+        """ See ClockModel.get_uncertainty """
+        if local_ns is None:
+            local_ns = time.time_ns()
+        t_ref, _, _, var_offset, cov, var_drift = self.read_params()
+        dt = (local_ns - t_ref) / 1e9
+        return np.sqrt(var_offset + 2 * dt * cov + dt**2 * var_drift)
+
+    def read_params(self):
+        """
+        Return a consistent copy of the model: (t_ref, offset, drift,
+        var_offset, cov, var_drift), with t_ref and offset in ns
+        (see ClockPublisher.publish_params).
+        """
+        words = self.words
+        iseq = CLOCK_WORDS['seq']
+        ts_end = None
+        while True:
+            seq, *params = CLOCK_MODEL.unpack_from(self.shm.buf,
+                                                   CLOCK_SHARE_HEADER_SIZE)
+            if seq & 1 == 0 and words[iseq] == seq:
+                break
+            # Let the writer finish, in case it runs on the same CPU
+            if ts_end is None:
+                ts_end = time.perf_counter() + ClockReader.READ_TIMEOUT
+            elif time.perf_counter() > ts_end:
+                raise ClockBusyError('Shared clock %s locked' % self.name)
+            os.sched_yield()
+        if seq == 0:
+            raise ClockNotPublishedError('Shared clock %s not published '\
+                                         'yet' % self.name)
+        return tuple(params)
+
+    def read_info(self):
+        """
+        Return the publisher pid, the time of the last update (local,
+        in ns) and the number of updates, as a dict.
+        """
+        return {'pid' : self.words[CLOCK_WORDS['pid']],
+                'ts_published' : self.words[CLOCK_WORDS['ts_published']],
+                'nb_updates' : self.words[CLOCK_WORDS['nb_updates']]}
+
+    def close(self):
+        del self.to_server_time # holds a view of the shared memory
+        self.words.release()
+        self.shm.close()
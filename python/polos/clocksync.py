@@ -0,0 +1,249 @@
+"""
+Continuous clock synchronization with a Synchronized Trigger Server (STS).
+
+A ClockSync thread probes the server periodically and feeds a ClockModel,
+which tracks the clock offset and its drift (frequency error). The model
+then converts local timestamps to server time without network traffic.
+"""
+import time
+import logging
+from threading import Thread, Event
+
+import numpy as np
+
+from ._polos import STATUS_OK, STATUS_ERROR, STATUS_WARNING
+from .server import ST_NTPClient, STS_DEFAULT_PORT, STS_TRANSPORT_UDP
+from .server import STS_WIRE_V1, STS_PROBE
+from .server import format_duration
+
+logger = logging.getLogger('polos')
+
+class ClockModel:
+    """
+    Linear model of the server clock relative to the local one:
+
+        server_time = local_time + offset + drift * (local_time - t_ref)
+
+    Parameters are fitted by weighted least squares on a window of the
+    last offset samples. Each sample is weighted by the inverse variance
+    of its error, which is bounded by half its round-trip delay.
+
+    The current parameters are held in a single tuple which is replaced on
+    update, so that readers in other threads always see a consistent model.
+    Conversions are O(1).
+    """
+
+    def __init__(self, window=32):
+        """
+        argument:
+            window (int): number of last samples used for the fit
+        """
+        assert(window >= 2)
+        self.window = window
+        self.sample_times = np.zeros(window, dtype=np.int64) # local, ns
+        self.sample_offsets = np.zeros(window) # second
+        self.sample_delays = np.zeros(window) # second
+        self.nb_samples = 0
+
+        # t_ref (local ns), offset (s), drift (s/s),
+        # var(offset), cov(offset, drift), var(drift)
+        self.params = None
+
+    def is_ready(self):
+        return self.params is not None
+
+    def add_sample(self, local_ns, offset, delay):
+        """
+        Add an offset sample and refit the model.
+
+        arguments:
+            - local_ns (int): local time of the sample, in ns
+            - offset (float): server time minus local time, in second
+            - delay (float): round-trip delay of the probe, in second
+        """
+        i_sample = self.nb_samples % self.window
+        self.sample_times[i_sample] = local_ns
+        self.sample_offsets[i_sample] = offset
+        self.sample_delays[i_sample] = delay
+        self.nb_samples += 1
+        self.fit(t_ref=local_ns)
+
+    def fit(self, t_ref):
+        n = min(self.nb_samples, self.window)
+        dt = (self.sample_times[:n] - t_ref) / 1e9
+        offsets = self.sample_offsets[:n]
+        # Offset error is within +/- delay/2: variance of a uniform
+        # distribution, with a floor to avoid infinite weights
+        variances = np.maximum(self.sample_delays[:n], 1e-7)**2 / 12
+        weights = 1 / variances
+
+        if n < 2 or np.ptp(dt) == 0:
+            offset = np.average(offsets, weights=weights)
+            self.params = (t_ref, offset, 0., 1 / weights.sum(), 0., 0.)
+            return
+
+        design = np.stack([np.ones(n), dt], axis=1)
+        normal = design.T @ (design * weights[:, np.newaxis])
+        cov = np.linalg.inv(normal)
+        offset, drift = cov @ (design.T @ (weights * offsets))
+        if n > 2:
+            # Inflate uncertainty if residuals exceed the delay-based errors
+            residuals = offsets - offset - drift * dt
+            chi2 = (weights * residuals**2).sum() / (n - 2)
+            cov = cov * max(chi2, 1)
+        self.params = (t_ref, offset, drift, cov[0, 0], cov[0, 1], cov[1, 1])
+
+    def get_offset(self, local_ns=None):
+        """ Return the offset in second, at the given local time """
+        if local_ns is None:
+            local_ns = time.time_ns()
+        t_ref, offset, drift, _, _, _ = self.params
+        return offset + drift * (local_ns - t_ref) / 1e9
+
+    def get_drift(self):
+        """ Return the estimated drift, in second per second """
+        return self.params[2]
+
+    def to_server_time(self, local_ns):
+        """ Convert the given local time to server time, both in ns """
+        t_ref, offset, drift, _, _, _ = self.params
+        return local_ns + round((offset + drift * (local_ns - t_ref) / 1e9) \
+                                * 1e9)
+
+    def get_uncertainty(self, local_ns=None):
+        """
+        Return the standard deviation of the offset estimate at the given
+        local time, in second. It grows with the time since the last sample.
+        """
+        if local_ns is None:
+            local_ns = time.time_ns()
+        t_ref, _, _, var_offset, cov, var_drift = self.params
+        dt = (local_ns - t_ref) / 1e9
+        return np.sqrt(var_offset + 2 * dt * cov + dt**2 * var_drift)
+
+
+class ClockSync(Thread):
+    """
+    Keep a ClockModel in sync with a STS, by probing it periodically
+    in a background thread.
+
+    The probing interval adapts between min_interval and max_interval:
+    it is doubled when the predicted uncertainty at the next probing is
+    below target_uncertainty, else halved.
+
+    Each probing session sends nb_trials probes (see ST_NTPClient.request)
+    and keeps the offset of the one with the smallest round-trip delay.
+    UDP is used by default, the server must then be started with udp=True.
+    Probes use the binary wire format, for nanosecond timestamps, and
+    are STS_PROBE requests: they do not fire any server callback.
+
+    If publisher is given (see polos.clockshare), the model is published
+    to it on each update, so that other processes of the host can convert
+    times without probing the server.
+
+    >>> clock_sync = ClockSync('localhost')            #doctest: +SKIP
+    >>> clock_sync.start()                             #doctest: +SKIP
+    >>> clock_sync.wait_ready()                        #doctest: +SKIP
+    >>> clock_sync.to_server_time(time.time_ns())      #doctest: +SKIP
+    """
+
+    DEFAULT_NAME = 'ClockSync'
+
+    def __init__(self, host, port=STS_DEFAULT_PORT,
+                 transport=STS_TRANSPORT_UDP, nb_trials=20, in_flight=4,
+                 min_interval=1., max_interval=64.,
+                 target_uncertainty=100e-6, window=32,
+                 client_name=DEFAULT_NAME, publisher=None):
+        super().__init__(daemon=True)
+        assert(0 < min_interval <= max_interval)
+
+        self.host = host
+        self.port = port
+        self.nb_trials = nb_trials
+        self.in_flight = in_flight
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_uncertainty = target_uncertainty
+        self.interval = min_interval
+
+        self.client = ST_NTPClient(client_name, transport=transport,
+                                   wire_format=STS_WIRE_V1,
+                                   probe_command=STS_PROBE)
+        self.model = ClockModel(window)
+        self.client_name = client_name
+        self.publisher = publisher
+        self.nb_updates = 0
+
+        self.finished = Event()
+        self.updated = Event()
+
+        self.status = STATUS_ERROR
+        self.status_message = 'Not started'
+
+    def get_status(self):
+        return self.status, self.status_message
+
+    def run(self):
+        self.client.connect(self.host, self.port)
+        while not self.finished.is_set():
+            try:
+                self.update()
+            except Exception as e:
+                logger.warning('%s probing failed: %s', self.client_name, e)
+                self.status = STATUS_ERROR
+                self.status_message = 'Probing failed: %s' % e
+                self.interval = self.min_interval
+            self.finished.wait(self.interval)
+        self.client.close()
+
+    def update(self):
+        """ Run a probing session, update the model and the interval """
+        self.client.request(self.nb_trials, self.in_flight)
+        best = np.argmin(self.client.delays)
+        self.model.add_sample(self.client.probe_times[best],
+                              self.client.offsets[best],
+                              self.client.delays[best])
+        if self.publisher is not None:
+            self.publisher.publish(self.model)
+        self.nb_updates += 1
+
+        next_uncertainty = self.model.get_uncertainty(time.time_ns() + \
+                                                      self.interval * 2e9)
+        if next_uncertainty < self.target_uncertainty:
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = max(self.interval / 2, self.min_interval)
+
+        uncertainty = self.model.get_uncertainty()
+        logger.debug('%s offset: %s, drift: %1.3f ppm, uncertainty: %s, '\
+                     'next probing in %1.1f s', self.client_name,
+                     format_duration(self.model.get_offset()),
+                     self.model.get_drift() * 1e6,
+                     format_duration(uncertainty), self.interval)
+        if uncertainty < self.target_uncertainty:
+            self.status = STATUS_OK
+        else:
+            self.status = STATUS_WARNING
+        self.status_message = 'Offset with server: %s +/- %s' % \
+                              (format_duration(self.model.get_offset()),
+                               format_duration(uncertainty))
+        self.updated.set()
+
+    def wait_ready(self, timeout=None):
+        """ Wait for the first model update. Return True if it happened """
+        return self.updated.wait(timeout)
+
+    def stop(self):
+        self.finished.set()
+
+    def server_time(self):
+        """ Return the current server time, in ns """
+        return self.model.to_server_time(time.time_ns())
+
+    def to_server_time(self, local_ns):
+        """ Convert the given local time to server time, both in ns """
+        return self.model.to_server_time(local_ns)
+
+    def get_uncertainty(self, local_ns=None):
+        """ See ClockModel.get_uncertainty """
+        return self.model.get_uncertainty(local_ns)
@@ -0,0 +1,169 @@
+"""
+Clock offset estimators from NTP-like probe samples.
+
+All estimators share the signature:
+
+    estimator(offsets, delays, times) -> offset
+
+where offsets and delays are arrays of per-probe clock offsets and
+round-trip delays and times are the probe local times, all in second.
+times may be None. The offset is estimated at the time of the last probe.
+Estimators are vectorized and do not modify their inputs.
+
+They are selected by name in ST_NTPClient.request (see ESTIMATORS), and
+compared on synthetic or recorded traces with benchmark().
+"""
+import numpy as np
+
+# Minimum number of probes per time segment to fit a drift in paxson()
+MIN_PROBES_PER_SEGMENT = 16
+# Floor of round-trip delays used as weights, in second: loopback delays
+# rounded to the nanosecond can be 0 (see ClockModel.fit)
+MIN_WEIGHT_DELAY = 1e-7
+
+def median_delay(offsets, delays, times=None):
+    """ Offset of the probe having the median round-trip delay """
+    return offsets[np.argsort(delays)[len(delays)//2]]
+
+def min_delay(offsets, delays, times=None):
+    """
+    NTP clock filter: offset of the probe having the minimum round-trip
+    delay, which is the least affected by queueing.
+    """
+    return offsets[np.argmin(delays)]
+
+def lowest_delays(offsets, delays, times=None, k=8):
+    """
+    Mean of the offsets of the k probes with the lowest round-trip delays,
+    weighted by the inverse squared delay (offset error is bounded by
+    half the delay).
+    """
+    k = min(k, len(delays))
+    selection = np.argpartition(delays, k-1)[:k]
+    weights = 1 / np.maximum(delays[selection], MIN_WEIGHT_DELAY)**2
+    return np.average(offsets[selection], weights=weights)
+
+def huber(offsets, delays, times=None, c=1.345, nb_iterations=10):
+    """
+    Robust Huber regression of the offset, by iteratively reweighted
+    least squares. If times are given, a linear drift is fitted and
+    the offset is returned at the last probe time.
+    Residuals are scaled by their median absolute deviation.
+    """
+    if times is None or np.ptp(times) == 0:
+        design = np.ones((len(offsets), 1))
+    else:
+        design = np.stack([np.ones(len(offsets)), times - times[-1]], axis=1)
+    weights = np.ones(len(offsets))
+    for _ in range(nb_iterations):
+        weighted = design * weights[:, np.newaxis]
+        params = np.linalg.lstsq(weighted.T @ design, weighted.T @ offsets,
+                                 rcond=None)[0]
+        residuals = offsets - design @ params
+        scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        if scale == 0:
+            break
+        abs_residuals = np.abs(residuals) / scale
+        weights = np.minimum(1, c / np.maximum(abs_residuals, 1e-12))
+    return params[0]
+
+def paxson(offsets, delays, times=None, nb_segments=4):
+    """
+    Asymmetry-aware estimator after Paxson (1998): the minimum forward
+    and backward one-way delays are taken independently, so that queueing
+    in one direction does not bias the offset:
+
+        offset = (min(forward) - min(backward)) / 2
+
+    with forward = offset + delay/2 = server receive - client origin
+    and backward = delay/2 - offset = client destination - server transmit.
+
+    If times are given and there are enough probes, the minima are taken
+    per time segment and a linear drift is fitted through them, and the
+    offset is returned at the last probe time.
+    """
+    forward = offsets + delays / 2
+    backward = delays / 2 - offsets
+    if times is None or np.ptp(times) == 0 or \
+       len(offsets) < MIN_PROBES_PER_SEGMENT * nb_segments:
+        return (forward.min() - backward.min()) / 2
+
+    segments = np.array_split(np.argsort(times), nb_segments)
+    def lower_envelope(one_way):
+        i_mins = np.array([s[np.argmin(one_way[s])] for s in segments])
+        slope, intercept = np.polyfit(times[i_mins] - times[-1],
+                                      one_way[i_mins], 1)
+        return intercept
+    return (lower_envelope(forward) - lower_envelope(backward)) / 2
+
+ESTIMATORS = {'median_delay' : median_delay,
+              'min_delay' : min_delay,
+              'lowest_delays' : lowest_delays,
+              'huber' : huber,
+              'paxson' : paxson}
+
+def get_estimator(estimator):
+    """ Return the estimator function for the given name or callable """
+    if callable(estimator):
+        return estimator
+    if estimator not in ESTIMATORS:
+        raise ValueError('Unknown estimator %s. Available: %s' % \
+                         (estimator, ', '.join(ESTIMATORS)))
+    return ESTIMATORS[estimator]
+
+def synthetic_trace(nb_probes, offset=0., drift=0., base_delay=100e-6,
+                    queueing_delay=200e-6, asymmetry=0., interval=1e-3,
+                    seed=None):
+    """
+    Generate NTP-like probe samples with known offset and drift.
+
+    One-way delays are base_delay/2 plus exponential queueing delays.
+    Queueing on the backward path is scaled by (1 + asymmetry).
+
+    Return (offsets, delays, times, true offset at the last probe time),
+    all in second.
+    """
+    rng = np.random.RandomState(seed)
+    times = np.arange(nb_probes) * interval
+    true_offsets = offset + drift * times
+    forward = base_delay / 2 + rng.exponential(queueing_delay, nb_probes)
+    backward = base_delay / 2 + \
+               rng.exponential(queueing_delay * (1 + asymmetry), nb_probes)
+    offsets = true_offsets + (forward - backward) / 2
+    delays = forward + backward
+    return offsets, delays, times, true_offsets[-1]
+
+def benchmark(nb_probes=(5, 10, 20, 50, 100), nb_runs=200, trace=None,
+              estimators=None, seed=0, **trace_options):
+    """
+    Compare the accuracy of estimators against the number of probes.
+
+    If trace is None, each run uses a new synthetic trace (see
+    synthetic_trace, which takes trace_options). Else trace is a recorded
+    (offsets, delays, times, true_offset) tuple, from which runs draw
+    random windows of consecutive probes. true_offset is 0 for a trace
+    recorded on a single host.
+
+    Return a dict mapping estimator names to arrays of root mean square
+    errors, in second, one per number of probes.
+    """
+    if estimators is None:
+        estimators = ESTIMATORS
+    rng = np.random.RandomState(seed)
+    squared_errors = {name : np.zeros(len(nb_probes)) for name in estimators}
+    for i_nb, nb in enumerate(nb_probes):
+        for _ in range(nb_runs):
+            if trace is None:
+                offsets, delays, times, true_offset = \
+                    synthetic_trace(nb, seed=rng.randint(2**31),
+                                    **trace_options)
+            else:
+                start = rng.randint(len(trace[0]) - nb + 1)
+                offsets, delays, times = [a[start:start+nb] \
+                                          for a in trace[:3]]
+                true_offset = trace[3]
+            for name, estimator in estimators.items():
+                squared_errors[name][i_nb] += \
+                    (estimator(offsets, delays, times) - true_offset)**2
+    return {name : np.sqrt(se / nb_runs) \
+            for name, se in squared_errors.items()}
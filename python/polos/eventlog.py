@@ -0,0 +1,151 @@
+"""
+High-rate binary event log, for full per-request traces.
+
+An EventLogger records (time in ns, event code, argument) in a
+preallocated NumPy ring buffer, without formatting nor allocating memory,
+so that it can be used in the server and client hot loops instead of the
+logging module. When the buffer is full, the oldest events are
+overwritten.
+
+Appends take no lock: each logger must be written by one thread only.
+
+The log is dumped to a compact binary file (dump), read back as arrays
+by read_event_log:
+    - header: EVENT_LOG_HEADER (magic, version, record size, number of
+      logged events, number of overwritten events)
+    - records: EVENT_DTYPE, oldest first
+"""
+import struct
+import time
+
+import numpy as np
+
+EVENT_DTYPE = np.dtype([('ts', '<i8'), ('code', '<u2'), ('arg', '<i8')])
+EVENT_LOG_MAGIC = b'PLEV'
+EVENT_LOG_VERSION = 1
+EVENT_LOG_HEADER = struct.Struct('<4sHHQQ')
+
+# Server events
+EVENT_CONNECT = 1 # arg: client port
+EVENT_DISCONNECT = 2
+EVENT_RECEIVE = 3 # arg: number of bytes received
+EVENT_REQUEST = 4 # arg: sequence number
+EVENT_CALLBACK_END = 5 # arg: sequence number
+EVENT_REPLY = 6 # arg: sequence number
+EVENT_SCHEDULE = 7 # arg: sequence number
+EVENT_FIRE = 8 # arg: sequence number, ts: callback start
+# Client events
+EVENT_SEND = 16 # arg: sequence number
+EVENT_REPLY_RECEIVED = 17 # arg: sequence number
+EVENT_LOCAL_TRIGGER = 18 # arg: sequence number of the remote trigger
+EVENT_RECONNECT = 19 # arg: number of reconnections
+
+EVENT_NAMES = {EVENT_CONNECT : 'connect',
+               EVENT_DISCONNECT : 'disconnect',
+               EVENT_RECEIVE : 'receive',
+               EVENT_REQUEST : 'request',
+               EVENT_CALLBACK_END : 'callback_end',
+               EVENT_REPLY : 'reply',
+               EVENT_SCHEDULE : 'schedule',
+               EVENT_FIRE : 'fire',
+               EVENT_SEND : 'send',
+               EVENT_REPLY_RECEIVED : 'reply_received',
+               EVENT_LOCAL_TRIGGER : 'local_trigger',
+               EVENT_RECONNECT : 'reconnect'}
+
+class EventLogger:
+    """
+    Ring buffer of the last size events.
+
+    If filename is given, servers dump the log to it when they stop (see
+    sync_trigger_server), which is the way to get the log of a server
+    running in another process.
+
+    >>> event_logger = EventLogger(size=1000)
+    >>> event_logger.log(EVENT_SEND, 1)
+    >>> event_logger.get_events()['code']
+    array([16], dtype=uint16)
+    """
+    DEFAULT_SIZE = 2**16
+
+    def __init__(self, size=DEFAULT_SIZE, filename=None):
+        assert(size > 0)
+        self.size = size
+        self.filename = filename
+        self.events = np.zeros(size, dtype=EVENT_DTYPE)
+        # Field views, faster to write than records
+        self._ts = self.events['ts']
+        self._codes = self.events['code']
+        self._args = self.events['arg']
+        self.nb_events = 0 # logged since creation or reset
+
+    def log(self, code, arg=0, ts=None):
+        """ Record an event, at the current time (in ns) if ts is None """
+        if ts is None:
+            ts = time.time_ns()
+        ievent = self.nb_events % self.size
+        self._ts[ievent] = ts
+        self._codes[ievent] = code
+        self._args[ievent] = arg
+        self.nb_events += 1
+
+    def reset(self):
+        self.nb_events = 0
+
+    def get_nb_dropped(self):
+        """ Return the number of events overwritten by newer ones """
+        return max(0, self.nb_events - self.size)
+
+    def get_events(self):
+        """ Return a copy of the recorded events, oldest first """
+        if self.nb_events <= self.size:
+            return self.events[:self.nb_events].copy()
+        ioldest = self.nb_events % self.size
+        return np.concatenate((self.events[ioldest:],
+                               self.events[:ioldest]))
+
+    def dump(self, filename=None):
+        """ Write the events to the given binary file (default: filename) """
+        if filename is None:
+            filename = self.filename
+        with open(filename, 'wb') as fout:
+            fout.write(EVENT_LOG_HEADER.pack(EVENT_LOG_MAGIC,
+                                             EVENT_LOG_VERSION,
+                                             EVENT_DTYPE.itemsize,
+                                             self.nb_events,
+                                             self.get_nb_dropped()))
+            fout.write(self.get_events().tobytes())
+
+    def to_string(self):
+        return format_events(self.get_events())
+
+
+def read_event_log(filename):
+    """
+    Read a log written by EventLogger.dump.
+
+    output:
+        - events (structured array of EVENT_DTYPE): fields 'ts' (ns),
+          'code' and 'arg', oldest first
+        - number of events which were overwritten before the dump
+    """
+    with open(filename, 'rb') as fin:
+        header = fin.read(EVENT_LOG_HEADER.size)
+        if len(header) < EVENT_LOG_HEADER.size:
+            raise ValueError('%s: truncated event log header' % filename)
+        magic, version, record_size, _, nb_dropped = \
+            EVENT_LOG_HEADER.unpack(header)
+        if magic != EVENT_LOG_MAGIC:
+            raise ValueError('%s is not an event log' % filename)
+        if version != EVENT_LOG_VERSION or \
+           record_size != EVENT_DTYPE.itemsize:
+            raise ValueError('%s: unsupported event log version %d' % \
+                             (filename, version))
+        events = np.fromfile(fin, dtype=EVENT_DTYPE)
+    return events, nb_dropped
+
+def format_events(events):
+    """ Return one line per event: time in second, event name, argument """
+    return '\n'.join('%f : %s %d' % (ts / 1e9,
+                                     EVENT_NAMES.get(code, str(code)), arg)
+                     for ts, code, arg in events)
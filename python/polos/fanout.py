@@ -0,0 +1,254 @@
+"""
+Synchronized triggers across several Synchronized Trigger Servers (STS).
+
+A STFanOutClient keeps one connection per server and multiplexes them with
+selectors, so that probing dozens of servers takes about as long as probing
+the slowest one. Triggers are then scheduled on all servers at the same
+moment (see STS_SCHEDULE in sync_trigger_server), converted to each server
+clock by its estimated offset. Requests use the binary wire format
+(see STBaseClient).
+"""
+import time
+import logging
+import selectors
+
+import numpy as np
+
+from ._polos import STATUS_OK, STATUS_ERROR, STATUS_WARNING
+from .server import STBaseClient, STSTimeoutError, STS_DEFAULT_PORT
+from .server import STS_WIRE_V1, STS_PROBE
+from .server import STS_CALLBACK_1, STS_SCHEDULE
+from .server import STS_REPLY_V1, STS_REPLY_LATE, STS_SPIN_TIME
+from .server import format_duration
+from .estimators import get_estimator
+
+logger = logging.getLogger('polos')
+
+class STFanOutClient:
+    """
+    Fire synchronized triggers on several servers at once.
+
+    >>> client = STFanOutClient(['rpi1', ('rpi2', 8889)]) #doctest: +SKIP
+    >>> client.connect()                                  #doctest: +SKIP
+    >>> client.probe()                                    #doctest: +SKIP
+    >>> client.trigger()                                  #doctest: +SKIP
+    >>> client.spread                                     #doctest: +SKIP
+    """
+
+    DEFAULT_NAME = 'STFanOutClient'
+    SPREAD_TOLERANCE = 1e-3 # second
+
+    def __init__(self, servers, trigger_callback=None,
+                 client_name=DEFAULT_NAME):
+        """
+        arguments:
+            - servers (list): host names, or (host, port) tuples
+            - trigger_callback (callable): local trigger, fired with the
+              remote ones. Optional.
+        """
+        self.servers = [(s, STS_DEFAULT_PORT) if isinstance(s, str) else s \
+                        for s in servers]
+        assert(trigger_callback is None or callable(trigger_callback))
+        self.trigger_callback = trigger_callback
+        self.client_name = client_name
+        self.clients = [STBaseClient('%s[%s:%d]' % (client_name, host, port),
+                                     wire_format=STS_WIRE_V1) \
+                        for host, port in self.servers]
+        self.selector = selectors.DefaultSelector()
+
+        nb_servers = len(self.servers)
+        self.offsets = np.zeros(nb_servers) # server minus local time, second
+        self.delays = np.zeros(nb_servers) # median round-trip delays, second
+        self.fire_times = None # local times of the remote triggers, ns
+        self.spread = None # second
+
+        self.status = STATUS_ERROR
+        self.status_message = 'Not connected'
+
+    def get_status(self):
+        return self.status, self.status_message
+
+    def connect(self):
+        for iclient, (client, (host, port)) in enumerate(zip(self.clients,
+                                                             self.servers)):
+            client.connect(host, port)
+            client.socket.setblocking(False)
+            self.selector.register(client.socket, selectors.EVENT_READ,
+                                   iclient)
+        self.status = STATUS_WARNING
+        self.status_message = 'Connected to %d servers, but no query yet' % \
+                              len(self.clients)
+
+    def close(self):
+        for client in self.clients:
+            if client.socket is not None:
+                self.selector.unregister(client.socket)
+                client.close()
+        self.selector.close()
+        self.status = STATUS_ERROR
+        self.status_message = 'Closed'
+
+    def shutdown_servers(self):
+        for client in self.clients:
+            client.shutdown_server()
+
+    def _read_replies(self, timeout, streams):
+        """
+        Wait for replies from any server, up to timeout second.
+        Return a list of (server index, reply, reception time in ns),
+        reply being None for reports of scheduled triggers (stored in the
+        trigger_reports of the server client).
+        streams holds the incomplete replies of each server.
+        """
+        replies = []
+        for key, _ in self.selector.select(max(0, timeout)):
+            iclient = key.data
+            client = self.clients[iclient]
+            rdata = client._recv(STS_REPLY_V1.size * 4)
+            ts_destination = time.time_ns()
+            if rdata is None:
+                continue
+            if not rdata:
+                raise ConnectionError('Connection closed by server %s:%d' % \
+                                self.servers[iclient])
+            stream = streams[iclient] + rdata
+            nb_bytes = len(stream) - len(stream) % STS_REPLY_V1.size
+            for offset in range(0, nb_bytes, STS_REPLY_V1.size):
+                replies.append((iclient,
+                                client.decode_reply(stream[offset:offset + \
+                                                    STS_REPLY_V1.size]),
+                                ts_destination))
+            streams[iclient] = stream[nb_bytes:]
+        return replies
+
+    def probe(self, nb_trials=10, estimator='lowest_delays', timeout=5):
+        """
+        Estimate the clock offset and round-trip delay of all servers.
+
+        Each server is probed in lock-step, its next probe being sent as soon
+        as its reply arrives, independently of the other servers.
+        Probes are STS_PROBE requests, which do not run any server callback.
+        See ST_NTPClient.request for estimator.
+        """
+        estimator = get_estimator(estimator)
+        nb_servers = len(self.clients)
+        # origin, destination, transmit, receive in ns, per server and trial
+        timestamps = np.zeros((4, nb_servers, nb_trials), dtype=np.int64)
+        ts_orig, ts_dest, ts_tr, ts_receive = timestamps
+        nb_received = np.zeros(nb_servers, dtype=int)
+        streams = [b''] * nb_servers
+
+        def send_probe(iclient):
+            client = self.clients[iclient]
+            request = client.encode_request(STS_PROBE)
+            ts_orig[iclient, nb_received[iclient]] = time.time_ns()
+            client.send_request(request)
+
+        for iclient in range(nb_servers):
+            send_probe(iclient)
+        deadline = time.perf_counter() + timeout
+        while (nb_received < nb_trials).any():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                late = [self.servers[i] for i in range(nb_servers) \
+                        if nb_received[i] < nb_trials]
+                raise STSTimeoutError('Timeout during probing of %s' % late)
+            for iclient, reply, ts_destination in \
+                self._read_replies(remaining, streams):
+                if reply is None or reply[0] != self.clients[iclient].seq:
+                    continue
+                itrial = nb_received[iclient]
+                ts_dest[iclient, itrial] = ts_destination
+                ts_receive[iclient, itrial] = reply[1]
+                ts_tr[iclient, itrial] = reply[3]
+                nb_received[iclient] += 1
+                if nb_received[iclient] < nb_trials:
+                    send_probe(iclient)
+
+        offsets = ((ts_receive - ts_orig) + (ts_tr - ts_dest)) / 2e9
+        delays = ((ts_dest - ts_orig) - (ts_tr - ts_receive)) / 1e9
+        probe_times = ((ts_orig + ts_dest) // 2 - \
+                       ts_orig[:, -1:]) / 1e9
+        for iclient in range(nb_servers):
+            self.offsets[iclient] = estimator(offsets[iclient],
+                                              delays[iclient],
+                                              probe_times[iclient])
+        self.delays = np.median(delays, axis=1)
+        for (host, port), offset, delay in zip(self.servers, self.offsets,
+                                               self.delays):
+            logger.info('%s %s:%d offset: %s, round-trip delay: %s',
+                        self.client_name, host, port, format_duration(offset),
+                        format_duration(delay))
+        self.status = STATUS_WARNING
+        self.status_message = 'Probed %d servers, max round-trip delay: %s' % \
+                              (nb_servers, format_duration(self.delays.max()))
+
+    def trigger(self, lead_time=None, timeout=5):
+        """
+        Fire the triggers of all servers (STS_CALLBACK_1), and the local one
+        if any, at the same moment: lead_time second from now.
+        By default, lead_time is ten times the largest round-trip delay,
+        and at least 20 ms.
+        probe must have been called before.
+
+        Set fire_times to the local times of the remote callback starts,
+        as estimated from the server offsets, in ns, and spread to their
+        range in second (including the local trigger). Return spread.
+        """
+        if lead_time is None:
+            lead_time = max(10 * self.delays.max(), 20e-3)
+        ts_local = time.time_ns() + round(lead_time * 1e9)
+        offsets_ns = np.round(self.offsets * 1e9).astype(np.int64)
+
+        seqs = []
+        for client, offset_ns in zip(self.clients, offsets_ns):
+            client.send_request(client.encode_request(STS_SCHEDULE,
+                                                      ts_local + int(offset_ns),
+                                                      STS_CALLBACK_1))
+            seqs.append(client.seq)
+
+        ts_local_callback = None
+        if self.trigger_callback is not None:
+            wait = (ts_local - time.time_ns()) / 1e9 - STS_SPIN_TIME
+            if wait > 0:
+                time.sleep(wait)
+            while time.time_ns() < ts_local:
+                continue
+            ts_local_callback = time.time_ns()
+            self.trigger_callback()
+
+        streams = [b''] * len(self.clients)
+        deadline = time.perf_counter() + timeout + lead_time
+        while any(seq not in client.trigger_reports \
+                  for client, seq in zip(self.clients, seqs)):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise STSTimeoutError('Timeout during waiting for trigger '\
+                                      'reports')
+            self._read_replies(remaining, streams)
+
+        reports = [client.trigger_reports.pop(seq) \
+                   for client, seq in zip(self.clients, seqs)]
+        nb_late = sum(report[0] == STS_REPLY_LATE for report in reports)
+        if nb_late > 0:
+            logger.warning('%s %d servers received the trigger request too '\
+                           'late, increase lead_time (%s)', self.client_name,
+                           nb_late, format_duration(lead_time))
+        self.fire_times = np.array([report[2] for report in reports],
+                                   dtype=np.int64) - offsets_ns
+        fire_times = self.fire_times
+        if ts_local_callback is not None:
+            fire_times = np.append(fire_times, ts_local_callback)
+        self.spread = (fire_times.max() - fire_times.min()) / 1e9
+
+        logger.info('%s triggers fired with a spread of %s '\
+                    '(offset uncertainty up to %s)', self.client_name,
+                    format_duration(self.spread),
+                    format_duration(self.delays.max() / 2))
+        if self.spread < STFanOutClient.SPREAD_TOLERANCE and nb_late == 0:
+            self.status = STATUS_OK
+        else:
+            self.status = STATUS_WARNING
+        self.status_message = 'Trigger spread over %d servers: %s' % \
+                              (len(self.clients), format_duration(self.spread))
+        return self.spread
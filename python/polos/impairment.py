@@ -0,0 +1,295 @@
+"""
+Network impairment proxy, to test synchronization on a single host.
+
+An ImpairmentProxy relays TCP or UDP traffic between clients and a server,
+delaying, dropping and reordering it as set by an Impairment per
+direction (uplink: client to server, downlink: server to client), so that
+asymmetric networks can be simulated. Impairments are drawn from a random
+generator seeded per direction: the n-th packet of a direction gets the
+same impairment from one run to the other.
+
+Over TCP, data stays ordered: a packet is never sent before the previous
+one, so that jitter causes head-of-line blocking and reordering has no
+other effect. A lost packet is delivered after an extra retransmission
+timeout (ImpairmentProxy.TCP_RTO).
+
+The proxy records the true transit time of each packet through it,
+readable by the process which created it (get_transits).
+
+The proxy runs in its own process, so that the spin-wait of a client
+does not delay relayed data. See also script polos_impairment_proxy.
+
+>>> proxy = ImpairmentProxy(('localhost', 8888),                  #doctest: +SKIP
+...                         Impairment(delay=1e-3, jitter=2e-4),
+...                         Impairment(delay=3e-3), seed=1)
+>>> proxy.start()                                                 #doctest: +SKIP
+>>> client.connect('localhost', proxy.get_port())                 #doctest: +SKIP
+"""
+import time
+import socket
+import select
+import heapq
+import logging
+from multiprocessing import Process, Event, RawArray, RawValue
+
+import numpy as np
+
+from .server import STS_TRANSPORT_TCP, STS_TRANSPORT_UDP
+
+logger = logging.getLogger('polos')
+
+UPLINK = 0 # client to server
+DOWNLINK = 1 # server to client
+
+# Transit of a packet through the proxy. ts_sent is -1 if it was dropped,
+# or not sent yet. Times are time.time_ns() values.
+TRANSIT_DTYPE = np.dtype([('direction', '<i8'), ('ts_received', '<i8'),
+                          ('ts_sent', '<i8'), ('size', '<i8')])
+
+class Impairment:
+    """
+    Impairment of one direction. Packets are delayed by delay plus a
+    random jitter, in second, of the given distribution:
+        - 'exponential': of mean jitter, like queuing delays
+        - 'uniform': between 0 and jitter
+        - 'normal': of standard deviation jitter (total delay clipped at 0)
+    Packets are lost with probability loss. With probability reorder, a
+    packet is delayed by reorder_delay more (default: delay + 2 * jitter),
+    so that next ones overtake it (UDP only).
+    """
+    DISTRIBUTIONS = ('exponential', 'uniform', 'normal')
+
+    def __init__(self, delay=0., jitter=0., distribution='exponential',
+                 loss=0., reorder=0., reorder_delay=None):
+        assert(delay >= 0 and jitter >= 0)
+        assert(distribution in Impairment.DISTRIBUTIONS)
+        assert(0 <= loss <= 1 and 0 <= reorder <= 1)
+        self.delay = delay
+        self.jitter = jitter
+        self.distribution = distribution
+        self.loss = loss
+        self.reorder = reorder
+        if reorder_delay is None:
+            reorder_delay = delay + 2 * jitter
+        self.reorder_delay = reorder_delay
+
+    def sample(self, rng):
+        """
+        Return the delay of the next packet, in second, None if it is lost.
+        The same number of random values is drawn for all packets, so that
+        the n-th packet gets the same impairment for a given seed.
+        """
+        u_loss, u_jitter, u_reorder = rng.random(3)
+        normal = rng.standard_normal()
+        if u_loss < self.loss:
+            return None
+        if self.distribution == 'exponential':
+            delay = self.delay - self.jitter * np.log1p(-u_jitter)
+        elif self.distribution == 'uniform':
+            delay = self.delay + self.jitter * u_jitter
+        else:
+            delay = max(0., self.delay + self.jitter * normal)
+        if u_reorder < self.reorder:
+            delay += self.reorder_delay
+        return delay
+
+    def __repr__(self):
+        return 'Impairment(delay=%g, jitter=%g, distribution=%r, loss=%g, '\
+               'reorder=%g, reorder_delay=%g)' % \
+               (self.delay, self.jitter, self.distribution, self.loss,
+                self.reorder, self.reorder_delay)
+
+
+class ImpairmentProxy(Process):
+    """
+    Relay between clients and the server at server_address, applying the
+    uplink and downlink impairments (downlink: same as uplink if None),
+    drawn with the given seed. Listens on localhost, on the given port
+    (ephemeral one if 0, see get_port).
+    Over TCP, serves one connection at a time, like the server.
+    Records the transits of the first max_transits packets.
+    """
+    TCP_RTO = 0.2 # second, minimum retransmission timeout of Linux
+    BUFFER_SIZE = 4096
+
+    def __init__(self, server_address, uplink=None, downlink=None, seed=0,
+                 transport=STS_TRANSPORT_TCP, port=0, max_transits=2**16):
+        super().__init__(daemon=True)
+        assert(transport in (STS_TRANSPORT_TCP, STS_TRANSPORT_UDP))
+        self.server_address = server_address
+        if uplink is None:
+            uplink = Impairment()
+        if downlink is None:
+            downlink = uplink
+        self.impairments = (uplink, downlink)
+        self.seed = seed
+        self.transport = transport
+        if transport == STS_TRANSPORT_TCP:
+            self.listening_socket = socket.socket(socket.AF_INET,
+                                                  socket.SOCK_STREAM)
+            self.listening_socket.setsockopt(socket.SOL_SOCKET,
+                                             socket.SO_REUSEADDR, 1)
+            self.listening_socket.bind(('localhost', port))
+            self.listening_socket.listen(1)
+        else:
+            self.listening_socket = socket.socket(socket.AF_INET,
+                                                  socket.SOCK_DGRAM)
+            self.listening_socket.bind(('localhost', port))
+        self.stop_event = Event()
+
+        self.max_transits = max_transits
+        self.transits_buffer = RawArray('b', max_transits * \
+                                        TRANSIT_DTYPE.itemsize)
+        self.nb_transits = RawValue('q', 0)
+
+    def get_port(self):
+        return self.listening_socket.getsockname()[1]
+
+    def stop(self):
+        self.stop_event.set()
+        self.join(timeout=1)
+        self.listening_socket.close()
+
+    def get_transits(self):
+        """ Return a copy of the recorded transits (TRANSIT_DTYPE) """
+        transits = np.frombuffer(self.transits_buffer, dtype=TRANSIT_DTYPE)
+        return transits[:min(self.nb_transits.value,
+                             self.max_transits)].copy()
+
+    def run(self):
+        self.transits = np.frombuffer(self.transits_buffer,
+                                      dtype=TRANSIT_DTYPE)
+        self.rngs = [np.random.default_rng([self.seed, direction]) \
+                     for direction in (UPLINK, DOWNLINK)]
+        # Heap of (due time, order, direction, transit index, send, data,
+        # address)
+        self.pending = []
+        self.nb_packets = 0
+        if self.transport == STS_TRANSPORT_TCP:
+            self.run_tcp()
+        else:
+            self.run_udp()
+        self.listening_socket.close()
+
+    def receive(self, direction, data, send, address=None):
+        """ Record a received packet and plan its sending """
+        ts_received = time.time_ns()
+        itransit = self.nb_transits.value
+        if itransit < self.max_transits:
+            self.transits[itransit] = (direction, ts_received, -1, len(data))
+        self.nb_transits.value = itransit + 1
+
+        delay = self.impairments[direction].sample(self.rngs[direction])
+        if delay is None:
+            if self.transport == STS_TRANSPORT_UDP:
+                return
+            delay = self.impairments[direction].delay + self.TCP_RTO
+        ts_due = ts_received + round(delay * 1e9)
+        if self.transport == STS_TRANSPORT_TCP:
+            # Keep data ordered
+            ts_due = max(ts_due, self.last_due[direction])
+            self.last_due[direction] = ts_due
+        heapq.heappush(self.pending, (ts_due, self.nb_packets, direction,
+                                      itransit, send, data, address))
+        self.nb_packets += 1
+
+    def send_due(self):
+        """
+        Send due packets. Return the time to wait for the next one,
+        in second (None if none).
+        """
+        while self.pending:
+            wait = (self.pending[0][0] - time.time_ns()) / 1e9
+            if wait > 0:
+                return wait
+            _, _, _, itransit, send, data, address = \
+                heapq.heappop(self.pending)
+            if address is None:
+                send(data)
+            else:
+                send(data, address)
+            if itransit < self.max_transits:
+                self.transits['ts_sent'][itransit] = time.time_ns()
+        return None
+
+    def select(self, to_read):
+        timeout = 0.1 # to check the stop event
+        wait = self.send_due()
+        if wait is not None:
+            timeout = min(timeout, wait)
+        return select.select(to_read, [], [], timeout)[0]
+
+    def run_tcp(self):
+        self.listening_socket.settimeout(0.1)
+        while not self.stop_event.is_set():
+            try:
+                client_socket, _ = self.listening_socket.accept()
+            except socket.timeout:
+                continue
+            try:
+                server_socket = socket.create_connection(self.server_address)
+            except OSError as e:
+                logger.error('Impairment proxy cannot connect to %s: %s',
+                             self.server_address, e)
+                client_socket.close()
+                continue
+            for sock in (client_socket, server_socket):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.last_due = [0, 0]
+            try:
+                self.relay_tcp(client_socket, server_socket)
+            finally:
+                client_socket.close()
+                server_socket.close()
+
+    def relay_tcp(self, client_socket, server_socket):
+        routes = {client_socket : (UPLINK, server_socket.sendall),
+                  server_socket : (DOWNLINK, client_socket.sendall)}
+        while not self.stop_event.is_set():
+            for sock in self.select([client_socket, server_socket]):
+                data = sock.recv(self.BUFFER_SIZE)
+                if len(data) == 0:
+                    # Deliver what is left then close both sides
+                    while self.pending:
+                        time.sleep(max(0, self.send_due() or 0))
+                    return
+                direction, send = routes[sock]
+                self.receive(direction, data, send)
+
+    def run_udp(self):
+        # One socket to the server per client, to route replies back
+        upstreams = {} # client address -> socket
+        clients = {} # socket -> client address
+        listening_send = self.listening_socket.sendto
+        while not self.stop_event.is_set():
+            to_read = [self.listening_socket] + list(clients)
+            for sock in self.select(to_read):
+                if sock is self.listening_socket:
+                    data, address = sock.recvfrom(self.BUFFER_SIZE)
+                    upstream = upstreams.get(address)
+                    if upstream is None:
+                        upstream = socket.socket(socket.AF_INET,
+                                                 socket.SOCK_DGRAM)
+                        upstream.connect(self.server_address)
+                        upstreams[address] = upstream
+                        clients[upstream] = address
+                    self.receive(UPLINK, data, upstream.send)
+                else:
+                    try:
+                        data = sock.recv(self.BUFFER_SIZE)
+                    except ConnectionRefusedError:
+                        continue # server not there (yet)
+                    self.receive(DOWNLINK, data, listening_send,
+                                 clients[sock])
+        for upstream in clients:
+            upstream.close()
+
+def get_transit_delays(transits, direction=None):
+    """
+    Return the transit delays of the packets which went through the
+    proxy, in second, for the given direction (both if None).
+    """
+    sent = transits['ts_sent'] >= 0
+    if direction is not None:
+        sent &= transits['direction'] == direction
+    return (transits['ts_sent'][sent] - transits['ts_received'][sent]) / 1e9
@@ -0,0 +1,289 @@
+"""
+Latency metrics in fixed memory, readable from a local endpoint.
+
+A LatencyHistogram counts values in nanoseconds in log-linear buckets, as
+HDR histograms do: each power of two is split into 2**sub_bucket_bits
+buckets, giving a relative precision of 2**-sub_bucket_bits (about 3% by
+default) from 1 ns to 2**max_value_bits ns (about 68 s by default).
+Larger values are counted in the last bucket. Recording is a few integer
+operations, without allocating memory for the histogram.
+Each histogram must be written by one thread only.
+
+Metrics groups histograms, and formats them as text or in the Prometheus
+exposition format. MetricsServer serves them over a Unix socket (address
+given as a path) or TCP (address given as (host, port)):
+    - a request starting with 'GET' (eg a Prometheus scrape) gets an HTTP
+      reply with the Prometheus format
+    - a request 'prometheus' gets the Prometheus format
+    - any other request, or none, gets the text format
+
+>>> metrics = Metrics({'server' : 'STServer'})             #doctest: +SKIP
+>>> histogram = metrics.add_histogram('delay', 'Delay')    #doctest: +SKIP
+>>> histogram.record(1500)                                 #doctest: +SKIP
+>>> MetricsServer(metrics, '/tmp/polos_metrics').start()   #doctest: +SKIP
+$ echo prometheus | nc -U /tmp/polos_metrics
+"""
+import os
+import os.path as op
+import select
+import socket as socket_module
+import logging
+from threading import Thread, Event
+
+import numpy as np
+
+logger = logging.getLogger('polos')
+
+DEFAULT_SUB_BUCKET_BITS = 5
+DEFAULT_MAX_VALUE_BITS = 36
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+PROMETHEUS_MIN_BITS = 10 # first Prometheus bucket bound: 2**10 ns (~1 us)
+METRICS_REQUEST_TIMEOUT = 0.2 # second
+
+class LatencyHistogram:
+    """ Histogram of durations, recorded in ns """
+
+    def __init__(self, name, description,
+                 sub_bucket_bits=DEFAULT_SUB_BUCKET_BITS,
+                 max_value_bits=DEFAULT_MAX_VALUE_BITS):
+        assert(0 < sub_bucket_bits < max_value_bits)
+        self.name = name
+        self.description = description
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.max_value_bits = max_value_bits
+        self.nb_buckets = (max_value_bits - sub_bucket_bits + 1) * \
+                          self.sub_bucket_count
+        # A list is faster to increment than an array
+        self.counts = [0] * self.nb_buckets
+        self.total = 0 # sum of recorded values, in ns
+
+    def get_index(self, value_ns):
+        """ Return the bucket index of the given value, in ns """
+        nb_bits = value_ns.bit_length()
+        if nb_bits <= self.sub_bucket_bits:
+            return value_ns
+        # Keep the sub_bucket_bits + 1 most significant bits
+        shift = nb_bits - self.sub_bucket_bits - 1
+        return min(shift * self.sub_bucket_count + (value_ns >> shift),
+                   self.nb_buckets - 1)
+
+    def get_lower_bound(self, index):
+        """ Return the lowest value of the given bucket, in ns """
+        if index < 2 * self.sub_bucket_count:
+            return index
+        shift = index // self.sub_bucket_count - 1
+        return (index - shift * self.sub_bucket_count) << shift
+
+    def record(self, value_ns):
+        """ Count the given duration, in ns (int). Negative ones count as 0 """
+        if value_ns < 0:
+            value_ns = 0
+        # Same as get_index, inlined
+        nb_bits = value_ns.bit_length()
+        if nb_bits <= self.sub_bucket_bits:
+            index = value_ns
+        else:
+            shift = nb_bits - self.sub_bucket_bits - 1
+            index = shift * self.sub_bucket_count + (value_ns >> shift)
+            if index >= self.nb_buckets:
+                index = self.nb_buckets - 1
+        self.counts[index] += 1
+        self.total += value_ns
+
+    def record_many(self, values):
+        """ Count the given durations, in second """
+        for value in values:
+            self.record(round(value * 1e9))
+
+    def reset(self):
+        self.counts[:] = [0] * self.nb_buckets
+        self.total = 0
+
+    def get_count(self):
+        return sum(self.counts)
+
+    def get_quantiles(self, quantiles=QUANTILES):
+        """
+        Return the values of the given quantiles, in second, as the highest
+        value of the bucket holding them. None if nothing was recorded.
+        """
+        cumulated = np.cumsum(self.counts)
+        if cumulated[-1] == 0:
+            return [None] * len(quantiles)
+        # Rank of the quantile value, from 1
+        ranks = np.maximum(1, np.ceil(np.array(quantiles) * cumulated[-1]))
+        indexes = np.searchsorted(cumulated, ranks)
+        return [(self.get_lower_bound(int(index) + 1) - 1) / 1e9 \
+                for index in indexes]
+
+    def get_max(self):
+        """ Return the highest recorded value, in second, None if none """
+        nonzero = np.flatnonzero(self.counts)
+        if len(nonzero) == 0:
+            return None
+        return (self.get_lower_bound(int(nonzero[-1]) + 1) - 1) / 1e9
+
+    def get_cumulated_counts(self, bounds_ns):
+        """
+        Return the number of values lower than each of the given bounds,
+        which must be bucket lower bounds (eg powers of two), in ns.
+        """
+        cumulated = np.concatenate(([0], np.cumsum(self.counts)))
+        return [int(cumulated[min(self.get_index(bound), self.nb_buckets)]) \
+                for bound in bounds_ns]
+
+
+class Metrics:
+    """
+    Set of latency histograms, with labels common to all of them
+    (eg {'server' : server_name})
+    """
+
+    def __init__(self, labels=None, prefix='polos'):
+        self.labels = labels if labels is not None else {}
+        self.prefix = prefix
+        self.histograms = {}
+
+    def add_histogram(self, name, description, **options):
+        """ Create, store and return a LatencyHistogram """
+        assert(name not in self.histograms)
+        histogram = LatencyHistogram(name, description, **options)
+        self.histograms[name] = histogram
+        return histogram
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def format_text(self):
+        """ Return one line per histogram: count, quantiles and maximum """
+        lines = []
+        labels = ' '.join('%s=%s' % item for item in self.labels.items())
+        for name, histogram in self.histograms.items():
+            values = histogram.get_quantiles() + [histogram.get_max()]
+            fields = ['p%s=%s' % (('%g' % (q * 100)).replace('.', ''),
+                                  format_value(v)) \
+                      for q, v in zip(QUANTILES, values)]
+            fields.append('max=%s' % format_value(values[-1]))
+            lines.append('%s %s count=%d %s' % (name, labels,
+                                                histogram.get_count(),
+                                                ' '.join(fields)))
+        return '\n'.join(lines) + '\n'
+
+    def format_prometheus(self):
+        """
+        Return the histograms in the Prometheus exposition format, with
+        bucket upper bounds at powers of two ns.
+        """
+        lines = []
+        labels = ''.join('%s="%s",' % item for item in self.labels.items())
+        for name, histogram in self.histograms.items():
+            full_name = '%s_%s' % (self.prefix, name)
+            bounds_ns = [1 << nb_bits for nb_bits in \
+                         range(PROMETHEUS_MIN_BITS,
+                               histogram.max_value_bits + 1)]
+            count = histogram.get_count()
+            lines.append('# HELP %s %s' % (full_name, histogram.description))
+            lines.append('# TYPE %s histogram' % full_name)
+            for bound, nb_lower in \
+                zip(bounds_ns, histogram.get_cumulated_counts(bounds_ns)):
+                lines.append('%s_bucket{%sle="%g"} %d' % \
+                             (full_name, labels, bound / 1e9, nb_lower))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (full_name, labels,
+                                                        count))
+            labels_only = '{%s}' % labels.rstrip(',') if labels else ''
+            lines.append('%s_sum%s %.9f' % (full_name, labels_only,
+                                            histogram.total / 1e9))
+            lines.append('%s_count%s %d' % (full_name, labels_only, count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value_sec):
+    return '%.6f' % value_sec if value_sec is not None else 'NA'
+
+def parse_metrics_address(address):
+    """ Return (host, port) from 'HOST:PORT', else the given Unix path """
+    if not address.startswith('/') and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+class MetricsServer(Thread):
+    """ Serve metrics over a Unix or TCP socket, in a background thread """
+
+    def __init__(self, metrics, address):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.address = address
+        if isinstance(address, str):
+            if op.exists(address):
+                os.unlink(address)
+            self.socket = socket_module.socket(socket_module.AF_UNIX,
+                                               socket_module.SOCK_STREAM)
+        else:
+            self.socket = socket_module.socket(socket_module.AF_INET,
+                                               socket_module.SOCK_STREAM)
+            self.socket.setsockopt(socket_module.SOL_SOCKET,
+                                   socket_module.SO_REUSEADDR, True)
+        self.socket.bind(address)
+        self.socket.listen(4)
+        self.finished = Event()
+
+    def run(self):
+        logger.info('Serving metrics on %s', self.address)
+        while not self.finished.is_set():
+            if not select.select([self.socket], [], [],
+                                 METRICS_REQUEST_TIMEOUT)[0]:
+                continue
+            connection, _ = self.socket.accept()
+            try:
+                self.serve(connection)
+            except OSError as e:
+                logger.warning('Cannot serve metrics: %s', e)
+            finally:
+                connection.close()
+        self.socket.close()
+        if isinstance(self.address, str) and op.exists(self.address):
+            os.unlink(self.address)
+
+    def serve(self, connection):
+        connection.settimeout(METRICS_REQUEST_TIMEOUT)
+        try:
+            request = connection.recv(1024)
+        except socket_module.timeout:
+            request = b''
+        if request.startswith(b'GET'):
+            body = self.metrics.format_prometheus().encode()
+            connection.sendall(b'HTTP/1.0 200 OK\r\n'\
+                               b'Content-Type: text/plain; version=0.0.4\r\n'\
+                               b'Content-Length: %d\r\n\r\n' % len(body) + \
+                               body)
+        elif request.strip() == b'prometheus':
+            connection.sendall(self.metrics.format_prometheus().encode())
+        else:
+            connection.sendall(self.metrics.format_text().encode())
+
+    def stop(self, timeout=1.):
+        self.finished.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+def read_metrics(address, metrics_format='text', timeout=1.):
+    """
+    Read the metrics served at the given address, in the given format
+    ('text' or 'prometheus'). Return a str.
+    """
+    family = socket_module.AF_UNIX if isinstance(address, str) \
+             else socket_module.AF_INET
+    with socket_module.socket(family, socket_module.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall(metrics_format.encode() + b'\n')
+        chunks = []
+        chunk = sock.recv(4096)
+        while chunk:
+            chunks.append(chunk)
+            chunk = sock.recv(4096)
+    return b''.join(chunks).decode()
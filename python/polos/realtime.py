@@ -0,0 +1,136 @@
+"""
+Real-time execution profile, to cut the tail latency of triggers.
+
+Applies, as far as permitted:
+    - CPU affinity pinning (os.sched_setaffinity)
+    - SCHED_FIFO scheduling (os.sched_setscheduler), which usually requires
+      root or CAP_SYS_NICE
+    - locking of memory pages (mlockall), so that they are never swapped out
+    - freezing or disabling the garbage collector, so that no collection
+      pauses a trigger
+    - pre-faulting of heap pages, so that later allocations do not page fault
+
+Settings that are not supported or not permitted are skipped with a
+warning. apply_realtime_profile reports what was actually applied.
+
+Note: affinity and scheduling apply to the calling thread on Linux, the
+others to the whole process.
+"""
+import os
+import gc
+import ctypes
+import ctypes.util
+import mmap
+import logging
+
+logger = logging.getLogger('polos')
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+# mallopt parameters from malloc.h
+M_TRIM_THRESHOLD = -1
+M_MMAP_MAX = -4
+
+GC_FREEZE = 'freeze' # collect then move all objects to a permanent generation
+GC_DISABLE = 'disable'
+GC_MODES = (None, GC_FREEZE, GC_DISABLE)
+
+DEFAULT_PRIORITY = 50 # SCHED_FIFO priority, from 1 to 99
+DEFAULT_PREFAULT_SIZE = 2**23 # bytes
+
+def _get_libc():
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        raise OSError('libc not found')
+    return ctypes.CDLL(libc_name, use_errno=True)
+
+def set_affinity(cpus):
+    """ Pin the calling thread to the given CPU indexes. Return the set """
+    os.sched_setaffinity(0, cpus)
+    return os.sched_getaffinity(0)
+
+def set_fifo_priority(priority):
+    """ Use SCHED_FIFO with the given priority for the calling thread """
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    return priority
+
+def lock_memory():
+    """ Lock current and future memory pages of the process in RAM """
+    libc = _get_libc()
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return True
+
+def prefault_heap(size):
+    """
+    Touch size bytes of heap, and keep them in the heap once freed,
+    so that later allocations do not page fault. Return size.
+    """
+    libc = _get_libc()
+    # Keep freed memory in the heap instead of returning it to the system
+    libc.mallopt(M_TRIM_THRESHOLD, -1)
+    libc.mallopt(M_MMAP_MAX, 0)
+    buffer = bytearray(size)
+    buffer[::mmap.PAGESIZE] = b'\x01' * len(range(0, size, mmap.PAGESIZE))
+    del buffer
+    return size
+
+def apply_realtime_profile(cpus=None, priority=DEFAULT_PRIORITY,
+                           lock=True, gc_mode=GC_FREEZE,
+                           prefault_size=DEFAULT_PREFAULT_SIZE):
+    """
+    Apply the real-time profile to the calling thread / process.
+
+    arguments:
+        - cpus (iterable of int): CPUs to pin to. None to keep the current
+          affinity
+        - priority (int): SCHED_FIFO priority. None to keep the current
+          scheduling policy
+        - lock (bool): lock memory pages with mlockall
+        - gc_mode (str): see GC_MODES. None to leave the garbage collector
+          untouched
+        - prefault_size (int): bytes of heap to pre-fault. 0 to skip
+    output:
+        dict mapping each requested setting ('affinity', 'scheduler',
+        'mlockall', 'gc', 'prefault') to the applied value, or None if
+        it could not be applied.
+    """
+    assert(gc_mode in GC_MODES)
+    applied = {}
+
+    def apply(setting, func, *args):
+        try:
+            applied[setting] = func(*args)
+        except (OSError, AttributeError, ValueError) as e:
+            logger.warning('Real-time profile: cannot apply %s: %s',
+                           setting, e)
+            applied[setting] = None
+
+    if cpus is not None:
+        apply('affinity', set_affinity, set(cpus))
+    # Memory first: prefaulted pages are then locked by MCL_CURRENT
+    if prefault_size > 0:
+        apply('prefault', prefault_heap, prefault_size)
+    if lock:
+        apply('mlockall', lock_memory)
+    if gc_mode == GC_FREEZE:
+        gc.collect()
+        gc.freeze()
+        applied['gc'] = GC_FREEZE
+    elif gc_mode == GC_DISABLE:
+        gc.collect()
+        gc.disable()
+        applied['gc'] = GC_DISABLE
+    # Last, so that the setup does not hog a CPU
+    if priority is not None:
+        apply('scheduler', set_fifo_priority, priority)
+
+    logger.info('Real-time profile applied: %s', format_profile(applied))
+    return applied
+
+def format_profile(applied):
+    """ Return a one-line description of what apply_realtime_profile did """
+    return ', '.join('%s=%s' % (setting, value if value is not None \
+                                else 'FAILED')
+                     for setting, value in applied.items())
@@ -0,0 +1,143 @@
+"""
+Same-host self-test of the trigger accuracy of STClient.
+
+run_selftest starts a server and an STClient on the same machine and fires
+a given number of triggers with STClient.request. Both the server callback
+and the local callback write CLOCK_MONOTONIC in shared memory
+(StampCallback), which gives the true skew between them:
+    skew = local callback time - remote callback time
+It is reported next to what the client knows:
+    - the estimated one-way delay returned by STClient.request
+    - STClient.trigger_delay_error, the estimated minus the actual delay of
+      the trigger request, which is the skew as seen by the client
+    - the residual skew - trigger_delay_error, ie the error on this estimate
+
+Network impairments can be simulated by an ImpairmentProxy between the
+client and the server (see polos.impairment), eg to measure how accuracy
+degrades when jitter or asymmetry grow.
+
+See also script polos_trigger_selftest.
+
+Note: the server runs in another process, so that the spin-wait of the
+client does not delay it. Both sides run the same callback, so that its
+own overhead cancels out in the skew.
+"""
+import time
+import logging
+from multiprocessing import RawArray
+
+import numpy as np
+
+from .server import STServerProcess, STClient, STS_WIRE_V1
+from .impairment import ImpairmentProxy, Impairment
+
+logger = logging.getLogger('polos')
+
+STARTUP_TIME = 0.2 # second, to let the server bind its port
+
+class StampCallback:
+    """
+    Callback writing CLOCK_MONOTONIC, in ns, in the next slot of an array
+    in shared memory, readable from the process which created it.
+    Stamps beyond size are dropped.
+    """
+    def __init__(self, size):
+        self.size = size
+        # First item is the number of stamps
+        self.stamps = RawArray('q', size + 1)
+
+    def __call__(self):
+        ts = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+        stamps = self.stamps
+        nb_stamps = stamps[0]
+        if nb_stamps < self.size:
+            stamps[nb_stamps + 1] = ts
+            stamps[0] = nb_stamps + 1
+
+    def reset(self):
+        self.stamps[0] = 0
+
+    def get_stamps(self):
+        """ Return a copy of the stamps, in ns """
+        stamps = np.frombuffer(self.stamps, dtype=np.int64)
+        return stamps[1:stamps[0] + 1].copy()
+
+
+def run_selftest(nb_triggers=1000, port=8991, delay=0., nb_trials=None,
+                 uplink=None, downlink=None, seed=0, warm=False):
+    """
+    Fire nb_triggers triggers with STClient.request, through an
+    ImpairmentProxy if delay (in second) is not 0 or if impairments are
+    given (see ImpairmentProxy; delay is a shortcut for a fixed delay in
+    both directions). nb_trials is given to STClient.request.
+    If warm is True, the client is kept warm (see STClient.keep_warm), so
+    that triggers are sent without probes by default.
+    Return a dict of arrays, in second:
+        'skew', 'trigger_delay_error', 'estimated_delay', 'delay_std'
+    """
+    server_stamps = StampCallback(nb_triggers)
+    client_stamps = StampCallback(nb_triggers)
+    server = STServerProcess(port=port, callback1=server_stamps,
+                             receive_timeout=0.5)
+    server.start()
+    time.sleep(STARTUP_TIME)
+    if uplink is None and delay > 0:
+        uplink = Impairment(delay=delay)
+    proxy = None
+    if uplink is not None or downlink is not None:
+        proxy = ImpairmentProxy(('localhost', port), uplink, downlink, seed)
+        proxy.start()
+        port = proxy.get_port()
+
+    trigger_delay_errors = np.zeros(nb_triggers)
+    estimated_delays = np.zeros(nb_triggers)
+    delay_stds = np.zeros(nb_triggers)
+    client = STClient(client_stamps, wire_format=STS_WIRE_V1)
+    try:
+        client.connect('localhost', port)
+        if warm:
+            client.keep_warm()
+        for itrigger in range(nb_triggers):
+            estimated_delays[itrigger], delay_stds[itrigger] = \
+                client.request(nb_trials)
+            trigger_delay_errors[itrigger] = client.trigger_delay_error
+        client.shutdown_server()
+    finally:
+        client.close()
+        server.join(timeout=1)
+        if proxy is not None:
+            proxy.stop()
+
+    skews = (client_stamps.get_stamps() - server_stamps.get_stamps()) / 1e9
+    return {'skew' : skews,
+            'trigger_delay_error' : trigger_delay_errors,
+            'estimated_delay' : estimated_delays,
+            'delay_std' : delay_stds}
+
+def summarize(results):
+    """
+    Return statistics of the arrays given by run_selftest:
+    {name : {'mean', 'std', 'p1', 'p50', 'p99', 'abs_p99', 'abs_max'}}
+    plus 'residual' = skew - trigger_delay_error.
+    """
+    results = dict(results)
+    results['residual'] = results['skew'] - results['trigger_delay_error']
+    summary = {}
+    for name, values in results.items():
+        p1, p50, p99 = np.percentile(values, [1, 50, 99])
+        summary[name] = {'mean' : values.mean(), 'std' : values.std(),
+                         'p1' : p1, 'p50' : p50, 'p99' : p99,
+                         'abs_p99' : np.percentile(np.abs(values), 99),
+                         'abs_max' : np.abs(values).max()}
+    return summary
+
+def format_summary(summary):
+    """ Return a table of the statistics given by summarize, in us """
+    stats = ('mean', 'std', 'p1', 'p50', 'p99', 'abs_p99', 'abs_max')
+    lines = ['%-20s' % 'us' + ''.join('%10s' % stat for stat in stats)]
+    for name in ('skew', 'trigger_delay_error', 'residual',
+                 'estimated_delay', 'delay_std'):
+        lines.append('%-20s' % name + \
+                     ''.join('%10.1f' % (summary[name][stat] * 1e6) \
+                             for stat in stats))
+    return '\n'.join(lines)
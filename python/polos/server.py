@@ -1,16 +1,33 @@
-import os.path as op
 import time
 import timeit
-from threading import Thread
+from threading import Thread, Lock, Event
+from queue import SimpleQueue
+from collections import deque
 from multiprocessing import Process
 import socket as socket_module
 import select
+import heapq
+import struct
 import logging
-from glob import glob
 
 import numpy as np
 
 from ._polos import STATUS_OK, STATUS_ERROR, STATUS_WARNING
+from .timestamping import enable_rx_timestamps, enable_tx_timestamps
+from .timestamping import recv_timestamped, recv_into_timestamped
+from .timestamping import get_tx_timestamps
+from .estimators import get_estimator
+from .realtime import apply_realtime_profile
+from .eventlog import EVENT_CONNECT, EVENT_DISCONNECT
+from .eventlog import EVENT_RECEIVE, EVENT_REQUEST, EVENT_CALLBACK_END
+from .eventlog import EVENT_REPLY, EVENT_SCHEDULE, EVENT_FIRE
+from .eventlog import EVENT_SEND, EVENT_REPLY_RECEIVED
+from .eventlog import EVENT_LOCAL_TRIGGER, EVENT_RECONNECT
+from .metrics import Metrics, MetricsServer
+from .tracing import STAGE_SELECT, STAGE_RECV, STAGE_CALLBACK, STAGE_SEND
+from .tracing import STAGE_SPIN, STAGE_CLIENT_SEND, STAGE_CLIENT_RECV
+from .tracing import STAGE_CLIENT_SPIN, STAGE_LOCAL_CALLBACK
+from .timestamplog import TimestampLog, get_log_filename
 
 logger = logging.getLogger('polos')
 
@@ -23,6 +40,44 @@ STS_CONNECTION_TIMEOUT = 1
 STS_CALLBACK_1 = b'0'
 STS_CALLBACK_2 = b'1'
 STS_QUIT = b'2'
+# Binary only: run a callback at a given server time (see sync_trigger_server)
+STS_SCHEDULE = b'3'
+STS_TRIGGER_REPORT = b'4' # reply only
+# Binary only: reply at once, without running any callback (see STClient.probe)
+STS_PROBE = b'5'
+
+# Binary only: STS_CALLBACK_1 requests, and the scheduling of them, fire the
+# callback of the channel given in the request, channel 0 being callback1
+# (see sync_trigger_server)
+STS_NB_CHANNELS = 256
+
+## STS binary wire format ##
+# Binary requests and replies start with the format version byte, which
+# cannot be mistaken for a legacy text command. Their command byte is the
+# one of the legacy format (eg STS_CALLBACK_1[0]).
+# Timestamps are time.time_ns() values.
+STS_WIRE_TEXT = 0
+STS_WIRE_V1 = 1
+STS_WIRE_V1_BYTE = bytes([STS_WIRE_V1])
+# version, command, target command (0 if unused), channel (0 by default),
+# sequence number, command argument (0 if unused).
+# The channel byte was padding before channels, hence 0 for older clients.
+STS_REQUEST_V1 = struct.Struct('!BBBBIq')
+# version, command, status, sequence number,
+# receive, callback and transmit timestamps
+STS_REPLY_V1 = struct.Struct('!BBBxIqqq')
+STS_REPLY_OK = 0
+STS_REPLY_LATE = 1 # scheduled time already passed, fired as soon as possible
+STS_REPLY_DEFERRED = 2 # callback handed to the worker, report to follow
+STS_REPLY_ERROR = 0x80 # and above
+
+# Scheduled triggers are waited for by select until STS_SPIN_TIME before
+# their time, then by a busy loop, which is more precise than a sleep
+STS_SPIN_TIME = 2e-3 # second
+
+STS_TRANSPORT_TCP = 'tcp'
+STS_TRANSPORT_UDP = 'udp'
+STS_UDP_TIMEOUT = 0.2 # second, after which a probe datagram is deemed lost
 
 STS_DEFAULT_NAME = 'STServer'
 
@@ -36,27 +91,113 @@ class NoStatus:
     
     def get_status():
         return None, ''
+
+class STSTimeoutError(Exception): pass
     
-class TimestampSaver:
-    def __init__(self, tmp_dir, fn_prefix):
-        self.fn_prefix = op.join(tmp_dir, fn_prefix)
+class TimestampSaver(TimestampLog):
+    """
+    Trigger callback appending time.time_ns() to the timestamp log
+    <tmp_dir>/<fn_prefix>.tslog (see polos.timestamplog), or
+    <tmp_dir>/<fn_prefix>.w<worker>.tslog for the given worker process.
+    """
+    def __init__(self, tmp_dir, fn_prefix, worker=None):
+        super().__init__(get_log_filename(tmp_dir, fn_prefix, worker))
+        self.tmp_dir = tmp_dir
+        self.fn_prefix = fn_prefix
 
-    def __call__(self):
-        ts = time.time()
-        open(self.fn_prefix + '_' + str(ts), 'a').close()
+    def for_worker(self, iworker):
+        """
+        Return the saver of the given worker process, with its own log,
+        a log having a single writer (see STServerSupervisor)
+        """
+        return TimestampSaver(self.tmp_dir, self.fn_prefix, iworker)
 
     def get_ts(self):
-        ts_fn = glob(self.fn_prefix + '_' + '*')[0]
-        return TimestampSaver.get_ts_from_filename(ts_fn)
-
-    @staticmethod
-    def get_ts_from_filename(ts_fn):
-        return float(op.split(ts_fn)[1].split('_')[1])    
+        """ Return the last timestamp, in second, None if none """
+        ts = self.get_last()
+        return ts / 1e9 if ts is not None else None
     
 def sync_trigger_server(port=STS_DEFAULT_PORT, callback1=None,
                         callback2=None, server_name=STS_DEFAULT_NAME,
-                        receive_timeout=None, status_handler=None):
+                        receive_timeout=None, status_handler=None,
+                        udp=False, kernel_timestamps=False,
+                        async_callbacks=False, realtime=None,
+                        reuse_port=False, event_logger=None,
+                        metrics_address=None, tracer=None, channels=None,
+                        admin=None):
     """
+    Serve synchronized trigger requests on the given port.
+
+    A TCP listener accepts one connection at a time. If udp is True,
+    a UDP socket is also bound to the same port to answer datagram probes
+    (see ST_NTPClient with transport=STS_TRANSPORT_UDP). Each datagram
+    holds one request.
+
+    Requests are either legacy text ones (a single command byte, followed 
+    by a sequence number over UDP) or binary ones (STS_REQUEST_V1, starting
+    with the version byte). The reply uses the same format as the request,
+    so that older clients keep working. Several requests read at once are
+    run one after the other, in both formats.
+
+    channels is a dict mapping channel numbers (0 to STS_NB_CHANNELS - 1)
+    to callbacks, eg one per GPIO line, so that a single server, with a 
+    single clock calibration, fires different triggers. Binary 
+    STS_CALLBACK_1 requests fire the callback of their channel, callback1
+    being the one of channel 0 (the only one of text requests). A request
+    for a channel without callback gets a STS_REPLY_ERROR reply.
+
+    Binary STS_PROBE requests are replied to at once, without running any
+    callback, even if async_callbacks is True. The callback timestamp of 
+    their reply is the receive one.
+
+    If async_callbacks is True, callbacks do not delay replies: they are
+    handed to a worker thread, spawned at startup, and the reply is sent
+    at once with status STS_REPLY_DEFERRED. For binary requests, a 
+    STS_TRIGGER_REPORT reply with the same sequence number follows when 
+    the callback has run, giving the receive time and the callback start 
+    and end times. Scheduled triggers are busy-waited by the worker.
+    Callbacks run one after the other, in request order.
+
+    If realtime is True, or a dict of options of apply_realtime_profile,
+    the real-time profile is applied once sockets are set up (see 
+    polos.realtime).
+    The callback worker inherits its CPU affinity and scheduling policy.
+
+    If reuse_port is True, sockets are bound with SO_REUSEPORT, so that
+    several server processes can share the port, the kernel distributing
+    connections and datagrams among them (see polos.supervisor).
+
+    If kernel_timestamps is True, the receive timestamp is the one given by
+    the kernel when the request arrived (Linux, see polos.timestamping),
+    instead of the time when select returned. Falls back to the latter
+    if unsupported.
+
+    If event_logger is given (see polos.eventlog), connections, requests,
+    callbacks and replies of the main loop are recorded in it, and it is
+    dumped to its file, if any, when the server stops.
+
+    If metrics_address is given, as a Unix socket path or (host, port),
+    latency histograms of binary and text requests are recorded and served
+    there (see polos.metrics): time from request reception to reply,
+    callback duration, and lateness of scheduled triggers.
+
+    status_handler gets status updates with set_status(status, message).
+    If it also has count_connection() and count_request(ts_receive)
+    methods, they are called for each accepted connection and request,
+    eg to publish counters to other processes (see polos.statusboard).
+    Its reset_counters() method, if any, is called on admin reset_stats.
+
+    If tracer is given (see polos.tracing), the main loop records the
+    stages of binary and text requests in it: select wake-up, recv,
+    dispatch, callback (unless async_callbacks) and reply sending, and the
+    busy-wait of scheduled triggers. It is dumped to its file, if any,
+    when the server stops.
+
+    If admin is given (see polos.admin), the server also waits for
+    commands on this control channel: stop, replace a callback, reset
+    latency histograms and counters, dump latency histograms. They are
+    run at once, even while waiting for a connection.
+
     TODO: add finished callback?
     """
     
@@ -68,6 +209,11 @@ def sync_trigger_server(port=STS_DEFAULT_PORT, callback1=None,
             assert(callable(cb))
             return cb
 
+    if channels is None:
+        channels = {}
+    if 0 in channels:
+        assert(callback1 is None)
+        callback1 = channels[0]
     callback1 = init_callback(callback1)
     callback2 = init_callback(callback2)
 
@@ -75,8 +221,10 @@ def sync_trigger_server(port=STS_DEFAULT_PORT, callback1=None,
         status_handler = NoStatus()
         
     status_handler.set_status(STATUS_ERROR, 'Idle')
+    count_connection = getattr(status_handler, 'count_connection', None)
+    count_request = getattr(status_handler, 'count_request', None)
 
-    # Evaluate reply encoding overhead
+    # Evaluate reply encoding overhead of legacy text replies
     nb_trials = 10000
     code = '(str(ts)+" "+str(ts)+" "+str(ts)).encode()'
     ts_encode_time = timeit.timeit(code, setup='ts=time.time()',
@@ -87,32 +235,441 @@ def sync_trigger_server(port=STS_DEFAULT_PORT, callback1=None,
     socket = socket_module.socket(socket_module.AF_INET,
                                   socket_module.SOCK_STREAM)
     socket.setsockopt(socket_module.SOL_SOCKET, socket_module.SO_REUSEADDR, True)
+    if reuse_port:
+        socket.setsockopt(socket_module.SOL_SOCKET,
+                          socket_module.SO_REUSEPORT, True)
     socket.bind(('', port))
     socket.listen(1)
 
+    if udp:
+        udp_socket = socket_module.socket(socket_module.AF_INET,
+                                          socket_module.SOCK_DGRAM)
+        udp_socket.setsockopt(socket_module.SOL_SOCKET,
+                              socket_module.SO_REUSEADDR, True)
+        if reuse_port:
+            udp_socket.setsockopt(socket_module.SOL_SOCKET,
+                                  socket_module.SO_REUSEPORT, True)
+        udp_socket.bind(('', port))
+        udp_socket.setblocking(False)
+        if kernel_timestamps:
+            kernel_timestamps = enable_rx_timestamps(udp_socket)
+        logger.info('%s serving UDP probes on %s', server_name, udp_socket)
+    else:
+        udp_socket = None
+
+    if realtime is True:
+        apply_realtime_profile()
+    elif isinstance(realtime, dict):
+        apply_realtime_profile(**realtime)
+
     status_handler.set_status(STATUS_WARNING, 'Waiting connection...')
     logger.info('%s waiting connection on %s', server_name, socket)
-    
+
+    # Preallocated dispatch table, to get the same call delay for all 
+    # callbacks: dispatch[command byte][channel] is the callback, None if 
+    # there is none. Rows of commands without channels repeat their
+    # callback.
+    channel_table = [None] * STS_NB_CHANNELS
+    channel_table[0] = callback1
+    for channel, callback in channels.items():
+        assert(0 <= channel < STS_NB_CHANNELS)
+        channel_table[channel] = init_callback(callback)
+    no_callbacks = [None] * STS_NB_CHANNELS
+    dispatch = [no_callbacks] * 256
+    dispatch[STS_CALLBACK_1[0]] = channel_table
+    dispatch[STS_CALLBACK_2[0]] = [callback2] * STS_NB_CHANNELS
+    if channels:
+        logger.info('%s serving channels %s', server_name,
+                    sorted(set(channels) | {0}))
+
+    # Preallocated buffers, so that binary requests do not allocate memory.
+    # request_views[n] receives after the n bytes of a split request.
+    request_buffer = bytearray(STS_BUFFER_SIZE)
+    request_views = [memoryview(request_buffer)[n:] \
+                     for n in range(STS_REQUEST_V1.size)]
+    reply_buffer = bytearray(STS_REPLY_V1.size)
+    report_buffer = bytearray(STS_REPLY_V1.size) # used by callback worker
+
+    # Replies are sent by the main loop and reports by the callback worker
+    send_lock = Lock()
+
+    # Only the main loop records events, the logger taking no lock
+    log_event = event_logger.log if event_logger is not None else None
+
+    # Latency histograms. The callback ones are written by the callback
+    # worker in async mode, by the main loop otherwise.
+    if metrics_address is not None:
+        metrics = Metrics({'server' : server_name})
+        record_reply = metrics.add_histogram('sts_request_to_reply_seconds',
+                                             'Time from request reception '\
+                                             'to reply').record
+        record_callback = metrics.add_histogram('sts_callback_seconds',
+                                                'Callback duration').record
+        record_lateness = metrics.add_histogram('sts_trigger_lateness_seconds',
+                                                'Delay of scheduled '\
+                                                'triggers after their '\
+                                                'time').record
+        metrics_server = MetricsServer(metrics, metrics_address)
+        metrics_server.start()
+    else:
+        metrics = None
+
+    def send_reply(buffer, send, address, command, status, seq,
+                   ts_1, ts_2, ts_3):
+        """
+        Pack a binary reply in the given buffer and send it, to address if
+        not None (UDP).
+        """
+        STS_REPLY_V1.pack_into(buffer, 0, STS_WIRE_V1, command, status, seq,
+                               ts_1, ts_2, ts_3)
+        send_lock.acquire()
+        try:
+            if address is None:
+                send(buffer)
+            else:
+                send(buffer, address)
+        finally:
+            send_lock.release()
+
+    def send_report(buffer, send, address, status, seq, ts_reference,
+                    ts_start, ts_end):
+        try:
+            send_reply(buffer, send, address, STS_TRIGGER_REPORT[0], status,
+                       seq, ts_reference, ts_start, ts_end)
+        except OSError as e:
+            # Requester gone: the trigger still happened
+            logger.warning('%s could not report trigger %d: %s',
+                           server_name, seq, e)
+
+    def run_callbacks(callbacks):
+        """
+        Callback worker: run the callbacks of the queue, after busy-waiting 
+        for their due time, and report their start and end times
+        (if a send function is given). Stops on None.
+        """
+        for item in iter(callbacks.get, None):
+            callback, ts_due, seq, ts_reference, status, send, address = item
+            while time.time_ns() < ts_due:
+                continue
+            ts_start = time.time_ns()
+            callback()
+            ts_end = time.time_ns()
+            if send is not None:
+                send_report(report_buffer, send, address, status, seq,
+                            ts_reference, ts_start, ts_end)
+            if metrics is not None:
+                record_callback(ts_end - ts_start)
+                if ts_due > 0: # scheduled
+                    record_lateness(ts_start - ts_due)
+
+    if async_callbacks:
+        callbacks = SimpleQueue()
+        worker = Thread(target=run_callbacks, args=(callbacks,), daemon=True)
+        worker.start()
+        # Text requests: hand off callbacks, without report
+        def defer(callback):
+            return lambda: callbacks.put((callback, 0, 0, 0, 0, None, None))
+        text_actions = [None if row[0] is None else defer(row[0]) \
+                        for row in dispatch]
+    else:
+        # Text requests are on channel 0
+        text_actions = [row[0] for row in dispatch]
+
+    # Scheduled triggers: heap of (server time in ns, sequence number,
+    # target command, channel, reply status, send function, address)
+    scheduled = []
+
+    def run_binary_requests(nb_bytes, ts_receive, send, address):
+        """
+        Execute all complete binary requests in the first nb_bytes of
+        request_buffer and send their replies.
+        Return the number of bytes processed and the command byte that 
+        stopped processing (None if all went fine, -1 for an unsupported
+        version).
+        """
+        offset = 0
+        while offset + STS_REQUEST_V1.size <= nb_bytes:
+            if tracer is not None:
+                ts_trace = time.perf_counter_ns()
+            version, command, target, channel, seq, arg = \
+                STS_REQUEST_V1.unpack_from(request_buffer, offset)
+            offset += STS_REQUEST_V1.size
+            if version != STS_WIRE_V1:
+                return offset, -1
+            if log_event is not None:
+                log_event(EVENT_REQUEST, seq, ts_receive)
+            if count_request is not None:
+                count_request(ts_receive)
+            if command == STS_SCHEDULE[0]:
+                # Acknowledge now, report when fired (see fire_scheduled)
+                if dispatch[target][channel] is None:
+                    status = STS_REPLY_ERROR
+                else:
+                    status = STS_REPLY_OK if arg > ts_receive \
+                             else STS_REPLY_LATE
+                    heapq.heappush(scheduled, (arg, seq, target, channel,
+                                               status, send, address))
+                send_reply(reply_buffer, send, address, command, status, seq,
+                           ts_receive, 0, time.time_ns())
+                if log_event is not None:
+                    log_event(EVENT_SCHEDULE, seq)
+                ts_receive = time.time_ns()
+                continue
+            if command == STS_PROBE[0]:
+                # Not deferred: no callback
+                send_reply(reply_buffer, send, address, command,
+                           STS_REPLY_OK, seq, ts_receive, ts_receive,
+                           time.time_ns())
+                if log_event is not None:
+                    log_event(EVENT_REPLY, seq)
+                ts_receive = time.time_ns()
+                continue
+            callback = dispatch[command][channel]
+            if callback is None:
+                if dispatch[command] is no_callbacks:
+                    return offset, command
+                # Known command, channel without callback
+                send_reply(reply_buffer, send, address, command,
+                           STS_REPLY_ERROR, seq, ts_receive, 0,
+                           time.time_ns())
+                ts_receive = time.time_ns()
+                continue
+            if async_callbacks:
+                callbacks.put((callback, 0, seq, ts_receive, STS_REPLY_OK,
+                               send, address))
+                status = STS_REPLY_DEFERRED
+                if tracer is not None:
+                    ts_dispatched = ts_called = time.perf_counter_ns()
+            else:
+                if tracer is not None:
+                    ts_dispatched = time.perf_counter_ns()
+                ts_start = time.time_ns()
+                callback()
+                status = STS_REPLY_OK
+                if tracer is not None:
+                    ts_called = time.perf_counter_ns()
+            ts_callback = time.time_ns()
+            send_reply(reply_buffer, send, address, command, status, seq,
+                       ts_receive, ts_callback, time.time_ns())
+            if tracer is not None:
+                tracer.trace_request(seq, ts_trace, ts_dispatched, ts_called,
+                                     time.perf_counter_ns())
+            if log_event is not None:
+                log_event(EVENT_CALLBACK_END, seq, ts_callback)
+                log_event(EVENT_REPLY, seq)
+            if metrics is not None:
+                record_reply(time.time_ns() - ts_receive)
+                if not async_callbacks:
+                    record_callback(ts_callback - ts_start)
+            ts_receive = time.time_ns()
+        return offset, None
+
+    def fire_scheduled():
+        """
+        Run the scheduled triggers due within STS_SPIN_TIME, busy-waiting
+        for their exact time, and report the actual firing times.
+        Return the time to wait for the next one, in second (None if none).
+        """
+        while scheduled:
+            ts_scheduled = scheduled[0][0]
+            wait = (ts_scheduled - time.time_ns()) / 1e9 - STS_SPIN_TIME
+            if wait > 0:
+                return wait
+            ts_scheduled, seq, target, channel, status, send, address = \
+                heapq.heappop(scheduled)
+            callback = dispatch[target][channel]
+            if async_callbacks:
+                callbacks.put((callback, ts_scheduled, seq,
+                               ts_scheduled, status, send, address))
+                continue
+            if tracer is not None:
+                ts_trace = time.perf_counter_ns()
+            while time.time_ns() < ts_scheduled:
+                continue
+            ts_start = time.time_ns()
+            if tracer is not None:
+                ts_spun = time.perf_counter_ns()
+            callback()
+            ts_end = time.time_ns()
+            if tracer is not None:
+                ts_called = time.perf_counter_ns()
+            send_report(reply_buffer, send, address, status, seq,
+                        ts_scheduled, ts_start, ts_end)
+            if tracer is not None:
+                tracer.trace(STAGE_SPIN, ts_trace, ts_spun, seq)
+                tracer.trace(STAGE_CALLBACK, ts_spun, ts_called, seq)
+                tracer.trace(STAGE_SEND, ts_called, time.perf_counter_ns(),
+                             seq)
+            if log_event is not None:
+                log_event(EVENT_FIRE, seq, ts_start)
+            if metrics is not None:
+                record_callback(ts_end - ts_start)
+                record_lateness(ts_start - ts_scheduled)
+            logger.debug('%s scheduled trigger %d fired %s late', server_name,
+                         seq, format_duration((ts_start - ts_scheduled) / 1e9))
+        return None
+
+    ## Admin commands, run by the main loop (see polos.admin)
+    def admin_stop():
+        nonlocal finished
+        finished = True
+
+    def admin_set_callback(command, channel, callback):
+        row = dispatch[command[0]]
+        if row is no_callbacks:
+            raise ValueError('No callback for command %s' % command)
+        assert(0 <= channel < STS_NB_CHANNELS)
+        if command == STS_CALLBACK_2:
+            row[:] = [init_callback(callback)] * STS_NB_CHANNELS
+        elif channel == 0 or callback is not None:
+            row[channel] = init_callback(callback)
+        else:
+            row[channel] = None
+        if async_callbacks:
+            text_actions[command[0]] = defer(row[0])
+        else:
+            text_actions[command[0]] = row[0]
+        logger.info('%s callback of channel %d of command %s replaced',
+                    server_name, channel, command)
+
+    def admin_reset_stats():
+        if metrics is not None:
+            metrics.reset()
+        reset_counters = getattr(status_handler, 'reset_counters', None)
+        if reset_counters is not None:
+            reset_counters()
+
+    def admin_dump_metrics(metrics_format='text'):
+        if metrics is None:
+            raise ValueError('Metrics not recorded (see metrics_address)')
+        if metrics_format == 'prometheus':
+            return metrics.format_prometheus()
+        return metrics.format_text()
+
+    admin_handlers = {'stop' : admin_stop,
+                      'set_callback' : admin_set_callback,
+                      'reset_stats' : admin_reset_stats,
+                      'dump_metrics' : admin_dump_metrics}
+
     ## Main loop
     finished = False
-    while not finished and socket is not None:
-        socket.settimeout(STS_CONNECTION_TIMEOUT)
-        try:
-            connection, conn_address = socket.accept() #wait
+    connection = None
+    nb_pending = 0 # bytes of a binary request split over several recv
+    listening = [socket]
+    if udp_socket is not None:
+        listening.append(udp_socket)
+        udp_send = udp_socket.sendto
+    if admin is not None:
+        admin.attach()
+        listening.append(admin)
+    while not finished:
+        # Wait for a new connection or for requests on the current one.
+        # Will come back here if nothing needed to be done, to check
+        # if something else should be done instead, like terminating
+        # the server.
+        if connection is None:
+            to_read = listening
+            timeout = STS_CONNECTION_TIMEOUT
+        else:
+            to_read = connected
+            timeout = receive_timeout
+        wait = fire_scheduled()
+        if wait is not None and (timeout is None or wait < timeout):
+            timeout = wait
+
+        if tracer is not None:
+            ts_trace = time.perf_counter_ns()
+        ready = select.select(to_read, [], [], timeout)[0]
+        ts_receive = time.time_ns()
+        if tracer is not None:
+            tracer.trace(STAGE_SELECT, ts_trace, time.perf_counter_ns())
+        if not ready:
+            if connection is None and wait is None:
+                logger.debug('%s connection timeout', server_name)
+            continue
+
+        if admin is not None and admin in ready:
+            ready.remove(admin)
+            if not admin.serve(admin_handlers):
+                logger.info('%s admin channel closed', server_name)
+                listening.remove(admin)
+                if connection is not None:
+                    connected.remove(admin)
+                admin = None
+            if finished or not ready:
+                continue
+            ts_receive = time.time_ns()
+
+        if udp_socket is not None and udp_socket in ready:
+            if tracer is not None:
+                ts_trace = time.perf_counter_ns()
+            if kernel_timestamps:
+                nb_bytes, address, ts_kernel = \
+                    recv_into_timestamped(udp_socket, request_buffer)
+                if ts_kernel is not None:
+                    ts_receive = ts_kernel
+            else:
+                nb_bytes, address = udp_socket.recvfrom_into(request_buffer)
+            if tracer is not None:
+                tracer.trace(STAGE_RECV, ts_trace, time.perf_counter_ns(),
+                             nb_bytes)
+            if log_event is not None:
+                log_event(EVENT_RECEIVE, nb_bytes, ts_receive)
+            if nb_bytes > 0 and request_buffer[0] == STS_WIRE_V1:
+                _, command = run_binary_requests(nb_bytes, ts_receive,
+                                                 udp_send, address)
+            else:
+                # Legacy datagram: command byte + sequence number
+                if tracer is not None:
+                    ts_trace = time.perf_counter_ns()
+                command = request_buffer[0] if nb_bytes > 0 else None
+                if count_request is not None:
+                    count_request(ts_receive)
+                action = text_actions[command] if nb_bytes > 0 else None
+                if action is not None:
+                    if tracer is not None:
+                        ts_dispatched = time.perf_counter_ns()
+                    ts_start = time.time_ns()
+                    action()
+                    ts_callback = time.time_ns()
+                    if tracer is not None:
+                        ts_called = time.perf_counter_ns()
+                        if async_callbacks: # deferred, no callback span
+                            ts_dispatched = ts_called
+                    ts_transmit = time.time() + ts_encode_time
+                    with send_lock:
+                        udp_socket.sendto(request_buffer[1:nb_bytes] + \
+                                          (' ' + str(ts_receive / 1e9) + \
+                                           ' ' + str(ts_callback / 1e9) + \
+                                           ' ' + str(ts_transmit)).encode(),
+                                          address)
+                    if tracer is not None:
+                        tracer.trace_request(0, ts_trace, ts_dispatched,
+                                             ts_called,
+                                             time.perf_counter_ns())
+                    if log_event is not None:
+                        log_event(EVENT_CALLBACK_END, 0, ts_callback)
+                        log_event(EVENT_REPLY, 0)
+                    if metrics is not None:
+                        record_reply(time.time_ns() - ts_receive)
+                        if not async_callbacks:
+                            record_callback(ts_callback - ts_start)
+                    command = None
+            if command == STS_QUIT[0]:
+                finished = True
+            elif command is not None or nb_bytes == 0:
+                # Do not let a stray datagram shut the server down
+                logger.warning('%s dropping bad UDP request from %s: %s',
+                               server_name, address,
+                               bytes(request_buffer[:nb_bytes]))
+            if finished or len(ready) == 1:
+                continue
+            ts_receive = time.time_ns()
+
+        if connection is None:
+            connection, conn_address = socket.accept()
             status_handler.set_status(STATUS_WARNING,
                                       'Connecting to %s' % str(conn_address))
-            
-            # listen for some time then check if something else should
-            # be done instead, like terminating the server.
-            # Will come back here if nothing needed to be done.
-        except socket_module.timeout:
-            logger.debug('%s connection timeout', server_name)
-            connection = None
-
-        # Use a dict to get the same call delay for all callbacks
-        actions = {STS_CALLBACK_1 : callback1,
-                   STS_CALLBACK_2  : callback2}
-        if connection is not None:
             logger.info('%s waiting for request from %s',
                         server_name, conn_address)
             logger.info('%s waiting for request using %s',
@@ -120,54 +677,148 @@ def sync_trigger_server(port=STS_DEFAULT_PORT, callback1=None,
             
             status_handler.set_status(STATUS_OK,
                                       'Connected to %s' % str(conn_address))
-
             connection.setblocking(False)
-            while not finished and socket is not None:
-                ready = select.select([connection], [], [], receive_timeout)
-                ts_receive = time.time()
-                if ready[0]:
-                    data = connection.recv(STS_BUFFER_SIZE) #wait
-                    # There is still the overhead of "dict.get" here:
-                    action_result = actions.get(data, lambda: 1)()
-                    ts_callback = time.time()
-                    if action_result == 1:
-                        if not data:
-                            break
-                        elif data == STS_QUIT:
-                            finished = True
-                            break
-                        else:
-                            finished = True
-                            msg = 'Shutting down because of bad request: %s' % \
-                                  data
-                            status_handler.set_status(STATUS_ERROR, msg)
-                            logger.error('%s %s', server_name, msg)
-                            break
-                    ts_transmit = time.time() + ts_encode_time
-                    connection.sendall((str(ts_receive) + ' ' + \
-                                        str(ts_callback) + ' ' + \
+            connection.setsockopt(socket_module.IPPROTO_TCP,
+                                  socket_module.TCP_NODELAY, True)
+            if kernel_timestamps:
+                kernel_timestamps = enable_rx_timestamps(connection)
+            if log_event is not None:
+                log_event(EVENT_CONNECT, conn_address[1])
+            if count_connection is not None:
+                count_connection()
+            connected = [connection]
+            if udp_socket is not None:
+                connected.append(udp_socket)
+            if admin is not None:
+                connected.append(admin)
+            connection_send = connection.sendall
+            continue
+
+        if tracer is not None:
+            ts_trace = time.perf_counter_ns()
+        if kernel_timestamps:
+            nb_received, _, ts_kernel = \
+                recv_into_timestamped(connection, request_views[nb_pending])
+            if ts_kernel is not None:
+                ts_receive = ts_kernel
+        else:
+            nb_received = connection.recv_into(request_views[nb_pending]) #wait
+        if tracer is not None:
+            tracer.trace(STAGE_RECV, ts_trace, time.perf_counter_ns(),
+                         nb_received)
+        if log_event is not None:
+            log_event(EVENT_RECEIVE, nb_received, ts_receive)
+        nb_bytes = nb_pending + nb_received
+        if nb_pending or (nb_received > 0 and \
+                          request_buffer[0] == STS_WIRE_V1):
+            nb_done, command = run_binary_requests(nb_bytes, ts_receive,
+                                                   connection_send, None)
+            if command is None and nb_received > 0:
+                nb_pending = nb_bytes - nb_done
+                if nb_pending > 0:
+                    # Move the start of the split request to the front
+                    request_buffer[:nb_pending] = \
+                        request_buffer[nb_done:nb_bytes]
+                continue
+        else:
+            # Legacy text requests are single command bytes. Coalesced ones
+            # (eg b'00') are run in turn, each with its own reply.
+            command = None
+            for ibyte in range(nb_received):
+                if tracer is not None:
+                    ts_trace = time.perf_counter_ns()
+                command = request_buffer[ibyte]
+                action = text_actions[command]
+                if action is None:
+                    break
+                if count_request is not None:
+                    count_request(ts_receive)
+                if tracer is not None:
+                    ts_dispatched = time.perf_counter_ns()
+                ts_start = time.time_ns()
+                action()
+                ts_callback = time.time_ns()
+                if tracer is not None:
+                    ts_called = time.perf_counter_ns()
+                    if async_callbacks: # deferred, no callback span
+                        ts_dispatched = ts_called
+                ts_transmit = time.time() + ts_encode_time
+                with send_lock:
+                    connection.sendall((str(ts_receive / 1e9) + ' ' + \
+                                        str(ts_callback / 1e9) + ' ' + \
                                         str(ts_transmit)).encode())
-                    
-            logger.info('%s last callback at %s', server_name, ts_callback)
-            logger.info('%s closing connection %s', server_name, connection)
-            connection.close()
-            
+                if tracer is not None:
+                    tracer.trace_request(0, ts_trace, ts_dispatched, ts_called,
+                                         time.perf_counter_ns())
+                if log_event is not None:
+                    log_event(EVENT_CALLBACK_END, 0, ts_callback)
+                    log_event(EVENT_REPLY, 0)
+                if metrics is not None:
+                    record_reply(time.time_ns() - ts_receive)
+                    if not async_callbacks:
+                        record_callback(ts_callback - ts_start)
+                command = None
+                ts_receive = time.time_ns()
+            if command is None and nb_received > 0:
+                continue
+
+        if command == STS_QUIT[0]:
+            finished = True
+        elif nb_received > 0:
+            finished = True
+            msg = 'Shutting down because of bad request: %s' % \
+                  bytes(request_buffer[:nb_bytes])
+            status_handler.set_status(STATUS_ERROR, msg)
+            logger.error('%s %s', server_name, msg)
+
+        logger.info('%s last request at %f', server_name, ts_receive / 1e9)
+        logger.info('%s closing connection %s', server_name, connection)
+        connection.close()
+        connection = None
+        nb_pending = 0
+        if log_event is not None:
+            log_event(EVENT_DISCONNECT)
+
     ## Close
-    if socket is not None:
-        logger.info('%s closing %s', server_name, socket)
-        socket.shutdown(socket_module.SHUT_RDWR)
-        socket.close()
-        status_handler.set_status(STATUS_ERROR, 'Finished')
+    if scheduled:
+        logger.warning('%s dropping %d scheduled triggers', server_name,
+                       len(scheduled))
+    if async_callbacks:
+        # Let pending callbacks run before closing sockets
+        callbacks.put(None)
+        worker.join()
+    if connection is not None:
+        logger.info('%s closing connection %s', server_name, connection)
+        connection.close()
+    if udp_socket is not None:
+        logger.info('%s closing %s', server_name, udp_socket)
+        udp_socket.close()
+    logger.info('%s closing %s', server_name, socket)
+    socket.shutdown(socket_module.SHUT_RDWR)
+    socket.close()
+    if event_logger is not None and event_logger.filename is not None:
+        event_logger.dump()
+    if metrics is not None:
+        metrics_server.stop()
+    if tracer is not None and tracer.filename is not None:
+        tracer.dump()
+    status_handler.set_status(STATUS_ERROR, 'Finished')
 
 class STServerProcess(Process):
     """ 
     Synchronized Trigger Server encapsulated in a multiprocessing.Process
 
     NTP-like server using TCP, returning receive / transmit timestamps. 
-    A callback can be executed before replying, depending on a query flag.
+    Probes can also be answered over UDP on the same port (udp=True).
+    A callback can be executed before replying, depending on a query flag,
+    or by a worker thread after replying (async_callbacks=True).
+    Callbacks of other trigger channels are given by channels, and the
+    server can be controlled through admin (see sync_trigger_server).
 
     Note: Process is used to minimize thread switching overhead, hopefully
           using a dedicated CPU to be as precise as possible.
+          Use realtime=dict(cpus=[...]) to actually pin it to a CPU, with
+          real-time priority (see polos.realtime).
           For more flexibility, but potentially less precision, 
           use STServerThread.
           
@@ -176,7 +827,11 @@ class STServerProcess(Process):
     
     def __init__(self, port=STS_DEFAULT_PORT, callback1=None,
                  callback2=None, receive_timeout=None,
-                 server_name=STS_DEFAULT_NAME, status_handler=None):
+                 server_name=STS_DEFAULT_NAME, status_handler=None,
+                 udp=False, kernel_timestamps=False, async_callbacks=False,
+                 realtime=None, reuse_port=False, event_logger=None,
+                 metrics_address=None, tracer=None, channels=None,
+                 admin=None):
         super().__init__()
 
         self.callback1 = callback1
@@ -184,6 +839,16 @@ class STServerProcess(Process):
         self.port = port
         self.server_name = server_name
         self.receive_timeout = receive_timeout
+        self.udp = udp
+        self.kernel_timestamps = kernel_timestamps
+        self.async_callbacks = async_callbacks
+        self.realtime = realtime
+        self.reuse_port = reuse_port
+        self.event_logger = event_logger
+        self.metrics_address = metrics_address
+        self.tracer = tracer
+        self.channels = channels
+        self.admin = admin
 
         if status_handler is None:
             status_handler = NoStatus()
@@ -197,7 +862,11 @@ class STServerProcess(Process):
     def run(self):
         sync_trigger_server(self.port, self.callback1, self.callback2,
                             self.server_name, self.receive_timeout,
-                            self.status_handler)
+                            self.status_handler, self.udp,
+                            self.kernel_timestamps, self.async_callbacks,
+                            self.realtime, self.reuse_port,
+                            self.event_logger, self.metrics_address,
+                            self.tracer, self.channels, self.admin)
         
     def run_old(self):
         #TODO: put everything in a function and wrap it in Process
@@ -281,17 +950,27 @@ class STServerThread(Thread):
     Synchronized Trigger Server encapsulated in a threading.Thread
 
     NTP-like server using TCP, returning receive / transmit timestamps. 
-    A callback can be executed before replying, depending on a query flag.
+    Probes can also be answered over UDP on the same port (udp=True).
+    A callback can be executed before replying, depending on a query flag,
+    or by a worker thread after replying (async_callbacks=True).
+    Callbacks of other trigger channels are given by channels, and the
+    server can be controlled through admin (see sync_trigger_server).
 
     Note: Thread can have large overhead and uncertainty.
           If time-critical is required, use STServerProcess.
+          The memory and GC settings of realtime apply to the whole 
+          process.
           
     """
     
     
     def __init__(self, port=STS_DEFAULT_PORT, callback1=None,
                  callback2=None, receive_timeout=None,
-                 server_name=STS_DEFAULT_NAME, status_handler=None):
+                 server_name=STS_DEFAULT_NAME, status_handler=None,
+                 udp=False, kernel_timestamps=False, async_callbacks=False,
+                 realtime=None, reuse_port=False, event_logger=None,
+                 metrics_address=None, tracer=None, channels=None,
+                 admin=None):
         super().__init__()
 
         self.callback1 = callback1
@@ -299,6 +978,16 @@ class STServerThread(Thread):
         self.port = port
         self.server_name = server_name
         self.receive_timeout = receive_timeout
+        self.udp = udp
+        self.kernel_timestamps = kernel_timestamps
+        self.async_callbacks = async_callbacks
+        self.realtime = realtime
+        self.reuse_port = reuse_port
+        self.event_logger = event_logger
+        self.metrics_address = metrics_address
+        self.tracer = tracer
+        self.channels = channels
+        self.admin = admin
 
         if status_handler is None:
             status_handler = NoStatus()
@@ -313,31 +1002,258 @@ class STServerThread(Thread):
     def run(self):
         sync_trigger_server(self.port, self.callback1, self.callback2,
                             self.server_name, self.receive_timeout,
-                            self.status_handler)
+                            self.status_handler, self.udp,
+                            self.kernel_timestamps, self.async_callbacks,
+                            self.realtime, self.reuse_port,
+                            self.event_logger, self.metrics_address,
+                            self.tracer, self.channels, self.admin)
         
 class STBaseClient:
+    """
+    Base of STS clients.
+
+    Requests use the legacy text wire format by default (wire_format=
+    STS_WIRE_TEXT), which all servers understand. Servers of this version
+    detect the format of each request from its first byte, so clients opt
+    in to the binary one with wire_format=STS_WIRE_V1: nanosecond
+    timestamps, sequence numbers, reply status, and the requests which
+    only exist in it (scheduled triggers, channels, probes). A server
+    older than the binary format shuts down on such a request.
+
+    Connection management: TCP connections use keep-alive probes, so that
+    a dead peer is detected even when idle. reconnect() opens a new
+    connection to the last server, retrying with exponential backoff.
+    With auto_reconnect=True, requests which fail because the connection
+    was lost are retried once after reconnecting.
+    With pool_size > 0, that many spare connections are kept open to the
+    server, so that reconnecting does not wait for a new handshake when
+    the server is still up. As the STS serves one connection at a time,
+    spare ones wait in its backlog until the active one is closed.
+    Statistics (eg delays) are attributes of the client, and survive
+    reconnections.
+
+    If event_logger is given (see polos.eventlog), requests sent, replies
+    received and reconnections are recorded in it.
+
+    Latency histograms are kept in metrics (see polos.metrics), once
+    requests are done, and can be served with serve_metrics.
+
+    If tracer is given (see polos.tracing), the sending of requests and
+    the waiting for replies are recorded in it.
+    """
 
     CLOCK_OFFSET_TOLERANCE = 10e-3 # second
+    MAX_TRIGGER_REPORTS = 1024 # oldest unclaimed reports are dropped
+    KEEPALIVE_IDLE = 1 # second, before the first keep-alive probe
+    KEEPALIVE_INTERVAL = 1 # second, between keep-alive probes
+    KEEPALIVE_COUNT = 3 # unanswered probes before the connection is dropped
+    CONNECT_TIMEOUT = 1 # second
+    RECONNECT_ATTEMPTS = 10
+    RECONNECT_BACKOFF_MIN = 0.05 # second, first wait between attempts
+    RECONNECT_BACKOFF_MAX = 2 # second
     
-    def __init__(self, client_name):
-        self.socket = socket_module.socket(socket_module.AF_INET,
-                                           socket_module.SOCK_STREAM)
+    def __init__(self, client_name, transport=STS_TRANSPORT_TCP,
+                 wire_format=STS_WIRE_TEXT, kernel_timestamps=False,
+                 auto_reconnect=False, pool_size=0, event_logger=None,
+                 tracer=None):
+        self.transport = transport
+        self.socket = self._create_socket()
+        assert(wire_format in (STS_WIRE_TEXT, STS_WIRE_V1))
+        self.wire_format = wire_format
+        self.seq = 0 # sequence number of the last request
+
+        # Kernel timestamps of the last request sending and reply reception,
+        # in ns (None if unavailable, see polos.timestamping).
+        # They are enabled once connected.
+        self.kernel_timestamps = kernel_timestamps
+        self.kernel_rx = False
+        self.kernel_tx = False
+        self.ts_kernel_origin = None
+        self.ts_kernel_destination = None
+        self.tx_timestamps = [] # pending (key, ns), see get_tx_timestamps
+        self.tx_count = 0 # key of the next kernel transmit timestamp
+        # Reports of scheduled triggers, by sequence number:
+        # (status, scheduled time, callback start, callback end) in ns
+        self.trigger_reports = {}
+        self.reply_status = None # status of the last binary reply
+        self.partial_reply = b'' # start of a reply cut by a timeout
         self.status = STATUS_ERROR
         self.status_message = 'Not connected'
 
+        # Connection management
+        self.server_address = None # (host, port) once connected
+        self.auto_reconnect = auto_reconnect
+        self.pool_size = pool_size if transport == STS_TRANSPORT_TCP else 0
+        self.spare_sockets = [] # warm connections to the server
+        self.nb_reconnections = 0
+
+        self.event_logger = event_logger
+        self.tracer = tracer
+        self.metrics = Metrics({'client' : client_name})
+        self.metrics_server = None
         self.client_name = client_name
         logger.info('%s created, socket: %s', self.client_name, self.socket)
+
+    def _create_socket(self):
+        socket_type = {STS_TRANSPORT_TCP : socket_module.SOCK_STREAM,
+                       STS_TRANSPORT_UDP : socket_module.SOCK_DGRAM}\
+                       [self.transport]
+        sock = socket_module.socket(socket_module.AF_INET, socket_type)
+        if self.transport == STS_TRANSPORT_TCP:
+            # Do not delay small requests (Nagle's algorithm)
+            sock.setsockopt(socket_module.IPPROTO_TCP,
+                            socket_module.TCP_NODELAY, True)
+            # Detect dead connections, eg after a network failure
+            sock.setsockopt(socket_module.SOL_SOCKET,
+                            socket_module.SO_KEEPALIVE, True)
+            for option, value in (('TCP_KEEPIDLE', self.KEEPALIVE_IDLE),
+                                  ('TCP_KEEPINTVL', self.KEEPALIVE_INTERVAL),
+                                  ('TCP_KEEPCNT', self.KEEPALIVE_COUNT)):
+                if hasattr(socket_module, option): # Not on all platforms
+                    sock.setsockopt(socket_module.IPPROTO_TCP,
+                                    getattr(socket_module, option), value)
+        return sock
         
     def connect(self, host, port=STS_DEFAULT_PORT):
         logger.info('%s connecting to %s:%d..., socket: %s', self.client_name,
                     host, port, self.socket)
         self.socket.connect((host, port))
         logger.info('%s connected to %s:%d', self.client_name, host, port)
+        self.server_address = (host, port)
+        self._setup_connection()
+        self.fill_pool()
+
+    def _setup_connection(self):
+        self.tx_count = 0
+        self.partial_reply = b''
+        self.tx_timestamps.clear()
+        if self.kernel_timestamps:
+            self.kernel_rx = enable_rx_timestamps(self.socket)
+            self.kernel_tx = enable_tx_timestamps(self.socket)
         self.status = STATUS_WARNING
         self.status_message = 'Connected to %s:%d, but no query yet' % \
-                              (host, port)
+                              self.server_address
+
+    def fill_pool(self):
+        """
+        Open spare connections to the server, up to pool_size.
+        Return the number of spare connections.
+        """
+        while len(self.spare_sockets) < self.pool_size:
+            sock = self._create_socket()
+            sock.settimeout(self.CONNECT_TIMEOUT)
+            try:
+                sock.connect(self.server_address)
+            except OSError as e:
+                logger.warning('%s cannot open spare connection: %s',
+                               self.client_name, e)
+                sock.close()
+                break
+            sock.settimeout(None)
+            self.spare_sockets.append(sock)
+        return len(self.spare_sockets)
+
+    @staticmethod
+    def _is_alive(sock):
+        """ Return False if the peer closed or reset the given connection """
+        try:
+            return sock.recv(1, socket_module.MSG_PEEK | \
+                             socket_module.MSG_DONTWAIT) != b''
+        except BlockingIOError: # No data: still open
+            return True
+        except OSError:
+            return False
+
+    def reconnect(self):
+        """
+        Replace the current connection by a spare one if still alive, else
+        by a new one, retrying with exponential backoff. The spare pool
+        is then refilled. Raise ConnectionError if all attempts failed.
+        """
+        assert(self.server_address is not None)
+        blocking = True
+        if self.socket is not None:
+            blocking = self.socket.getblocking()
+            self.socket.close()
+            self.socket = None
+        self.kernel_rx = self.kernel_tx = False
+
+        while len(self.spare_sockets) > 0:
+            sock = self.spare_sockets.pop(0)
+            if self._is_alive(sock):
+                self.socket = sock
+                logger.info('%s switched to a spare connection',
+                            self.client_name)
+                break
+            sock.close()
+
+        backoff = self.RECONNECT_BACKOFF_MIN
+        attempt = 0
+        while self.socket is None:
+            attempt += 1
+            sock = self._create_socket()
+            sock.settimeout(self.CONNECT_TIMEOUT)
+            try:
+                sock.connect(self.server_address)
+            except OSError as e:
+                sock.close()
+                if attempt == self.RECONNECT_ATTEMPTS:
+                    self.status = STATUS_ERROR
+                    self.status_message = 'Cannot reconnect to %s:%d' % \
+                                          self.server_address
+                    raise ConnectionError('%s cannot reconnect to %s:%d '\
+                                          'after %d attempts: %s' % \
+                                          ((self.client_name,) + \
+                                           self.server_address + \
+                                           (attempt, e)))
+                logger.warning('%s reconnection attempt %d failed (%s), '\
+                               'retrying in %s', self.client_name, attempt, e,
+                               format_duration(backoff))
+                time.sleep(backoff)
+                backoff = min(2 * backoff, self.RECONNECT_BACKOFF_MAX)
+                continue
+            self.socket = sock
+
+        self.socket.setblocking(blocking)
+        self.nb_reconnections += 1
+        if self.event_logger is not None:
+            self.event_logger.log(EVENT_RECONNECT, self.nb_reconnections)
+        logger.info('%s reconnected to %s:%d', self.client_name,
+                    *self.server_address)
+        self._setup_connection()
+        self.fill_pool()
+
+    def _retry_on_disconnect(self, func, *args):
+        """
+        Call func(*args). If the connection was lost and auto_reconnect is
+        set, reconnect and call it once more.
+        """
+        try:
+            return func(*args)
+        except ConnectionError as e:
+            if not self.auto_reconnect or self.server_address is None:
+                raise
+            logger.warning('%s lost connection (%s), reconnecting',
+                           self.client_name, e)
+        self.reconnect()
+        return func(*args)
+
+    def serve_metrics(self, address):
+        """
+        Serve metrics at the given Unix socket path or (host, port),
+        until the client is closed
+        """
+        assert(self.metrics_server is None)
+        self.metrics_server = MetricsServer(self.metrics, address)
+        self.metrics_server.start()
 
     def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        for sock in self.spare_sockets:
+            sock.close()
+        self.spare_sockets.clear()
         if self.socket is not None:
             logger.info('%s closing %s', self.client_name, self.socket)
 
@@ -352,52 +1268,453 @@ class STBaseClient:
 
     def shutdown_server(self):
         self.socket.setblocking(True)
-        self.socket.send(STS_QUIT)
+        self.send_request(self.encode_request(STS_QUIT))
+
+    def send_request(self, request):
+        """
+        Send the given request bytes. Keep track of the number of sent 
+        datagrams (UDP) or bytes (TCP), to match kernel transmit timestamps.
+        """
+        if self.tracer is not None:
+            ts_trace = time.perf_counter_ns()
+        if self.event_logger is not None:
+            ts_send = time.time_ns()
+            self.socket.send(request)
+            self.event_logger.log(EVENT_SEND, self.seq, ts_send)
+        else:
+            self.socket.send(request)
+        if self.tracer is not None:
+            self.tracer.trace(STAGE_CLIENT_SEND, ts_trace,
+                              time.perf_counter_ns(), self.seq)
+        if self.transport == STS_TRANSPORT_UDP:
+            self.tx_count += 1
+        else:
+            self.tx_count += len(request)
+
+    def encode_request(self, command, arg=0, target=b'\x00', channel=0):
+        """ 
+        Return the bytes of a request for the given command (eg STS_CALLBACK_1),
+        using the wire format of the client. Increment the sequence number.
+        The channel is only encoded in the binary wire format.
+        """
+        self.seq += 1
+        if self.wire_format == STS_WIRE_V1:
+            return STS_REQUEST_V1.pack(STS_WIRE_V1, command[0], target[0],
+                                       channel, self.seq, arg)
+        elif self.transport == STS_TRANSPORT_UDP:
+            return command + str(self.seq).encode()
+        else:
+            return command
+
+    def decode_reply(self, rdata):
+        """
+        Return (sequence number, receive, callback, transmit) from the given 
+        reply. Timestamps are in nanoseconds. The sequence number is None
+        for legacy text replies over TCP.
+        Reports of scheduled or deferred triggers are stored in 
+        trigger_reports, and None is returned for them.
+        """
+        if self.wire_format == STS_WIRE_V1:
+            (version, command, status, seq,
+             ts_receive, ts_callback, ts_transmit) = STS_REPLY_V1.unpack(rdata)
+            if status >= STS_REPLY_ERROR:
+                raise Exception('Server replied with error status %d' % status)
+            if command == STS_TRIGGER_REPORT[0]:
+                if len(self.trigger_reports) >= self.MAX_TRIGGER_REPORTS:
+                    del self.trigger_reports[next(iter(self.trigger_reports))]
+                self.trigger_reports[seq] = (status, ts_receive, ts_callback,
+                                             ts_transmit)
+                return None
+            self.reply_status = status
+            return seq, ts_receive, ts_callback, ts_transmit
+
+        fields = rdata.decode().split(' ')
+        if self.transport == STS_TRANSPORT_UDP:
+            seq = int(fields.pop(0))
+        else:
+            seq = None
+        ts_receive, ts_callback, ts_transmit = [round(float(f) * 1e9) \
+                                                for f in fields]
+        return seq, ts_receive, ts_callback, ts_transmit
+
+    def recv_reply(self, timeout):
+        """
+        Wait for the reply to the last request, dropping late replies
+        to previous ones. Return the reply bytes and the reception 
+        timestamp, in nanoseconds.
+        """
+        if self.wire_format == STS_WIRE_V1:
+            # Read exactly one reply, so that two are never merged
+            reply_size = STS_REPLY_V1.size
+        else:
+            reply_size = STS_BUFFER_SIZE
+        if self.tracer is not None:
+            ts_trace = time.perf_counter_ns()
+        deadline = time.perf_counter() + timeout
+        while True:
+            if self.wire_format == STS_WIRE_V1:
+                rdata = self._recv_exact(reply_size, deadline,
+                                         'server answer to request %d')
+            else:
+                ready = select.select([self.socket], [], [],
+                                      max(0, deadline - time.perf_counter()))
+                if not ready[0]:
+                    raise STSTimeoutError('Timeout during waiting for ' \
+                                          'server answer to request %d' % \
+                                          self.seq)
+                rdata = self._recv(reply_size)
+                if rdata is None:
+                    continue
+                if not rdata:
+                    raise ConnectionError('Connection closed by server')
+            ts_destination = time.time_ns()
+            reply = self.decode_reply(rdata)
+            if reply is None:
+                continue
+            if reply[0] is None or reply[0] == self.seq:
+                if self.event_logger is not None:
+                    self.event_logger.log(EVENT_REPLY_RECEIVED, self.seq,
+                                          ts_destination)
+                if self.tracer is not None:
+                    self.tracer.trace(STAGE_CLIENT_RECV, ts_trace,
+                                      time.perf_counter_ns(), self.seq)
+                return reply, ts_destination
+            logger.debug('%s dropping late reply %d (expected %d)',
+                         self.client_name, reply[0], self.seq)
+        
+    def schedule_trigger(self, server_time_ns, command=STS_CALLBACK_1,
+                         timeout=5, channel=0):
+        """
+        Ask the server to run the callback of the given command and channel
+        at the given server time, in ns. Requires the binary wire format.
+        Return the sequence number of the request, to be given to
+        wait_trigger_report.
+        """
+        assert(self.wire_format == STS_WIRE_V1)
+        self.send_request(self.encode_request(STS_SCHEDULE, server_time_ns,
+                                              command, channel))
+        seq = self.seq
+        self.recv_reply(timeout)
+        return seq
+
+    def wait_trigger_report(self, seq, timeout=5):
+        """
+        Wait for the report of the scheduled trigger of the given sequence
+        number, or of the deferred one (reply status STS_REPLY_DEFERRED).
+        Return (status, scheduled time, callback start, callback end),
+        in ns. The status is STS_REPLY_LATE if the trigger was scheduled in
+        the past.
+        """
+        deadline = time.perf_counter() + timeout
+        while seq not in self.trigger_reports:
+            self.decode_reply(self._recv_exact(STS_REPLY_V1.size, deadline,
+                                               'report of trigger %d', seq))
+        return self.trigger_reports.pop(seq)
+
+    def _recv_exact(self, size, deadline, waited_for, seq=None):
+        """
+        Receive exactly size bytes before the given perf_counter deadline.
+        Raise STSTimeoutError if they did not all arrive in time (waited_for
+        describes the expected data, formatted with seq, by default the
+        last one), and ConnectionError if the server closed the connection.
+        Bytes received before a timeout are kept for the next call, so that
+        the stream stays in sync.
+        """
+        rdata = self.partial_reply
+        self.partial_reply = b''
+        while len(rdata) < size:
+            ready = select.select([self.socket], [], [],
+                                  max(0, deadline - time.perf_counter()))
+            if not ready[0]:
+                self.partial_reply = rdata
+                raise STSTimeoutError('Timeout during waiting for ' + \
+                                      waited_for % \
+                                      (self.seq if seq is None else seq))
+            data = self._recv(size - len(rdata))
+            if data is None:
+                continue
+            if not data:
+                raise ConnectionError('Connection closed by server')
+            rdata += data
+        return rdata
+
+    def _recv(self, size):
+        """
+        Receive at most size bytes. Return None if there was no data,
+        select having been woken up by a kernel transmit timestamp.
+        """
+        try:
+            if self.kernel_rx:
+                rdata, _, self.ts_kernel_destination = \
+                    recv_timestamped(self.socket, size)
+                return rdata
+            return self.socket.recv(size)
+        except BlockingIOError:
+            if not self.kernel_tx:
+                raise
+            self.tx_timestamps.extend(get_tx_timestamps(self.socket))
+            return None
+
+    def _read_kernel_origin(self):
+        """ 
+        Set ts_kernel_origin to the kernel timestamp of the last sent request
+        """
+        self.ts_kernel_origin = None
+        if self.kernel_tx:
+            self.tx_timestamps.extend(get_tx_timestamps(self.socket))
+            if len(self.tx_timestamps) > 0:
+                self.ts_kernel_origin = self.tx_timestamps[-1][1]
+            self.tx_timestamps.clear()
         
     def request(self):
         raise NotImplementedError()
     
 
 class ST_NTPClient(STBaseClient):
+    """
+    Estimate the clock offset with a STS by NTP-like probes.
+
+    Probes can be sent over the TCP connection (default) or as UDP datagrams
+    (transport=STS_TRANSPORT_UDP), which avoids stream framing and gives
+    lower and more symmetric round-trip delays. The server must then be
+    started with udp=True. Each probe carries a sequence number so that
+    late replies are dropped, and lost UDP probes are skipped by request().
+
+    By default, the legacy text wire format is used. With the binary one
+    (wire_format=STS_WIRE_V1, see STBaseClient), timestamps have
+    nanosecond resolution and probes can be pipelined (see request).
+
+    Probes are probe_command requests: STS_CALLBACK_1 by default, which
+    runs the main server callback, or STS_PROBE (binary wire format),
+    which runs none, eg to keep the clock in sync without firing triggers.
+
+    With kernel_timestamps=True, origin and destination timestamps are
+    taken by the kernel (Linux) when the probe is sent and when the reply
+    is received, falling back to user-space timestamps if unsupported.
+    request() then reports how much the round-trip delay was reduced
+    (kernel_delay_gain, in second).
+    """
     DEFAULT_NAME = 'ST_NTPClient'
     CLOCK_OFFSET_TOLERANCE = 10e-3 # second
     
-    def __init__(self, client_name=DEFAULT_NAME):
-        super().__init__(client_name)
+    def __init__(self, client_name=DEFAULT_NAME, transport=STS_TRANSPORT_TCP,
+                 wire_format=STS_WIRE_TEXT, kernel_timestamps=False,
+                 auto_reconnect=False, pool_size=0, event_logger=None,
+                 tracer=None, probe_command=STS_CALLBACK_1):
+        super().__init__(client_name, transport, wire_format,
+                         kernel_timestamps, auto_reconnect, pool_size,
+                         event_logger, tracer)
         
+        assert(probe_command in (STS_CALLBACK_1, STS_CALLBACK_2, STS_PROBE))
+        assert(probe_command != STS_PROBE or wire_format == STS_WIRE_V1)
+        self.probe_command = probe_command
         self.offset = None
         self.roundtrip_delay = None
-        
-    def single_request(self):
-        ts_orig = time.time()
-        self.socket.send(STS_CALLBACK_1)
-        ready = select.select([self.socket], [], [], 1)
-        if ready[0]:
-            rdata = self.socket.recv(STS_BUFFER_SIZE)
-            ts_destination = time.time()
+        self.nb_lost = 0
+        self.user_timestamps = None # (origin, destination) of last probe
+        self.kernel_delay_gain = None
+        # Offsets and round-trip delays of the last request, in second,
+        # and local times of the probes (middle of round-trip, in ns)
+        self.offsets = None
+        self.delays = None
+        self.probe_times = None
+        self.delay_histogram = \
+            self.metrics.add_histogram('client_round_trip_delay_seconds',
+                                       'Round-trip delay of probes')
+
+    def get_timeout(self):
+        """ Return the time to wait for a reply before giving up, in second """
+        if self.transport == STS_TRANSPORT_UDP:
+            return STS_UDP_TIMEOUT
         else:
-            raise Exception('Timeout during waiting for server answer')
+            return 1
         
-        rts1,rts2,rts3 = rdata.decode().split(' ')
-        ts_receive = float(rts1)
-        ts_callback = float(rts2)
-        ts_transmit = float(rts3)
+    def single_request(self):
+        """
+        Send a single probe and wait for its reply.
+
+        Return the timestamps in nanoseconds:
+            (origin, destination, transmit, receive, callback)
+        Origin and destination are kernel timestamps if available.
+        User-space ones are kept in user_timestamps.
+        """
+        request = self.encode_request(self.probe_command)
+        ts_orig = time.time_ns()
+        self.send_request(request)
+        reply, ts_destination = self.recv_reply(self.get_timeout())
+        _, ts_receive, ts_callback, ts_transmit = reply
+
+        self.user_timestamps = (ts_orig, ts_destination)
+        self._read_kernel_origin()
+        if self.ts_kernel_origin is not None:
+            ts_orig = self.ts_kernel_origin
+        if self.ts_kernel_destination is not None:
+            ts_destination = self.ts_kernel_destination
         
         return ts_orig, ts_destination, ts_transmit, ts_receive, ts_callback
+
+    def _lockstep_probes(self, nb_trials):
+        """
+        Send probes one after the other, each one after the reply to the
+        previous one. 
+        Return an array of timestamps in ns, of shape (6, nb_trials), 
+        with rows: origin, destination, transmit, receive, user-space origin
+        and user-space destination; and the mask of received replies.
+        """
+        timestamps = np.zeros((6, nb_trials), dtype=np.int64)
+        received = np.ones(nb_trials, dtype=bool)
+        for itrial in range(nb_trials):
+            try:
+                ts_orig, ts_dest, ts_tr, ts_receive, ts_cbk = \
+                    self.single_request()
+            except STSTimeoutError:
+                if self.transport != STS_TRANSPORT_UDP:
+                    raise
+                received[itrial] = False
+                continue
+            timestamps[:, itrial] = (ts_orig, ts_dest, ts_tr, ts_receive,
+                                     self.user_timestamps[0],
+                                     self.user_timestamps[1])
+        return timestamps, received
+
+    def _burst_probes(self, nb_trials, in_flight):
+        """
+        Send probes without waiting for replies, keeping up to in_flight
+        probes pending. Replies are matched by sequence number.
+        Return the same as _lockstep_probes.
+        """
+        timestamps = np.zeros((6, nb_trials), dtype=np.int64)
+        ts_orig, ts_dest, ts_tr, ts_receive, user_orig, user_dest = timestamps
+        received = np.zeros(nb_trials, dtype=bool)
+        resolved = np.zeros(nb_trials, dtype=bool) # received or lost
+        tx_keys = np.zeros(nb_trials, dtype=np.int64)
+
+        requests = [self.encode_request(self.probe_command) \
+                    for _ in range(nb_trials)]
+        first_seq = self.seq - nb_trials + 1
+        timeout_ns = self.get_timeout() * 1e9
+        reply_size = STS_REPLY_V1.size
+        if self.transport == STS_TRANSPORT_UDP:
+            recv_size = reply_size
+        else:
+            recv_size = reply_size * in_flight
+        stream = b''
+
+        nb_sent = 0
+        nb_pending = 0
+        oldest = 0 # oldest probe not resolved yet
+        while oldest < nb_trials:
+            while nb_sent < nb_trials and nb_pending < in_flight:
+                user_orig[nb_sent] = time.time_ns()
+                self.send_request(requests[nb_sent])
+                tx_keys[nb_sent] = self.tx_count - 1
+                nb_sent += 1
+                nb_pending += 1
+
+            wait = (timeout_ns - time.time_ns() + user_orig[oldest]) / 1e9
+            if not select.select([self.socket], [], [], max(0, wait))[0]:
+                if self.transport != STS_TRANSPORT_UDP:
+                    raise STSTimeoutError('Timeout during waiting for '\
+                                          'server answer to request %d' % \
+                                          (first_seq + oldest))
+                resolved[oldest] = True # lost
+                nb_pending -= 1
+            else:
+                rdata = self._recv(recv_size)
+                ts_now = time.time_ns()
+                if rdata is None:
+                    continue
+                if not rdata:
+                    raise ConnectionError('Connection closed by server')
+                if self.ts_kernel_destination is not None:
+                    ts_rdest = self.ts_kernel_destination
+                else:
+                    ts_rdest = ts_now
+                stream += rdata
+                nb_replies = len(stream) // reply_size
+                for ireply in range(nb_replies):
+                    reply = self.decode_reply(stream[ireply * reply_size:
+                                                     (ireply + 1) * reply_size])
+                    if reply is None:
+                        continue
+                    seq, rts_receive, _, rts_transmit = reply
+                    iprobe = seq - first_seq
+                    if 0 <= iprobe < nb_sent and not resolved[iprobe]:
+                        user_dest[iprobe] = ts_now
+                        ts_dest[iprobe] = ts_rdest
+                        ts_receive[iprobe] = rts_receive
+                        ts_tr[iprobe] = rts_transmit
+                        received[iprobe] = True
+                        resolved[iprobe] = True
+                        nb_pending -= 1
+                    else:
+                        logger.debug('%s dropping late reply %d',
+                                     self.client_name, seq)
+                if self.transport == STS_TRANSPORT_UDP:
+                    stream = b''
+                else:
+                    stream = stream[nb_replies * reply_size:]
+            while oldest < nb_sent and resolved[oldest]:
+                oldest += 1
+
+        ts_orig[:] = user_orig
+        if self.kernel_tx:
+            self.tx_timestamps.extend(get_tx_timestamps(self.socket))
+            kernel_orig = dict(self.tx_timestamps)
+            self.tx_timestamps.clear()
+            for iprobe, tx_key in enumerate(tx_keys):
+                ts_orig[iprobe] = kernel_orig.get(tx_key, user_orig[iprobe])
+        return timestamps, received
         
-    def request(self, nb_trials=10):
-        assert(nb_trials > 0)
+    def request(self, nb_trials=10, in_flight=1, estimator='lowest_delays'):
+        """
+        Estimate the clock offset with the server from nb_trials probes.
+
+        If in_flight is 1, each probe is sent once the previous reply
+        is received. Else up to in_flight probes are kept pending, which
+        shortens the probing session. This requires the binary wire format.
+
+        estimator is the name of a function of polos.estimators.ESTIMATORS,
+        or a callable with the same signature, giving the offset from 
+        all probes. Use 'median_delay' for the former behavior.
+        """
+        estimator = get_estimator(estimator)
+        assert(nb_trials > 0 and in_flight > 0)
         self.socket.setblocking(False)
-        offsets = np.zeros(nb_trials)
-        delays = np.zeros(nb_trials)
-        for itrial in range(nb_trials):
-            ts_orig, ts_dest, ts_tr, ts_receive, ts_cbk = self.single_request()
-            offsets[itrial] = ((ts_receive - ts_orig) - (ts_tr - ts_dest)) / 2
-            delays[itrial] = (ts_dest - ts_orig) - (ts_tr - ts_receive)
+        if in_flight > 1:
+            assert(self.wire_format == STS_WIRE_V1)
+            timestamps, received = \
+                self._retry_on_disconnect(self._burst_probes, nb_trials,
+                                          in_flight)
+        else:
+            timestamps, received = \
+                self._retry_on_disconnect(self._lockstep_probes, nb_trials)
+
+        self.nb_lost = nb_trials - received.sum()
+        if self.nb_lost > 0:
+            logger.warning('%s lost %d probes out of %d', self.client_name,
+                           self.nb_lost, nb_trials)
+            if self.nb_lost == nb_trials:
+                raise STSTimeoutError('All probes were lost')
+            nb_trials = received.sum()
+
+        # Differences of integer timestamps, to keep nanosecond precision
+        ts_orig, ts_dest, ts_tr, ts_receive, user_orig, user_dest = \
+            timestamps[:, received]
+        offsets = ((ts_receive - ts_orig) + (ts_tr - ts_dest)) / 2e9
+        delays = ((ts_dest - ts_orig) - (ts_tr - ts_receive)) / 1e9
+        user_delays = ((user_dest - user_orig) - (ts_tr - ts_receive)) / 1e9
+        self.offsets = offsets
+        self.delays = delays
+        self.probe_times = (ts_orig + ts_dest) // 2
+        self.delay_histogram.record_many(delays)
 
-        to_keep = np.argsort(delays)[nb_trials//2]
-        self.offset = offsets[to_keep].mean() # rather trust requests with
-                                              # shorter round-trip delays
+        # rather trust requests with shorter round-trip delays
+        self.offset = estimator(offsets, delays,
+                                (self.probe_times - self.probe_times[-1]) / 1e9)
+        if self.tracer is not None:
+            # Map traces to the server clock
+            self.tracer.offset = self.offset
         self.round_trip_delay = np.median(delays)
         self.round_trip_delay_max = delays.max()
         self.round_trip_delay_min = delays.min()
@@ -406,6 +1723,13 @@ class ST_NTPClient(STBaseClient):
         logger.info('%s estimated round-trip delay: %f (%f) sec',
                     self.client_name, self.round_trip_delay,
                     self.round_trip_delay_std)
+
+        if self.kernel_rx or self.kernel_tx:
+            self.kernel_delay_gain = np.median(user_delays) - \
+                                     self.round_trip_delay
+            logger.info('%s kernel timestamps reduced round-trip delay '\
+                        'by %s', self.client_name,
+                        format_duration(self.kernel_delay_gain))
         
         if abs(self.offset) < STClient.CLOCK_OFFSET_TOLERANCE:
             self.status = STATUS_OK
@@ -417,43 +1741,171 @@ class ST_NTPClient(STBaseClient):
                                   self.offset
     
             
-class EventLogger:
-    def __init__():
-        self.size = 10000
-        self.events = [None] * self.size
-        self.i_event = 0
-
-    def log(msg):
-        self.events[self.i_event] = (time.time(), msg)
-        self.i_event += 1
-
-    def to_string():
-        '\n'.join(['%f : %s' %self.events[i] for i in range(self.i_event)])
-    
 class STClient(STBaseClient):
+    """
+    Fire a local and a remote trigger at the same time, compensating the
+    one-way delay estimated from the previous probes.
+
+    One-way delays are kept in delay_history across requests and
+    reconnections. Once it holds enough of them, request() only sends
+    WARM_TRIALS probes before triggering, instead of COLD_TRIALS.
+
+    The remote trigger is the callback of the given server channel
+    (see sync_trigger_server), which requires the binary wire format
+    unless it is 0. It can be changed between requests.
+
+    Delays can also be measured by lightweight probes (see probe), which
+    do not run server callbacks and require the binary wire format.
+    Once keep_warm() is called, a background thread probes the server
+    every WARM_INTERVAL on the same connection, and request() sends the
+    trigger at once, without any probe before it: the trigger takes about
+    one round trip instead of nb_trials.
+    """
 
     DEFAULT_NAME = 'STClient'
+    COLD_TRIALS = 100
+    WARM_TRIALS = 10
+    ESTIMATE_SIZE = 9 # number of last delays giving the estimated delay
+    HISTORY_SIZE = 100
+    WARM_INTERVAL = 0.2 # second, between probes of keep_warm
     
-    def __init__(self, trigger_callback=None):
+    def __init__(self, trigger_callback=None, wire_format=STS_WIRE_TEXT,
+                 auto_reconnect=False, pool_size=0, event_logger=None,
+                 tracer=None, channel=0):
 
-        super().__init__(client_name=STClient.DEFAULT_NAME)
+        super().__init__(client_name=STClient.DEFAULT_NAME,
+                         wire_format=wire_format,
+                         auto_reconnect=auto_reconnect, pool_size=pool_size,
+                         event_logger=event_logger, tracer=tracer)
         
         assert(callable(trigger_callback))
+        assert(channel == 0 or wire_format == STS_WIRE_V1)
         self.trigger_callback = trigger_callback
-                
-    def request(self, nb_trials=100):
+        self.channel = channel
+        self.delay_history = deque(maxlen=STClient.HISTORY_SIZE)
+        self.local_trigger_fired = False
+        # Requests and probes of the warm thread share the connection
+        self.lock = Lock()
+        self.warm_thread = None
+        self.warm_stop = Event()
+        self.delay_histogram = \
+            self.metrics.add_histogram('client_one_way_delay_seconds',
+                                       'One-way delay of requests')
+
+    def request(self, nb_trials=None):
+        """
+        Send nb_trials requests, the last one triggering the remote callback,
+        and fire the local one after the estimated delay.
+        By default, nb_trials is COLD_TRIALS, or WARM_TRIALS when
+        delay_history holds at least ESTIMATE_SIZE delays, or 1 (trigger 
+        only, delay estimated from delay_history) if kept warm (see
+        keep_warm).
+        If the connection is lost before the local trigger and 
+        auto_reconnect is set, the request is retried once reconnected.
+
+        Return (estimated delay, standard deviation of delays), in second.
+        """
+        with self.lock:
+            if nb_trials is None:
+                if len(self.delay_history) < STClient.ESTIMATE_SIZE:
+                    nb_trials = STClient.COLD_TRIALS
+                elif self.warm_thread is not None:
+                    nb_trials = 1
+                else:
+                    nb_trials = STClient.WARM_TRIALS
+            assert(nb_trials > 1 or len(self.delay_history) > 0)
+            self.local_trigger_fired = False
+            try:
+                return self._request(nb_trials)
+            except ConnectionError as e:
+                if not self.auto_reconnect or self.local_trigger_fired:
+                    raise
+                logger.warning('%s lost connection (%s), reconnecting',
+                               self.client_name, e)
+            self.reconnect()
+            return self._request(nb_trials)
+
+    def probe(self, nb_probes=1):
+        """
+        Send nb_probes lightweight probes (STS_PROBE), one after the other,
+        and add their one-way delays to delay_history. They do not run any
+        server callback. Requires the binary wire format.
+
+        Return the delays, in second.
+        """
+        assert(self.wire_format == STS_WIRE_V1)
+        with self.lock:
+            return self._retry_on_disconnect(self._probe, nb_probes)
+
+    def _probe(self, nb_probes):
+        self.socket.setblocking(False)
+        delays = np.zeros(nb_probes)
+        for iprobe in range(nb_probes):
+            request = self.encode_request(STS_PROBE)
+            ts_orig = time.time_ns()
+            self.send_request(request)
+            reply, ts_destination = self.recv_reply(5)
+            _, ts_receive, _, ts_transmit = reply
+            delays[iprobe] = ((ts_destination - ts_orig) - \
+                              (ts_transmit - ts_receive)) / 2e9
+        self.delay_history.extend(delays)
+        self.delay_histogram.record_many(delays)
+        return delays
+
+    def keep_warm(self, interval=WARM_INTERVAL):
+        """
+        Fill delay_history with probes if needed, then keep it up to date
+        by probing the server every interval, in second, in a background
+        thread, until stop_warm() or close().
+        """
+        assert(self.warm_thread is None)
+        missing = STClient.ESTIMATE_SIZE - len(self.delay_history)
+        if missing > 0:
+            self.probe(missing)
+        self.warm_stop.clear()
+        self.warm_thread = Thread(target=self._keep_warm, args=(interval,),
+                                  daemon=True)
+        self.warm_thread.start()
+
+    def _keep_warm(self, interval):
+        while not self.warm_stop.wait(interval):
+            try:
+                self.probe()
+            except (ConnectionError, STSTimeoutError) as e:
+                logger.warning('%s warm probe failed: %s',
+                               self.client_name, e)
+
+    def stop_warm(self):
+        if self.warm_thread is not None:
+            self.warm_stop.set()
+            self.warm_thread.join()
+            self.warm_thread = None
+
+    def close(self):
+        self.stop_warm()
+        super().close()
+
+    def _request(self, nb_trials):
                 
         # Request remote trigger
         self.socket.setblocking(False)
         self.delays = np.zeros(nb_trials)
+        if nb_trials == 1:
+            estimate_delays = list(self.delay_history)\
+                              [-STClient.ESTIMATE_SIZE:]
+            estimated_delay = np.median(estimate_delays)
         
         trigger_bytes = [STS_CALLBACK_2, STS_CALLBACK_1]
         for itrial in range(nb_trials):
+            request = self.encode_request(trigger_bytes[itrial==nb_trials-1],
+                                          channel=self.channel)
             ts_orig = time.time()
-            self.socket.send(trigger_bytes[itrial==nb_trials-1])
+            self.send_request(request)
             ts_send = time.time()
             
             if itrial==nb_trials-1: # last trial -> trigger
+                if self.tracer is not None:
+                    ts_trace = time.perf_counter_ns()
                 send_duration = (ts_send - ts_orig)
                 if estimated_delay >= send_duration:
                     trigger_delay = estimated_delay - send_duration
@@ -463,28 +1915,34 @@ class STClient(STBaseClient):
                     while time.perf_counter() < end:
                         continue
                 ts_pre_callback = time.time()
+                if self.tracer is not None:
+                    ts_spun = time.perf_counter_ns()
+                self.local_trigger_fired = True
                 self.trigger_callback()
                 ts_end_callback = time.time()
+                if self.tracer is not None:
+                    self.tracer.trace(STAGE_CLIENT_SPIN, ts_trace, ts_spun,
+                                      self.seq)
+                    self.tracer.trace(STAGE_LOCAL_CALLBACK, ts_spun,
+                                      time.perf_counter_ns(), self.seq)
+                if self.event_logger is not None:
+                    self.event_logger.log(EVENT_LOCAL_TRIGGER, self.seq,
+                                          round(ts_pre_callback * 1e9))
                 if estimated_delay < send_duration:
                     trigger_delay = 0
                     
-            ready = select.select([self.socket], [], [], 5)
-            ts_destination = time.time()
-            if ready[0]:
-                rdata = self.socket.recv(STS_BUFFER_SIZE)
-            else:
-                raise Exception('Timeout during waiting for server answer')
-            
-            rts1,rts2,rts3 = rdata.decode().split(' ')
-            ts_receive = float(rts1)
-            ts_remote_callback = float(rts2)
-            ts_transmit = float(rts3)
-
-            self.delays[itrial] = ((ts_destination - ts_orig) - \
-                                   (ts_transmit - ts_receive)) / 2 # + \
-                                   # (ts_remote_callback - ts_receive)/2
+            reply, ts_destination = self.recv_reply(5)
+            _, ts_receive, ts_remote_callback, ts_transmit = reply
+
+            self.delays[itrial] = ((ts_destination / 1e9 - ts_orig) - \
+                                   (ts_transmit - ts_receive) / 1e9) / 2 # + \
+                                   # (ts_remote_callback - ts_receive) / 2e9
+            self.delay_history.append(self.delays[itrial])
             if itrial==nb_trials-2:
-                estimated_delay = np.median(self.delays[-10:-1])
+                # Last delays, from previous requests if not enough probes
+                estimate_delays = list(self.delay_history)\
+                                  [-STClient.ESTIMATE_SIZE:]
+                estimated_delay = np.median(estimate_delays)
 
         # Aftermaths
         logger.info('%s request for remote trigger sent at %f',
@@ -493,8 +1951,8 @@ class STClient(STBaseClient):
                     self.client_name, ts_send)
         logger.info('%s estimated remote delay : %s [%s-%s]',
                     self.client_name, format_duration(estimated_delay),
-                    format_duration(self.delays[-10:-1].min()),
-                    format_duration(self.delays[-10:-1].max()))
+                    format_duration(min(estimate_delays)),
+                    format_duration(max(estimate_delays)))
         logger.debug('%s all delays:\n%s ', self.client_name,
                      '\n'.join([format_duration(d) for d in self.delays]))
         logger.info('%s planned to wait %s after socket.send returned',
@@ -509,16 +1967,74 @@ class STClient(STBaseClient):
                     ts_end_callback)
                 
         self.remote_trigger_sent_at = ts_orig
+        if self.reply_status == STS_REPLY_DEFERRED:
+            # Callback run by the server worker after replying
+            _, _, ts_remote_callback, ts_remote_end = \
+                self.wait_trigger_report(self.seq)
+            logger.info('%s remote callback ran from %f to %f (server time)',
+                        self.client_name, ts_remote_callback / 1e9,
+                        ts_remote_end / 1e9)
         logger.info('%s remote trigger issued btwn %f and %f (server time)',
-                    self.client_name, ts_receive, ts_remote_callback)
+                    self.client_name, ts_receive / 1e9,
+                    ts_remote_callback / 1e9)
+        self.remote_callback_at = ts_remote_callback / 1e9
 
         # remote_delay = self.delays[-10:-1].mean()
         # print('all delays:\n', self.delays)
         remote_delay_std = self.delays.std()
         self.trigger_delay_error = estimated_delay - self.delays[-1]
+        self.delay_histogram.record_many(self.delays)
 
         return estimated_delay, remote_delay_std
 
+    def request_at(self, server_time_ns, offset=0., timeout=5):
+        """
+        Schedule the remote trigger at the given server time, in ns, and
+        fire the local one at the corresponding local time. 
+        offset is the server time minus the local time, in second, 
+        eg estimated by ST_NTPClient or ClockSync.
+        Unlike request, the trigger accuracy does not depend on the network
+        delay, as long as the request reaches the server before its time.
+
+        Return (remote scheduled time, remote callback start, local callback 
+        start), in ns. Remote times are server ones.
+        """
+        with self.lock:
+            return self._request_at(server_time_ns, offset, timeout)
+
+    def _request_at(self, server_time_ns, offset, timeout):
+        self.socket.setblocking(False)
+        seq = self.schedule_trigger(server_time_ns, STS_CALLBACK_1, timeout,
+                                    self.channel)
+        
+        ts_local = server_time_ns - round(offset * 1e9)
+        wait = (ts_local - time.time_ns()) / 1e9 - STS_SPIN_TIME
+        if wait > 0:
+            time.sleep(wait)
+        while time.time_ns() < ts_local:
+            continue
+        ts_pre_callback = time.time_ns()
+        self.trigger_callback()
+        if self.event_logger is not None:
+            self.event_logger.log(EVENT_LOCAL_TRIGGER, seq, ts_pre_callback)
+
+        status, ts_scheduled, ts_remote_callback, _ = \
+            self.wait_trigger_report(seq, timeout + \
+                                     max(0, (ts_local - time.time_ns()) / 1e9))
+        if status == STS_REPLY_LATE:
+            logger.warning('%s remote trigger was scheduled in the past, '\
+                           'it fired %s late', self.client_name,
+                           format_duration((ts_remote_callback - \
+                                            ts_scheduled) / 1e9))
+        logger.info('%s remote trigger fired %s after scheduled time',
+                    self.client_name,
+                    format_duration((ts_remote_callback - ts_scheduled) / 1e9))
+        logger.info('%s local trigger fired %s after scheduled time',
+                    self.client_name,
+                    format_duration((ts_pre_callback - ts_local) / 1e9))
+        self.remote_trigger_sent_at = ts_local / 1e9
+        return ts_scheduled, ts_remote_callback, ts_pre_callback
+
 
     
 def format_duration(duration_sec):
@@ -0,0 +1,202 @@
+"""
+Shared-memory status board of server processes.
+
+A StatusBoard is a block of multiprocessing.shared_memory holding one
+fixed-layout slot (SLOT_DTYPE) per server: status code, message, pid,
+numbers of connections and requests, time of the last request and of the
+last status update. Any process of the host can attach to a board by its
+name and poll it, without sockets nor files (eg polos_server_ui).
+
+Each slot is written by one process only, through a StatusSlot, which is
+a status handler of sync_trigger_server that also counts connections and
+requests. Writes never block: they are guarded by a sequence lock. The
+writer makes the slot sequence number odd, updates the slot, then makes
+it even again. Readers copy the slot and retry if the sequence number
+was odd or changed meanwhile.
+
+Board layout:
+    - header: STATUS_BOARD_HEADER (magic, version, slot size, number of
+      slots), padded to STATUS_BOARD_HEADER_SIZE
+    - slots: SLOT_DTYPE records
+"""
+import os
+import time
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from ._polos import STATUS_ERROR
+
+STATUS_BOARD_MAGIC = b'PLSB'
+STATUS_BOARD_VERSION = 1
+STATUS_BOARD_HEADER = struct.Struct('<4sHHI')
+STATUS_BOARD_HEADER_SIZE = 64 # slots aligned on cache lines
+STATUS_BOARD_DEFAULT_NAME = 'polos_status'
+
+STATUS_NONE = -1 # status not set yet
+SLOT_MESSAGE_SIZE = 200
+SLOT_DTYPE = np.dtype([('seq', '<i8'), ('status', '<i8'), ('pid', '<i8'),
+                       ('ts_updated', '<i8'), ('nb_connections', '<i8'),
+                       ('nb_requests', '<i8'), ('ts_last_request', '<i8'),
+                       ('message', 'S%d' % SLOT_MESSAGE_SIZE)])
+# Index of integer fields in a slot, in 8-byte words
+SLOT_WORDS = {name : SLOT_DTYPE.fields[name][1] // 8 \
+              for name in SLOT_DTYPE.names if name != 'message'}
+
+# Names of the boards created by this process (or its parent, if forked),
+# which must stay registered to the resource tracker when attached to
+_created_names = set()
+
+class StatusBoardBusyError(Exception): pass
+
+class StatusBoard:
+    """
+    Status board of nb_slots slots in shared memory.
+    If create is False, attach to the existing board of the given name
+    instead. Otherwise the name is given by the system if None.
+    The creator must call close(unlink=True) when done.
+    """
+    READ_TIMEOUT = 0.1 # second
+
+    def __init__(self, nb_slots=1, name=None, create=True):
+        if create:
+            assert(nb_slots > 0)
+            size = STATUS_BOARD_HEADER_SIZE + nb_slots * SLOT_DTYPE.itemsize
+            self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=size)
+            STATUS_BOARD_HEADER.pack_into(self.shm.buf, 0,
+                                          STATUS_BOARD_MAGIC,
+                                          STATUS_BOARD_VERSION,
+                                          SLOT_DTYPE.itemsize, nb_slots)
+            _created_names.add(self.shm.name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if self.shm.name not in _created_names:
+                # Other processes must not destroy the board when they exit
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            magic, version, slot_size, nb_slots = \
+                STATUS_BOARD_HEADER.unpack_from(self.shm.buf, 0)
+            if magic != STATUS_BOARD_MAGIC:
+                self.shm.close()
+                raise ValueError('%s is not a status board' % name)
+            if version != STATUS_BOARD_VERSION or \
+               slot_size != SLOT_DTYPE.itemsize:
+                self.shm.close()
+                raise ValueError('%s: unsupported status board version %d' % \
+                                 (name, version))
+        self.name = self.shm.name
+        self.nb_slots = nb_slots
+        self.slots = np.ndarray(nb_slots, dtype=SLOT_DTYPE,
+                                buffer=self.shm.buf,
+                                offset=STATUS_BOARD_HEADER_SIZE)
+        # Integer view, a lot faster than NumPy to write single items
+        self.words = self.shm.buf.cast('q')
+        if create:
+            self.slots['status'] = STATUS_NONE
+
+    def get_slot(self, islot):
+        """ Return the StatusSlot writing the given slot """
+        return StatusSlot(self, islot)
+
+    def read_slot(self, islot):
+        """
+        Return a consistent copy of the given slot, as a dict:
+        status (None if not set), message, pid, ts_updated (ns),
+        nb_connections, nb_requests, ts_last_request (ns).
+        Raise StatusBoardBusyError if it stays locked by its writer for
+        READ_TIMEOUT.
+        """
+        seqs = self.slots['seq']
+        ts_end = None
+        while True:
+            seq = int(seqs[islot])
+            if seq % 2 == 0:
+                slot = self.slots[islot].copy()
+                if int(seqs[islot]) == seq:
+                    break
+            # Let the writer finish, in case it runs on the same CPU
+            if ts_end is None:
+                ts_end = time.perf_counter() + StatusBoard.READ_TIMEOUT
+            elif time.perf_counter() > ts_end:
+                raise StatusBoardBusyError('Slot %d of %s locked' % \
+                                           (islot, self.name))
+            os.sched_yield()
+        status = int(slot['status'])
+        return {'status' : status if status != STATUS_NONE else None,
+                'message' : slot['message'].decode(errors='ignore'),
+                'pid' : int(slot['pid']),
+                'ts_updated' : int(slot['ts_updated']),
+                'nb_connections' : int(slot['nb_connections']),
+                'nb_requests' : int(slot['nb_requests']),
+                'ts_last_request' : int(slot['ts_last_request'])}
+
+    def read_all(self):
+        return [self.read_slot(islot) for islot in range(self.nb_slots)]
+
+    def close(self, unlink=False):
+        # Views must be released before closing the shared memory
+        del self.slots
+        self.words.release()
+        self.shm.close()
+        if unlink:
+            _created_names.discard(self.shm.name)
+            self.shm.unlink()
+
+
+class StatusSlot:
+    """
+    Writer of a slot of a StatusBoard, to use as status_handler of a
+    server. Only one process must write a given slot.
+    """
+    def __init__(self, board, islot):
+        assert(0 <= islot < board.nb_slots)
+        self.board = board
+        self.islot = islot
+        first_word = (STATUS_BOARD_HEADER_SIZE + \
+                      islot * SLOT_DTYPE.itemsize) // 8
+        self._iseq = first_word + SLOT_WORDS['seq']
+        self._istatus = first_word + SLOT_WORDS['status']
+        self._ipid = first_word + SLOT_WORDS['pid']
+        self._its_updated = first_word + SLOT_WORDS['ts_updated']
+        self._inb_connections = first_word + SLOT_WORDS['nb_connections']
+        self._inb_requests = first_word + SLOT_WORDS['nb_requests']
+        self._its_last_request = first_word + SLOT_WORDS['ts_last_request']
+
+    def set_status(self, status, message):
+        message = message.encode()[:SLOT_MESSAGE_SIZE]
+        words = self.board.words
+        words[self._iseq] += 1
+        words[self._istatus] = status
+        self.board.slots['message'][self.islot] = message
+        words[self._ipid] = os.getpid()
+        words[self._its_updated] = time.time_ns()
+        words[self._iseq] += 1
+
+    def get_status(self):
+        slot = self.board.read_slot(self.islot)
+        if slot['status'] is None:
+            return STATUS_ERROR, slot['message']
+        return slot['status'], slot['message']
+
+    def count_connection(self):
+        words = self.board.words
+        words[self._iseq] += 1
+        words[self._inb_connections] += 1
+        words[self._iseq] += 1
+
+    def reset_counters(self):
+        """ Reset the numbers of connections and requests """
+        words = self.board.words
+        words[self._iseq] += 1
+        words[self._inb_connections] = 0
+        words[self._inb_requests] = 0
+        words[self._iseq] += 1
+
+    def count_request(self, ts_receive):
+        """ Count a request received at the given time, in ns """
+        words = self.board.words
+        words[self._iseq] += 1
+        words[self._inb_requests] += 1
+        words[self._its_last_request] = ts_receive
+        words[self._iseq] += 1
@@ -0,0 +1,248 @@
+"""
+Multi-process Synchronized Trigger Server (STS), for many clients.
+
+A STServerSupervisor starts several STServerProcess workers bound to the
+same port with SO_REUSEPORT. The kernel distributes incoming connections
+and datagrams among them, so that clients are served in parallel, each
+worker keeping its single-threaded loop. Each worker is pinned to its own
+CPU. The supervisor restarts workers which exit, and merges their status.
+"""
+import os
+import time
+import logging
+from collections import deque
+from threading import Thread, Event
+from multiprocessing import Value, Array
+
+from ._polos import STATUS_OK, STATUS_ERROR, STATUS_WARNING
+from .server import STServerProcess, STS_DEFAULT_PORT, STS_DEFAULT_NAME
+from .server import format_duration
+
+logger = logging.getLogger('polos')
+
+def get_worker_callback(callback, iworker):
+    """
+    Return the callback of the given worker: callback.for_worker(iworker)
+    if defined, else callback itself
+    """
+    for_worker = getattr(callback, 'for_worker', None)
+    if for_worker is None:
+        return callback
+    return for_worker(iworker)
+
+class SharedStatus:
+    """ Status handler of a server process, readable by its parent """
+
+    MESSAGE_SIZE = 256
+
+    def __init__(self):
+        self.status = Value('i', STATUS_ERROR)
+        self.message = Array('c', SharedStatus.MESSAGE_SIZE)
+
+    def set_status(self, status, message):
+        with self.status.get_lock():
+            self.status.value = status
+            self.message.value = message.encode()[:self.MESSAGE_SIZE - 1]
+
+    def get_status(self):
+        with self.status.get_lock():
+            return self.status.value, self.message.value.decode()
+
+
+class STServerSupervisor(Thread):
+    """
+    Run nb_workers STServerProcess sharing the same port, and restart them
+    when they exit, in a background thread.
+
+    Workers are pinned to the given CPUs, one each, cycling over them if
+    there are fewer CPUs than workers. If realtime is given (see
+    polos.realtime), the rest of the real-time profile is also applied to
+    workers. Other arguments are those of STServerProcess.
+
+    If status_board is given (see polos.statusboard), with at least
+    nb_workers slots, worker i publishes its status and counters in
+    slot i, so that other processes can monitor workers.
+
+    Callbacks having a for_worker(iworker) method, eg TimestampSaver, are
+    replaced by the result of this method in worker iworker, so that
+    workers do not share state such as a timestamp log.
+
+    Note: a client sending STS_QUIT only stops the worker serving it, which
+    is then restarted. Use stop() to stop all workers.
+
+    Workers which crash (non-zero exit code, eg the port cannot be bound
+    or a callback fails) are restarted at once the first time, then after
+    a delay doubling from check_interval up to RESTART_BACKOFF_MAX. After
+    MAX_CRASHES crashes within CRASH_WINDOW, the worker is given up.
+
+    >>> supervisor = STServerSupervisor(nb_workers=4)   #doctest: +SKIP
+    >>> supervisor.start()                              #doctest: +SKIP
+    >>> supervisor.get_status()                         #doctest: +SKIP
+    >>> supervisor.stop()                               #doctest: +SKIP
+    """
+
+    MAX_CRASHES = 5 # within CRASH_WINDOW, before giving up on a worker
+    CRASH_WINDOW = 60. # second
+    RESTART_BACKOFF_MAX = 10. # second
+
+    def __init__(self, port=STS_DEFAULT_PORT, nb_workers=None, cpus=None,
+                 callback1=None, callback2=None, receive_timeout=1.,
+                 server_name=STS_DEFAULT_NAME, udp=False,
+                 kernel_timestamps=False, async_callbacks=False,
+                 realtime=None, check_interval=0.2, status_board=None,
+                 channels=None):
+        super().__init__(daemon=True)
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0))
+        if nb_workers is None:
+            nb_workers = len(cpus)
+        assert(nb_workers > 0 and len(cpus) > 0)
+
+        self.port = port
+        self.nb_workers = nb_workers
+        self.cpus = [cpus[iworker % len(cpus)] \
+                     for iworker in range(nb_workers)]
+        self.server_name = server_name
+        self.check_interval = check_interval
+
+        # Options of apply_realtime_profile, only pinning by default
+        if realtime is None:
+            realtime = {'priority' : None, 'lock' : False, 'gc_mode' : None,
+                        'prefault_size' : 0}
+        elif realtime is True:
+            realtime = {}
+        self.worker_options = dict(receive_timeout=receive_timeout, udp=udp,
+                                   kernel_timestamps=kernel_timestamps,
+                                   async_callbacks=async_callbacks)
+        # Kept across restarts of a worker
+        self.worker_callbacks = []
+        for iworker in range(nb_workers):
+            worker_channels = None
+            if channels is not None:
+                worker_channels = {channel : get_worker_callback(callback,
+                                                                 iworker) \
+                                   for channel, callback in channels.items()}
+            self.worker_callbacks.append(
+                dict(callback1=get_worker_callback(callback1, iworker),
+                     callback2=get_worker_callback(callback2, iworker),
+                     channels=worker_channels))
+        self.realtime = realtime
+
+        self.workers = [None] * nb_workers
+        if status_board is not None:
+            assert(status_board.nb_slots >= nb_workers)
+            self.worker_statuses = [status_board.get_slot(iworker) \
+                                    for iworker in range(nb_workers)]
+        else:
+            self.worker_statuses = [SharedStatus() \
+                                    for _ in range(nb_workers)]
+        self.nb_restarts = 0
+        # Per worker: monotonic times of recent crashes, time of the pending
+        # restart (None if none), and whether it was given up
+        self.crash_times = [deque() for _ in range(nb_workers)]
+        self.restart_times = [None] * nb_workers
+        self.given_up = [False] * nb_workers
+        self.finished = Event()
+
+    def get_port(self):
+        return self.port
+
+    def start_worker(self, iworker):
+        realtime = dict(self.realtime, cpus=[self.cpus[iworker]])
+        worker = STServerProcess(port=self.port,
+                                 server_name='%s-%d' % (self.server_name,
+                                                        iworker),
+                                 status_handler=self.worker_statuses[iworker],
+                                 realtime=realtime, reuse_port=True,
+                                 **self.worker_options,
+                                 **self.worker_callbacks[iworker])
+        worker.daemon = True
+        worker.start()
+        self.workers[iworker] = worker
+        logger.info('%s started worker %d (pid %d) on CPU %d',
+                    self.server_name, iworker, worker.pid,
+                    self.cpus[iworker])
+
+    def run(self):
+        for iworker in range(self.nb_workers):
+            self.start_worker(iworker)
+        while not self.finished.wait(self.check_interval):
+            for iworker, worker in enumerate(self.workers):
+                if worker.is_alive() or self.given_up[iworker] or \
+                   self.finished.is_set():
+                    continue
+                if self.restart_times[iworker] is None:
+                    self.schedule_restart(iworker)
+                    continue
+                if time.monotonic() >= self.restart_times[iworker]:
+                    self.restart_times[iworker] = None
+                    self.nb_restarts += 1
+                    self.start_worker(iworker)
+
+    def schedule_restart(self, iworker):
+        """
+        Set the restart time of the given exited worker, backing off if it
+        crashed recently, or give it up if it crashed too often.
+        """
+        now = time.monotonic()
+        exitcode = self.workers[iworker].exitcode
+        delay = 0.
+        if exitcode != 0:
+            crash_times = self.crash_times[iworker]
+            while crash_times and \
+                  crash_times[0] < now - STServerSupervisor.CRASH_WINDOW:
+                crash_times.popleft()
+            crash_times.append(now)
+            if len(crash_times) > STServerSupervisor.MAX_CRASHES:
+                logger.error('%s worker %d crashed %d times within %s '\
+                             '(last exit code %s), giving it up',
+                             self.server_name, iworker, len(crash_times),
+                             format_duration(STServerSupervisor.CRASH_WINDOW),
+                             exitcode)
+                self.given_up[iworker] = True
+                return
+            if len(crash_times) > 1:
+                delay = min(self.check_interval * 2**(len(crash_times) - 2),
+                            STServerSupervisor.RESTART_BACKOFF_MAX)
+        logger.warning('%s worker %d exited with code %s, restarting it '\
+                       'in %s', self.server_name, iworker, exitcode,
+                       format_duration(delay))
+        self.restart_times[iworker] = now + delay
+
+    def stop(self, timeout=1.):
+        """ Stop supervision and terminate all workers """
+        self.finished.set()
+        if self.is_alive():
+            self.join(timeout)
+        for worker in self.workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+                worker.join(timeout)
+
+    def get_worker_statuses(self):
+        return [status.get_status() for status in self.worker_statuses]
+
+    def get_status(self):
+        """
+        Merged status: OK if all workers are serving, WARNING if some
+        are (eg others being restarted), else ERROR.
+        """
+        nb_serving = 0
+        nb_connected = 0
+        for worker, (status, _) in zip(self.workers,
+                                       self.get_worker_statuses()):
+            if worker is not None and worker.is_alive() and \
+               status != STATUS_ERROR:
+                nb_serving += 1
+                nb_connected += status == STATUS_OK
+        if nb_serving == self.nb_workers:
+            status = STATUS_OK
+        elif nb_serving > 0:
+            status = STATUS_WARNING
+        else:
+            status = STATUS_ERROR
+        message = '%d/%d workers serving, %d connected, %d restarts' % \
+                  (nb_serving, self.nb_workers, nb_connected, self.nb_restarts)
+        if any(self.given_up):
+            message += ', %d given up' % sum(self.given_up)
+        return status, message
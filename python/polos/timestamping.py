@@ -0,0 +1,131 @@
+"""
+Kernel socket timestamps (Linux).
+
+The kernel can stamp packets when they are received (SO_TIMESTAMPNS) and
+when they are handed to the network device (SO_TIMESTAMPING). These
+timestamps do not include the scheduler wake-up latency and the Python
+overhead which are in user-space timestamps taken around recv / send.
+
+All timestamps are CLOCK_REALTIME values in nanoseconds, ie comparable
+with time.time_ns(). Functions return None / False when kernel timestamps
+are not supported, so that callers can fall back to user-space timestamps.
+"""
+import socket
+import struct
+import logging
+
+logger = logging.getLogger('polos')
+
+# Values from linux/asm-generic/socket.h and linux/net_tstamp.h,
+# which are not all exposed by the socket module
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+SO_TIMESTAMPING = getattr(socket, 'SO_TIMESTAMPING', 37)
+SCM_TIMESTAMPING = SO_TIMESTAMPING
+MSG_ERRQUEUE = getattr(socket, 'MSG_ERRQUEUE', 0x2000)
+
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_OPT_ID = 1 << 7
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11
+
+TX_TIMESTAMPING_FLAGS = SOF_TIMESTAMPING_TX_SOFTWARE | \
+                        SOF_TIMESTAMPING_SOFTWARE | \
+                        SOF_TIMESTAMPING_OPT_ID | \
+                        SOF_TIMESTAMPING_OPT_TSONLY
+
+# struct timespec, using native long (32 or 64 bits)
+TIMESPEC = struct.Struct('@ll')
+# struct sock_extended_err: errno, origin, type, code, pad, info, data
+SOCK_EXTENDED_ERR = struct.Struct('@IBBBBII')
+SO_EE_ORIGIN_TIMESTAMPING = 4
+
+ANCILLARY_BUFFER_SIZE = 256
+
+def enable_rx_timestamps(sock):
+    """
+    Ask the kernel to stamp packets received by the given socket.
+    Return True if supported.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except (OSError, AttributeError) as e:
+        logger.warning('Kernel receive timestamps not supported: %s', e)
+        return False
+    return hasattr(sock, 'recvmsg')
+
+def enable_tx_timestamps(sock):
+    """
+    Ask the kernel to stamp packets sent by the given socket.
+    Timestamps are then read with get_tx_timestamps.
+    Return True if supported.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING,
+                        TX_TIMESTAMPING_FLAGS)
+    except (OSError, AttributeError) as e:
+        logger.warning('Kernel transmit timestamps not supported: %s', e)
+        return False
+    return hasattr(sock, 'recvmsg')
+
+def recv_timestamped(sock, buffer_size):
+    """
+    Receive data from the given socket, along with the kernel receive
+    timestamp (see enable_rx_timestamps).
+
+    Return (data, address, timestamp in ns). The timestamp is None if
+    the kernel did not provide it.
+    """
+    data, ancillary, _, address = sock.recvmsg(buffer_size,
+                                               ANCILLARY_BUFFER_SIZE)
+    for level, ancillary_type, ancillary_data in ancillary:
+        if level == socket.SOL_SOCKET and ancillary_type == SCM_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack_from(ancillary_data)
+            return data, address, sec * 1000000000 + nsec
+    return data, address, None
+
+def recv_into_timestamped(sock, buffer):
+    """
+    Same as recv_timestamped, but receive into the given buffer.
+    Return (number of bytes received, address, timestamp in ns).
+    """
+    nb_bytes, ancillary, _, address = sock.recvmsg_into([buffer],
+                                                        ANCILLARY_BUFFER_SIZE)
+    for level, ancillary_type, ancillary_data in ancillary:
+        if level == socket.SOL_SOCKET and ancillary_type == SCM_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack_from(ancillary_data)
+            return nb_bytes, address, sec * 1000000000 + nsec
+    return nb_bytes, address, None
+
+def get_tx_timestamps(sock):
+    """
+    Read all pending kernel transmit timestamps of the given socket
+    (see enable_tx_timestamps), without blocking.
+
+    Return a list of (key, timestamp in ns), in sending order.
+    The key is the index of the sent datagram for UDP sockets, and the
+    offset of the last sent byte for TCP sockets, counted from when
+    timestamps were enabled.
+    """
+    timestamps = []
+    while True:
+        try:
+            _, ancillary, _, _ = sock.recvmsg(0, ANCILLARY_BUFFER_SIZE,
+                                              MSG_ERRQUEUE | \
+                                              socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            break
+        ts, key = None, None
+        for level, ancillary_type, ancillary_data in ancillary:
+            if level == socket.SOL_SOCKET and \
+               ancillary_type == SCM_TIMESTAMPING:
+                # Software timestamp is the first of 3 timespec
+                sec, nsec = TIMESPEC.unpack_from(ancillary_data)
+                ts = sec * 1000000000 + nsec
+            elif len(ancillary_data) >= SOCK_EXTENDED_ERR.size:
+                err = SOCK_EXTENDED_ERR.unpack_from(ancillary_data)
+                if err[1] == SO_EE_ORIGIN_TIMESTAMPING:
+                    key = err[6]
+        if ts is not None:
+            timestamps.append((key, ts))
+    return timestamps
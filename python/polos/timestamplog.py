@@ -0,0 +1,217 @@
+"""
+Append-only binary log of trigger timestamps.
+
+A TimestampLog appends time.time_ns() values, as fixed-size records, to a
+preallocated memory-mapped file. Appending a timestamp is a store into
+memory: no file is created, no system call is made, except when the
+preallocated space is full, where the file is doubled.
+
+File layout:
+    - header: TIMESTAMP_LOG_HEADER (magic, version, record size, number of
+      records). The number of records is updated after each append.
+    - records: int64 timestamps in ns, in the order they were appended,
+      followed by the unused preallocated space.
+
+The last timestamp is read in O(1), and ranges by index or by time
+(get_range, get_between). A log can be read while another process of the
+same host appends to it, eg a server process started by the test, but
+must be written by one thread only: appends update the number of records
+without any lock. Server processes sharing a port (see
+polos.supervisor) therefore each write their own log, named after
+their worker index (see get_log_filename).
+
+convert_timestamp_directory converts the layout of the former
+TimestampSaver, one empty file prefix_<time in second> per trigger, to a
+log.
+"""
+import os
+import os.path as op
+import time
+import mmap
+import struct
+from glob import glob
+
+import numpy as np
+
+TIMESTAMP_LOG_MAGIC = b'PLTS'
+TIMESTAMP_LOG_VERSION = 1
+TIMESTAMP_LOG_HEADER = struct.Struct('<4sHHQ')
+TIMESTAMP_LOG_EXTENSION = '.tslog'
+TIMESTAMP_DTYPE = np.dtype('<i8')
+
+def get_log_filename(directory, prefix, worker=None):
+    """
+    Return the file name of the log with the given prefix, written by the
+    given worker process if not None
+    """
+    if worker is not None:
+        prefix += '.w%d' % worker
+    return op.join(directory, prefix + TIMESTAMP_LOG_EXTENSION)
+
+class TimestampLog:
+    """
+    Append-only log of timestamps, in ns, memory-mapped from filename.
+    An existing log is opened and appended to. Space for capacity
+    records is preallocated, and doubled when it is full.
+    Calling the log appends the current time, so that it can be used as
+    a trigger callback.
+    """
+    DEFAULT_CAPACITY = 2**12
+
+    def __init__(self, filename, capacity=DEFAULT_CAPACITY):
+        assert(capacity > 0)
+        self.filename = filename
+        directory = op.dirname(filename)
+        if directory != '' and not op.exists(directory):
+            os.makedirs(directory)
+        if op.exists(filename):
+            self.fd = os.open(filename, os.O_RDWR)
+            header = os.pread(self.fd, TIMESTAMP_LOG_HEADER.size, 0)
+            check_header(filename, header)
+            capacity = max(capacity, self._get_file_capacity())
+        else:
+            self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            os.pwrite(self.fd,
+                      TIMESTAMP_LOG_HEADER.pack(TIMESTAMP_LOG_MAGIC,
+                                                TIMESTAMP_LOG_VERSION,
+                                                TIMESTAMP_DTYPE.itemsize, 0),
+                      0)
+        self._map(capacity)
+
+    def _get_file_capacity(self):
+        return (os.fstat(self.fd).st_size - TIMESTAMP_LOG_HEADER.size) // \
+            TIMESTAMP_DTYPE.itemsize
+
+    def _map(self, capacity):
+        """ Map the file, grown to hold capacity records if needed """
+        if self._get_file_capacity() < capacity:
+            os.ftruncate(self.fd, TIMESTAMP_LOG_HEADER.size + \
+                         capacity * TIMESTAMP_DTYPE.itemsize)
+        self.capacity = capacity
+        self.mmap = mmap.mmap(self.fd, TIMESTAMP_LOG_HEADER.size + \
+                              capacity * TIMESTAMP_DTYPE.itemsize)
+        # Number of records, after magic, version and record size
+        self._count = np.frombuffer(self.mmap, dtype='<u8', count=1,
+                                    offset=8)
+        self.timestamps = np.frombuffer(self.mmap, dtype=TIMESTAMP_DTYPE,
+                                        count=capacity,
+                                        offset=TIMESTAMP_LOG_HEADER.size)
+
+    def _unmap(self):
+        # Views must be released before closing the map
+        del self._count
+        del self.timestamps
+        self.mmap.close()
+
+    def _remap(self, capacity):
+        self._unmap()
+        self._map(capacity)
+
+    def __call__(self):
+        self.append(time.time_ns())
+
+    def append(self, ts):
+        """ Append the given timestamp, in ns """
+        count = int(self._count[0])
+        if count == self.capacity:
+            self._remap(2 * self.capacity)
+        self.timestamps[count] = ts
+        self._count[0] = count + 1
+
+    def _refresh(self):
+        """ Remap if another process appended beyond the mapped capacity """
+        if int(self._count[0]) > self.capacity:
+            self._remap(self._get_file_capacity())
+
+    def __len__(self):
+        self._refresh()
+        return int(self._count[0])
+
+    def __getitem__(self, index):
+        """ Return the timestamp at the given index, in ns """
+        count = len(self)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError('timestamp index out of range')
+        return int(self.timestamps[index])
+
+    def get_last(self):
+        """ Return the last timestamp, in ns, None if the log is empty """
+        count = len(self)
+        if count == 0:
+            return None
+        return int(self.timestamps[count - 1])
+
+    def get_range(self, start=0, stop=None):
+        """ Return a copy of the timestamps from start to stop, in ns """
+        return self.timestamps[:len(self)][start:stop].copy()
+
+    def get_between(self, ts_start, ts_end):
+        """
+        Return a copy of the timestamps in [ts_start, ts_end[, in ns.
+        Found by binary search, assuming that timestamps are increasing.
+        """
+        timestamps = self.timestamps[:len(self)]
+        istart, iend = np.searchsorted(timestamps, [ts_start, ts_end])
+        return timestamps[istart:iend].copy()
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self._unmap()
+        os.close(self.fd)
+        self.fd = None
+
+
+def check_header(filename, header):
+    if len(header) < TIMESTAMP_LOG_HEADER.size:
+        raise ValueError('%s: truncated timestamp log header' % filename)
+    magic, version, record_size, _ = TIMESTAMP_LOG_HEADER.unpack(header)
+    if magic != TIMESTAMP_LOG_MAGIC:
+        raise ValueError('%s is not a timestamp log' % filename)
+    if version != TIMESTAMP_LOG_VERSION or \
+       record_size != TIMESTAMP_DTYPE.itemsize:
+        raise ValueError('%s: unsupported timestamp log version %d' % \
+                         (filename, version))
+
+def read_timestamp_log(filename):
+    """ Return the timestamps of the given log, in ns """
+    with open(filename, 'rb') as fin:
+        header = fin.read(TIMESTAMP_LOG_HEADER.size)
+        check_header(filename, header)
+        count = TIMESTAMP_LOG_HEADER.unpack(header)[3]
+        return np.fromfile(fin, dtype=TIMESTAMP_DTYPE, count=count)
+
+def get_ts_from_legacy_filename(ts_fn):
+    """ Return the time, in second, of a file of the former layout """
+    return float(op.split(ts_fn)[1].split('_')[1])
+
+def convert_timestamp_directory(directory, prefix, filename=None,
+                                remove=False):
+    """
+    Append the timestamps of the files prefix_<time in second> of the
+    given directory, in time order, to the log filename (default:
+    get_log_filename(directory, prefix)).
+    If remove is True, the converted files are removed.
+    Return the number of converted timestamps.
+    """
+    if filename is None:
+        filename = get_log_filename(directory, prefix)
+    ts_fns = glob(op.join(directory, prefix + '_*'))
+    timestamps = sorted((get_ts_from_legacy_filename(ts_fn), ts_fn) \
+                        for ts_fn in ts_fns)
+    log = TimestampLog(filename, capacity=max(1, len(timestamps)))
+    try:
+        for ts, _ in timestamps:
+            log.append(round(ts * 1e9))
+        log.flush()
+    finally:
+        log.close()
+    if remove:
+        for _, ts_fn in timestamps:
+            os.remove(ts_fn)
+    return len(timestamps)
@@ -0,0 +1,158 @@
+"""
+Per-stage tracing of the trigger path, exported in Chrome trace format.
+
+A Tracer records spans (stage, start, end, argument) timed with
+time.perf_counter_ns in a preallocated ring buffer. The server records
+the select wake-up, recv, dispatch, callback and reply sending of binary
+requests; clients record request sending, reply waiting, and for
+STClient the spin-wait and the local callback (see the STAGE_* codes).
+
+Spans are converted to wall-clock time with an anchor taken when the
+tracer is created, then to the reference clock (usually the server one)
+by adding the tracer offset, in second. ST_NTPClient sets the offset of
+its tracer when it estimates the clock offset.
+
+Traces are dumped with Tracer.dump, read with read_trace, and merged by
+write_chrome_trace in a JSON file that chrome://tracing or Perfetto
+(ui.perfetto.dev) can open.
+
+Like EventLogger, a tracer must be written by one thread only.
+"""
+import time
+import json
+
+import numpy as np
+
+SPAN_DTYPE = np.dtype([('stage', '<u2'), ('start', '<i8'), ('end', '<i8'),
+                       ('arg', '<i8')])
+
+# Server stages
+STAGE_SELECT = 1 # waiting in select, up to its wake-up
+STAGE_RECV = 2 # arg: number of bytes received
+STAGE_DISPATCH = 3 # decoding and callback lookup, arg: sequence number
+STAGE_CALLBACK = 4 # arg: sequence number
+STAGE_SEND = 5 # sending of the reply, arg: sequence number
+STAGE_SPIN = 6 # busy-wait of a scheduled trigger, arg: sequence number
+# Client stages
+STAGE_CLIENT_SEND = 16 # arg: sequence number
+STAGE_CLIENT_RECV = 17 # waiting for the reply, arg: sequence number
+STAGE_CLIENT_SPIN = 18 # busy-wait before the local trigger
+STAGE_LOCAL_CALLBACK = 19
+
+STAGE_NAMES = {STAGE_SELECT : 'select',
+               STAGE_RECV : 'recv',
+               STAGE_DISPATCH : 'dispatch',
+               STAGE_CALLBACK : 'callback',
+               STAGE_SEND : 'send',
+               STAGE_SPIN : 'spin',
+               STAGE_CLIENT_SEND : 'client_send',
+               STAGE_CLIENT_RECV : 'client_recv',
+               STAGE_CLIENT_SPIN : 'client_spin',
+               STAGE_LOCAL_CALLBACK : 'local_callback'}
+
+class Tracer:
+    """
+    Ring buffer of the last size spans, in perf_counter_ns time.
+
+    If filename is given, servers dump the trace to it when they stop,
+    which is the way to get the trace of a server running in another
+    process.
+    """
+    DEFAULT_SIZE = 2**16
+
+    def __init__(self, name, size=DEFAULT_SIZE, filename=None, offset=0.):
+        assert(size > 0)
+        self.name = name
+        self.size = size
+        self.filename = filename
+        self.offset = offset # to add to map to the reference clock, in sec
+        self.spans = np.zeros(size, dtype=SPAN_DTYPE)
+        # Field views, faster to write than records
+        self._stages = self.spans['stage']
+        self._starts = self.spans['start']
+        self._ends = self.spans['end']
+        self._args = self.spans['arg']
+        self.nb_spans = 0
+        # Read back to back, to convert perf_counter_ns to wall-clock time
+        self.anchor_wall = time.time_ns()
+        self.anchor_perf = time.perf_counter_ns()
+
+    def trace(self, stage, ts_start, ts_end, arg=0):
+        """ Record a span, with perf_counter_ns times """
+        ispan = self.nb_spans % self.size
+        self._stages[ispan] = stage
+        self._starts[ispan] = ts_start
+        self._ends[ispan] = ts_end
+        self._args[ispan] = arg
+        self.nb_spans += 1
+
+    def trace_request(self, seq, ts_start, ts_dispatched, ts_called,
+                      ts_sent):
+        """
+        Record the dispatch, callback (if any) and send spans of a request
+        """
+        self.trace(STAGE_DISPATCH, ts_start, ts_dispatched, seq)
+        if ts_called > ts_dispatched:
+            self.trace(STAGE_CALLBACK, ts_dispatched, ts_called, seq)
+        self.trace(STAGE_SEND, ts_called, ts_sent, seq)
+
+    def reset(self):
+        self.nb_spans = 0
+
+    def get_spans(self):
+        """ Return a copy of the spans, oldest first, in wall-clock ns """
+        if self.nb_spans <= self.size:
+            spans = self.spans[:self.nb_spans].copy()
+        else:
+            ioldest = self.nb_spans % self.size
+            spans = np.concatenate((self.spans[ioldest:],
+                                    self.spans[:ioldest]))
+        for field in ('start', 'end'):
+            spans[field] += self.anchor_wall - self.anchor_perf
+        return spans
+
+    def get_trace(self):
+        """ Return (name, spans in wall-clock ns, offset in second) """
+        return self.name, self.get_spans(), self.offset
+
+    def dump(self, filename=None):
+        """ Write the trace to the given .npz file (default: filename) """
+        if filename is None:
+            filename = self.filename
+        with open(filename, 'wb') as fout:
+            np.savez(fout, name=self.name, spans=self.get_spans(),
+                     offset=self.offset)
+
+
+def read_trace(filename):
+    """ Read a trace written by Tracer.dump. Return (name, spans, offset) """
+    with np.load(filename) as trace:
+        return str(trace['name']), trace['spans'], float(trace['offset'])
+
+def to_chrome_events(traces):
+    """
+    Return Chrome trace events of the given traces, each one being
+    (name, spans, offset), with times mapped to the reference clock.
+    Each trace is shown as a process.
+    """
+    events = []
+    for pid, (name, spans, offset) in enumerate(traces, 1):
+        events.append({'name' : 'process_name', 'ph' : 'M', 'pid' : pid,
+                       'tid' : 0, 'args' : {'name' : name}})
+        offset_ns = round(offset * 1e9)
+        for stage, ts_start, ts_end, arg in spans:
+            events.append({'name' : STAGE_NAMES.get(stage, str(stage)),
+                           'ph' : 'X', 'pid' : pid, 'tid' : 0,
+                           'ts' : (int(ts_start) + offset_ns) / 1e3,
+                           'dur' : int(ts_end - ts_start) / 1e3,
+                           'args' : {'arg' : int(arg)}})
+    return events
+
+def write_chrome_trace(filename, traces):
+    """
+    Merge the given traces, each one being (name, spans, offset) as given
+    by Tracer.get_trace or read_trace, in a Chrome trace JSON file.
+    """
+    with open(filename, 'w') as fout:
+        json.dump({'traceEvents' : to_chrome_events(traces),
+                   'displayTimeUnit' : 'ns'}, fout)
@@ -14,7 +14,14 @@ setup(name='polos',
       scripts=['scripts/polos_client_checks', 'scripts/polos_spam_time',
                'scripts/polos_send_ts_gpio', 'scripts/polos_server_ui',
                'scripts/polos_sync_trigger_server',
-               'scripts/polos_sync_trigger_request'],
+               'scripts/polos_sync_trigger_request',
+               'scripts/polos_estimator_benchmark',
+               'scripts/polos_merge_traces',
+               'scripts/polos_server_benchmark',
+               'scripts/polos_trigger_selftest',
+               'scripts/polos_convert_timestamps',
+               'scripts/polos_impairment_proxy',
+               'scripts/polos_clock_share'],
       classifiers=[
           "Development Status :: 3 - Alpha",
           "Environment :: Console",
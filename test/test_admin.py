@@ -0,0 +1,122 @@
+import unittest
+import time
+import sys
+from threading import Thread
+from multiprocessing import Value
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+from polos.admin import AdminChannel, AdminError
+from polos.admin import ADMIN_STOP, ADMIN_DUMP_METRICS
+from polos.server import STServerProcess, STServerThread, STClient
+from polos.server import STS_CALLBACK_2, STS_WIRE_V1
+from polos.statusboard import StatusBoard
+
+# Shared with the server process, set by a callback given by reference
+fire_counter = Value('i', 0)
+
+def fire():
+    fire_counter.value += 1
+
+class AdminTest(unittest.TestCase):
+
+    def setUp(self):
+        self.admin = AdminChannel()
+        self.to_close = [self.admin]
+
+    def tearDown(self):
+        for obj in self.to_close[::-1]:
+            obj.close()
+
+    def test_thread_server(self):
+        fired = []
+        server = STServerThread(port=8971, receive_timeout=None,
+                                admin=self.admin,
+                                metrics_address=('localhost', 8972))
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = STClient(lambda: None, channel=4, wire_format=STS_WIRE_V1)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+        self.assertRaises(Exception, client.request, nb_trials=2)
+
+        # Same process: any callable can be set
+        self.admin.set_callback(4, lambda: fired.append(4))
+        client.request(nb_trials=2)
+        self.assertEqual(fired, [4])
+        # Probes of the client run callback2, of all channels
+        self.admin.set_callback(0, lambda: fired.append(2),
+                                command=STS_CALLBACK_2)
+        client.request(nb_trials=3)
+        self.assertEqual(fired, [4, 2, 2, 4])
+        self.admin.set_callback(4, None)
+        self.assertRaises(Exception, client.request, nb_trials=2)
+
+        self.assertIn('count=', self.admin.dump_metrics())
+        self.assertIn('sts_request_to_reply_seconds',
+                      self.admin.dump_metrics('prometheus'))
+        self.admin.reset_stats()
+        self.assertIn('count=0', self.admin.dump_metrics())
+
+        # Errors are replied, the server keeps serving
+        self.assertRaises(AdminError, self.admin.set_callback, 0, fire,
+                          command=b'2')
+        self.assertRaises(AdminError, self.admin.set_callback, 256, fire)
+        client.channel = 0
+        client.request(nb_trials=2)
+
+        # Stop while a client is connected, without waiting for it
+        ts = time.perf_counter()
+        self.admin.stop()
+        server.join(timeout=1)
+        self.assertLess(time.perf_counter() - ts, 0.5)
+        self.assertFalse(server.is_alive())
+
+    def test_process_server(self):
+        board = StatusBoard(1)
+        self.addCleanup(board.close, unlink=True)
+        server = STServerProcess(port=8973, receive_timeout=None,
+                                 admin=self.admin,
+                                 status_handler=board.get_slot(0))
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = STClient(lambda: None, channel=9, wire_format=STS_WIRE_V1)
+        client.connect('localhost', server.get_port())
+        self.admin.set_callback(9, fire)
+        client.request(nb_trials=3)
+        client.close()
+        time.sleep(0.1)
+        self.assertEqual(fire_counter.value, 1)
+        self.assertEqual(board.read_slot(0)['nb_connections'], 1)
+        self.assertRaises(AdminError, self.admin.dump_metrics)
+        self.admin.reset_stats()
+        read = board.read_slot(0)
+        self.assertEqual((read['nb_connections'], read['nb_requests']),
+                         (0, 0))
+
+        # Waiting for a connection, no timeout: stopped at once
+        ts = time.perf_counter()
+        self.admin.stop()
+        self.assertLess(time.perf_counter() - ts, 0.1)
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_late_reply(self):
+        handlers = {ADMIN_STOP : lambda: time.sleep(0.2),
+                    ADMIN_DUMP_METRICS : lambda metrics_format: \
+                                         metrics_format}
+        def serve():
+            for icommand in range(2):
+                self.admin.serve(handlers)
+        server = Thread(target=serve)
+        server.start()
+
+        self.assertRaises(AdminError, self.admin.stop, timeout=0.05)
+        # The late reply to stop is not taken for this one
+        self.assertEqual(self.admin.dump_metrics('prometheus'), 'prometheus')
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
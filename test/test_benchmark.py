@@ -0,0 +1,62 @@
+import unittest
+import sys
+import os.path as op
+import shutil
+import tempfile
+from subprocess import run
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+from polos.benchmark import run_benchmark, save_results, load_results
+from polos.benchmark import compare_results, format_result
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='polos_benchmark_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_benchmark(self):
+        results = run_benchmark(('thread', 'process'), nb_clients=(1, 2),
+                                duration=0.2, port=8950)
+        self.assertEqual([(r['mode'], r['nb_clients']) for r in results],
+                         [('thread', 1), ('thread', 2),
+                          ('process', 1), ('process', 2)])
+        for result in results:
+            self.assertGreater(result['nb_requests'], 0)
+            self.assertGreater(result['throughput'], 0)
+            self.assertLessEqual(result['p50'], result['p99'])
+            self.assertLessEqual(result['p99'], result['p999'])
+            self.assertLessEqual(result['p999'], result['max'])
+            self.assertIsNotNone(result['server_cpu'])
+            format_result(result)
+
+        results_fn = op.join(self.tmp_dir, 'results.json')
+        save_results(results, results_fn)
+        self.assertEqual(load_results(results_fn), results)
+
+        self.assertEqual(compare_results(results, results), [])
+        slower = [dict(result) for result in results]
+        slower[1]['p99'] *= 2
+        slower[2]['throughput'] /= 2
+        regressions = compare_results(slower, results)
+        self.assertEqual([(key, metric) for key, metric, _, _ in regressions],
+                         [(('thread', 'udp', 2), 'p99'),
+                          (('process', 'udp', 1), 'throughput')])
+
+    def test_script(self):
+        baseline_fn = op.join(self.tmp_dir, 'baseline.json')
+        run(['polos_server_benchmark', '-m', 'process', '-c', '1',
+             '-d', '0.2', '-p', '8951', '-o', baseline_fn], check=True)
+        baseline = load_results(baseline_fn)
+        self.assertEqual(len(baseline), 1)
+        # Unreachable baseline -> regression
+        baseline[0]['throughput'] *= 1e3
+        save_results(baseline, baseline_fn)
+        status = run(['polos_server_benchmark', '-m', 'process', '-c', '1',
+                      '-d', '0.2', '-p', '8951', '-b', baseline_fn])
+        self.assertEqual(status.returncode, 1)
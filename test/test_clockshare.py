@@ -0,0 +1,113 @@
+import unittest
+import time
+import sys
+from subprocess import run, PIPE
+from multiprocessing import Process
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import numpy as np
+
+from polos.clockshare import ClockPublisher, ClockReader
+from polos.clockshare import ClockNotPublishedError
+from polos.clocksync import ClockModel, ClockSync
+from polos.server import STServerThread, ST_NTPClient
+
+class ClockShareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = ClockPublisher()
+        self.reader = ClockReader(self.publisher.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.publisher.close(unlink=True)
+
+    def test_model(self):
+        self.assertFalse(self.reader.is_ready())
+        self.assertRaises(ClockNotPublishedError, self.reader.to_server_time,
+                          time.time_ns())
+
+        model = ClockModel()
+        t0 = time.time_ns()
+        model.add_sample(t0, 2.5e-3, 100e-6)
+        model.add_sample(t0 + 10**9, 2.5e-3 + 20e-6, 100e-6)
+        self.publisher.publish(model)
+        self.assertTrue(self.reader.is_ready())
+        for local_ns in (t0, t0 + 10 * 10**9, t0 - 10**9):
+            self.assertLessEqual(abs(self.reader.to_server_time(local_ns) - \
+                                     model.to_server_time(local_ns)), 1)
+            self.assertAlmostEqual(self.reader.get_uncertainty(local_ns),
+                                   model.get_uncertainty(local_ns))
+        self.assertAlmostEqual(self.reader.get_offset(t0 + 10**9),
+                               2.52e-3, 9)
+        info = self.reader.read_info()
+        self.assertEqual(info['nb_updates'], 1)
+        self.assertLessEqual(info['ts_published'], time.time_ns())
+
+        # Read from another process
+        code = 'from polos.clockshare import ClockReader;'\
+               'reader = ClockReader("%s");'\
+               'print(reader.to_server_time(%d));'\
+               'reader.close()' % (self.publisher.name, t0)
+        output = run([sys.executable, '-c', code], stdout=PIPE, check=True)
+        self.assertEqual(int(output.stdout), self.reader.to_server_time(t0))
+
+    def test_seqlock(self):
+        def publish_all():
+            # All models map local time 1 to server time 2, torn ones do not
+            for t_ref in range(1, 20001):
+                self.publisher.publish_params(t_ref, t_ref, 1.)
+        writer = Process(target=publish_all)
+        writer.start()
+        nb_reads = 0
+        while writer.is_alive() or nb_reads == 0:
+            if self.reader.is_ready():
+                # Never torn
+                self.assertEqual(self.reader.to_server_time(1), 2)
+            nb_reads += 1
+        writer.join()
+        self.assertEqual(self.reader.read_params()[0], 20000)
+
+    def test_conversion_time(self):
+        self.publisher.publish_params(time.time_ns(), 1e6, 1e-5)
+        to_server_time = self.reader.to_server_time
+        local_ns = time.time_ns()
+        nb_conversions = 10000
+        durations = np.zeros(nb_conversions)
+        for iconv in range(nb_conversions):
+            ts = time.perf_counter_ns()
+            to_server_time(local_ns)
+            durations[iconv] = time.perf_counter_ns() - ts
+        # No network: a few microseconds at most even on a loaded machine
+        self.assertLess(np.median(durations), 5000)
+
+    def test_clock_sync(self):
+        server = STServerThread(port=8964, receive_timeout=0.5, udp=True)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        clock_sync = ClockSync('localhost', 8964, min_interval=0.05,
+                               max_interval=0.1, publisher=self.publisher)
+        clock_sync.start()
+        try:
+            self.assertTrue(clock_sync.wait_ready(timeout=2))
+            time.sleep(0.2)
+            local_ns = time.time_ns()
+            self.assertLessEqual(abs(self.reader.to_server_time(local_ns) - \
+                                     clock_sync.to_server_time(local_ns)),
+                                 10**5) # an update may happen in between
+            # Same host: server time is local time
+            self.assertLess(abs(self.reader.get_offset()), 1e-3)
+            self.assertGreater(self.reader.read_info()['nb_updates'], 1)
+        finally:
+            clock_sync.stop()
+            clock_sync.join(timeout=1)
+            client = ST_NTPClient()
+            client.connect('localhost', 8964)
+            client.shutdown_server()
+            client.close()
+            server.join(timeout=1)
+        self.assertFalse(server.is_alive())
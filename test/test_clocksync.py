@@ -0,0 +1,88 @@
+import unittest
+import time
+import sys
+
+import numpy as np
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import polos
+from polos.server import STServerThread, ST_NTPClient
+from polos.clocksync import ClockModel, ClockSync
+
+class ClockModelTest(unittest.TestCase):
+
+    def test_drift_tracking(self):
+        # Server clock 2.5 ms ahead, drifting by 20 ppm, jittered samples
+        offset, drift = 2.5e-3, 20e-6
+        rng = np.random.RandomState(0)
+        model = ClockModel(window=16)
+        t0 = time.time_ns()
+        for isample in range(40):
+            local_ns = t0 + isample * 10**9
+            delay = 100e-6 + rng.rand() * 50e-6
+            error = (rng.rand() - 0.5) * delay
+            model.add_sample(local_ns, offset + drift * isample + error, delay)
+
+        local_ns = t0 + 45 * 10**9
+        expected = offset + drift * 45
+        uncertainty = model.get_uncertainty(local_ns)
+        self.assertLess(uncertainty, 100e-6)
+        self.assertLess(abs(model.get_offset(local_ns) - expected),
+                        3 * uncertainty)
+        self.assertLess(abs(model.get_drift() - drift), 5e-6)
+        self.assertLess(abs(model.to_server_time(local_ns) - local_ns - \
+                            expected * 1e9), 3e9 * uncertainty)
+        # Uncertainty grows when extrapolating further
+        self.assertLess(model.get_uncertainty(local_ns),
+                        model.get_uncertainty(local_ns + 100 * 10**9))
+
+    def test_single_sample(self):
+        model = ClockModel()
+        self.assertFalse(model.is_ready())
+        local_ns = time.time_ns()
+        model.add_sample(local_ns, 1e-3, 200e-6)
+        self.assertTrue(model.is_ready())
+        self.assertEqual(model.get_drift(), 0)
+        self.assertEqual(model.to_server_time(local_ns), local_ns + 10**6)
+        self.assertAlmostEqual(model.get_uncertainty(local_ns),
+                               200e-6 / np.sqrt(12))
+
+
+class ClockSyncTest(unittest.TestCase):
+
+    def test_background_sync(self):
+        fired = []
+        server = STServerThread(port=8895, receive_timeout=0.5, udp=True,
+                                callback1=lambda: fired.append(1),
+                                callback2=lambda: fired.append(2))
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        clock_sync = ClockSync('localhost', 8895, min_interval=0.05,
+                               max_interval=0.2, target_uncertainty=1e-3)
+        clock_sync.start()
+        try:
+            self.assertTrue(clock_sync.wait_ready(timeout=2))
+            time.sleep(0.5)
+            self.assertGreater(clock_sync.nb_updates, 1)
+            self.assertEqual(clock_sync.get_status()[0], polos.STATUS_OK)
+            # Same host: server time is local time
+            local_ns = time.time_ns()
+            self.assertLess(abs(clock_sync.to_server_time(local_ns) - \
+                                local_ns), 10**6)
+            self.assertLess(clock_sync.get_uncertainty(), 1e-3)
+            # Interval grew since uncertainty is below target
+            self.assertEqual(clock_sync.interval, 0.2)
+            # Probes do not fire triggers
+            self.assertEqual(fired, [])
+        finally:
+            clock_sync.stop()
+            clock_sync.join(timeout=1)
+            client = ST_NTPClient()
+            client.connect('localhost', 8895)
+            client.shutdown_server()
+            client.close()
+            server.join(timeout=1)
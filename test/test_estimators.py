@@ -0,0 +1,87 @@
+import unittest
+import time
+import sys
+
+import numpy as np
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+from polos.estimators import ESTIMATORS, get_estimator, synthetic_trace
+from polos.estimators import benchmark, median_delay
+from polos.server import STServerThread, ST_NTPClient
+
+class EstimatorsTest(unittest.TestCase):
+
+    def test_estimators_on_synthetic_trace(self):
+        offsets, delays, times, true_offset = \
+            synthetic_trace(200, offset=1e-3, base_delay=100e-6,
+                            queueing_delay=100e-6, seed=0)
+        for name, estimator in ESTIMATORS.items():
+            offsets_copy = offsets.copy()
+            estimate = estimator(offsets, delays, times)
+            self.assertLess(abs(estimate - true_offset), 100e-6, name)
+            np.testing.assert_array_equal(offsets, offsets_copy)
+
+    def test_zero_delays(self):
+        # Loopback delays rounded to the nanosecond
+        offsets = np.array([1e-6, 2e-6, 3e-6, 5e-6])
+        delays = np.array([0., 0., 1e-6, 2e-6])
+        for name, estimator in ESTIMATORS.items():
+            estimate = estimator(offsets, delays, None)
+            self.assertTrue(np.isfinite(estimate), name)
+        # Zero-delay probes weigh the most
+        self.assertLess(abs(ESTIMATORS['lowest_delays'](offsets, delays) - \
+                            1.5e-6), 0.1e-6)
+
+    def test_drift(self):
+        offsets, delays, times, true_offset = \
+            synthetic_trace(200, offset=1e-3, drift=50e-6, interval=0.1,
+                            seed=0)
+        # Offset at the last probe time, despite a 1ms drift over the trace
+        for name in ['huber', 'paxson']:
+            estimate = ESTIMATORS[name](offsets, delays, times)
+            self.assertLess(abs(estimate - true_offset), 100e-6, name)
+
+    def test_benchmark(self):
+        nb_probes = (5, 50)
+        errors = benchmark(nb_probes, nb_runs=50, asymmetry=1.)
+        self.assertEqual(set(errors), set(ESTIMATORS))
+        for name, rms_errors in errors.items():
+            self.assertEqual(len(rms_errors), len(nb_probes))
+        # Low-delay probes carry the most information
+        for name in ['min_delay', 'lowest_delays', 'paxson']:
+            self.assertLess(errors[name][1], errors['median_delay'][1] / 2)
+            self.assertLess(errors[name][1], errors[name][0])
+
+        # Recorded trace on a single host
+        trace = synthetic_trace(500, seed=1)[:3] + (0.,)
+        errors = benchmark(nb_probes, nb_runs=20, trace=trace)
+        self.assertEqual(set(errors), set(ESTIMATORS))
+
+    def test_get_estimator(self):
+        self.assertIs(get_estimator('median_delay'), median_delay)
+        custom = lambda offsets, delays, times: 0.
+        self.assertIs(get_estimator(custom), custom)
+        self.assertRaises(ValueError, get_estimator, 'unknown')
+
+    def test_request_estimator(self):
+        server = STServerThread(port=8896, receive_timeout=0.5)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = ST_NTPClient()
+        client.connect('localhost', server.get_port())
+        try:
+            for name in ESTIMATORS:
+                client.request(nb_trials=20, estimator=name)
+                self.assertLess(abs(client.offset),
+                                ST_NTPClient.CLOCK_OFFSET_TOLERANCE)
+            client.request(nb_trials=20,
+                           estimator=lambda offsets, delays, times: 1.)
+            self.assertEqual(client.offset, 1.)
+        finally:
+            client.shutdown_server()
+            client.close()
+            server.join(timeout=1)
@@ -0,0 +1,131 @@
+import unittest
+import time
+import sys
+import os.path as op
+import shutil
+import tempfile
+import tracemalloc
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import numpy as np
+
+import polos
+import polos.eventlog
+from polos.eventlog import EventLogger, read_event_log, EVENT_DTYPE
+from polos.eventlog import EVENT_CONNECT, EVENT_DISCONNECT, EVENT_RECEIVE
+from polos.eventlog import EVENT_REQUEST, EVENT_CALLBACK_END, EVENT_REPLY
+from polos.eventlog import EVENT_SEND, EVENT_REPLY_RECEIVED
+from polos.server import STServerThread, ST_NTPClient, STS_WIRE_V1
+
+class EventLoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='polos_eventlog_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ring_buffer(self):
+        event_logger = EventLogger(size=4)
+        for ievent in range(6):
+            event_logger.log(EVENT_SEND, ievent, ts=1000 + ievent)
+        self.assertEqual(event_logger.nb_events, 6)
+        self.assertEqual(event_logger.get_nb_dropped(), 2)
+        events = event_logger.get_events()
+        self.assertEqual(events.dtype, EVENT_DTYPE)
+        # Oldest first
+        np.testing.assert_array_equal(events['arg'], [2, 3, 4, 5])
+        np.testing.assert_array_equal(events['ts'], [1002, 1003, 1004, 1005])
+        self.assertEqual(event_logger.to_string().split('\n')[0],
+                         '0.000001 : send 2')
+
+        event_logger.reset()
+        self.assertEqual(len(event_logger.get_events()), 0)
+
+    def test_dump_and_read(self):
+        event_logger = EventLogger(size=10)
+        for ievent in range(15):
+            event_logger.log(EVENT_REQUEST + ievent % 2, ievent)
+        log_fn = op.join(self.tmp_dir, 'events.bin')
+        event_logger.dump(log_fn)
+        self.assertEqual(op.getsize(log_fn),
+                         polos.eventlog.EVENT_LOG_HEADER.size + \
+                         10 * EVENT_DTYPE.itemsize)
+
+        events, nb_dropped = read_event_log(log_fn)
+        self.assertEqual(nb_dropped, 5)
+        np.testing.assert_array_equal(events, event_logger.get_events())
+        self.assertTrue((np.diff(events['ts']) >= 0).all())
+
+        with open(log_fn, 'r+b') as fout:
+            fout.write(b'XXXX')
+        self.assertRaises(ValueError, read_event_log, log_fn)
+
+    def test_no_allocation(self):
+        event_logger = EventLogger(size=100)
+        tracemalloc.start()
+        try:
+            # Warm up, with the event counter traced once above small ints
+            for ievent in range(300):
+                event_logger.log(EVENT_SEND, ievent)
+            snapshot_start = tracemalloc.take_snapshot()
+            for ievent in range(1000):
+                event_logger.log(EVENT_SEND, ievent)
+            snapshot_end = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        log_filter = [tracemalloc.Filter(True, polos.eventlog.__file__)]
+        stats = snapshot_end.filter_traces(log_filter).compare_to(
+            snapshot_start.filter_traces(log_filter), 'lineno')
+        self.assertEqual(sum(stat.count_diff for stat in stats), 0)
+
+    def test_server_and_client_traces(self):
+        log_fn = op.join(self.tmp_dir, 'server_events.bin')
+        server_logger = EventLogger(filename=log_fn)
+        server = STServerThread(port=8941, receive_timeout=0.5,
+                                event_logger=server_logger)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client_logger = EventLogger()
+        client = ST_NTPClient(event_logger=client_logger,
+                              wire_format=STS_WIRE_V1)
+        try:
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=5)
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+        # Dumped when the server stopped
+        events, nb_dropped = read_event_log(log_fn)
+        self.assertEqual(nb_dropped, 0)
+        codes = list(events['code'])
+        self.assertEqual(codes[0], EVENT_CONNECT)
+        self.assertEqual(codes[-1], EVENT_DISCONNECT)
+        # The quit request is received but not replied
+        for code, last_seq in ((EVENT_REQUEST, 6), (EVENT_CALLBACK_END, 5),
+                               (EVENT_REPLY, 5)):
+            np.testing.assert_array_equal(events['arg'][events['code'] == \
+                                                        code],
+                                          range(1, last_seq + 1))
+        self.assertEqual(codes.count(EVENT_RECEIVE), 6)
+
+        client_events = client_logger.get_events()
+        sent = client_events['code'] == EVENT_SEND
+        received = client_events['code'] == EVENT_REPLY_RECEIVED
+        np.testing.assert_array_equal(client_events['arg'][sent],
+                                      range(1, 7))
+        np.testing.assert_array_equal(client_events['arg'][received],
+                                      range(1, 6))
+        # Same host: server events lie between sending and reception
+        server_requests = events['ts'][events['code'] == EVENT_REQUEST][:5]
+        self.assertTrue((client_events['ts'][sent][:5] <= \
+                         server_requests).all())
+        self.assertTrue((server_requests <= \
+                         client_events['ts'][received]).all())
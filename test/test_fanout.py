@@ -0,0 +1,60 @@
+import unittest
+import time
+import sys
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import polos
+from polos.server import STServerThread
+from polos.fanout import STFanOutClient
+
+class EventRecorder:
+    def __init__(self):
+        self.ts = []
+
+    def __call__(self):
+        self.ts.append(time.time_ns())
+
+
+class FanOutTest(unittest.TestCase):
+
+    def test_fan_out_trigger(self):
+        ports = [8900, 8901, 8902]
+        recorders = [EventRecorder() for _ in ports]
+        servers = [STServerThread(port=port, callback1=recorder,
+                                  callback2=recorder, receive_timeout=0.5) \
+                   for port, recorder in zip(ports, recorders)]
+        for server in servers:
+            server.start()
+        time.sleep(0.2) # wait a bit to let servers update
+
+        local_recorder = EventRecorder()
+        client = STFanOutClient([('localhost', port) for port in ports],
+                                trigger_callback=local_recorder)
+        try:
+            client.connect()
+            client.probe(nb_trials=20)
+            self.assertTrue((client.delays > 0).all())
+            # Same host: no offset
+            self.assertTrue((abs(client.offsets) < 1e-3).all())
+            # Probes do not fire any callback
+            self.assertEqual([len(r.ts) for r in recorders], [0, 0, 0])
+
+            spread = client.trigger()
+            self.assertEqual(client.get_status()[0], polos.STATUS_OK)
+            self.assertEqual([len(r.ts) for r in recorders], [1, 1, 1])
+            self.assertEqual(len(local_recorder.ts), 1)
+            fire_times = [r.ts[0] for r in recorders] + local_recorder.ts
+            self.assertLess(spread, 1e-3)
+            self.assertLess(max(fire_times) - min(fire_times), 10**6)
+            # Reported fire times match the recorded ones on the same host
+            for recorder, ts in zip(recorders, client.fire_times):
+                self.assertLess(abs(recorder.ts[0] - ts), 10**6)
+        finally:
+            client.shutdown_servers()
+            client.close()
+            for server in servers:
+                server.join(timeout=1)
+        self.assertFalse(any(server.is_alive() for server in servers))
@@ -0,0 +1,123 @@
+import unittest
+import time
+import sys
+import socket
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import numpy as np
+
+from polos.impairment import Impairment, ImpairmentProxy, get_transit_delays
+from polos.impairment import UPLINK, DOWNLINK
+from polos.server import STServerThread, ST_NTPClient
+from polos.server import STS_TRANSPORT_UDP
+
+class ImpairmentTest(unittest.TestCase):
+
+    def test_sample(self):
+        impairment = Impairment(delay=1e-3, jitter=1e-4, loss=0.1,
+                                reorder=0.05)
+        def sample_all(seed):
+            rng = np.random.default_rng(seed)
+            return [impairment.sample(rng) for _ in range(10000)]
+        delays = sample_all(1)
+        self.assertEqual(sample_all(1), delays)
+        self.assertNotEqual(sample_all(2), delays)
+        received = np.array([d for d in delays if d is not None])
+        self.assertAlmostEqual(1 - len(received) / len(delays), 0.1, 1)
+        self.assertTrue((received >= 1e-3).all())
+        reordered = received >= 1e-3 + impairment.reorder_delay
+        self.assertAlmostEqual(reordered.mean(), 0.05, 1)
+        self.assertAlmostEqual(received[~reordered].mean(), 1.1e-3, 4)
+
+        for distribution in ('uniform', 'normal'):
+            rng = np.random.default_rng(0)
+            impairment = Impairment(delay=1e-4, jitter=1e-3,
+                                    distribution=distribution)
+            delays = np.array([impairment.sample(rng) for _ in range(1000)])
+            self.assertTrue((delays >= 0).all())
+            self.assertGreater(delays.std(), 1e-4)
+
+    def test_tcp_asymmetry(self):
+        server = STServerThread(port=8954, receive_timeout=0.5)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+        proxy = ImpairmentProxy(('localhost', 8954), Impairment(delay=1e-3),
+                                Impairment(delay=3e-3))
+        proxy.start()
+        client = ST_NTPClient()
+        try:
+            client.connect('localhost', proxy.get_port())
+            client.request(nb_trials=10)
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+            proxy.stop()
+        self.assertFalse(server.is_alive())
+        self.assertGreater(client.round_trip_delay, 4e-3)
+        # Same clock: the estimated offset is the asymmetry error,
+        # ie (uplink - downlink) / 2
+        self.assertLess(abs(client.offset - -1e-3), 0.3e-3)
+
+        transits = proxy.get_transits()
+        uplink_delays = get_transit_delays(transits, UPLINK)
+        downlink_delays = get_transit_delays(transits, DOWNLINK)
+        self.assertEqual(len(uplink_delays), 11) # with quit request
+        self.assertEqual(len(downlink_delays), 10)
+        self.assertTrue((uplink_delays >= 1e-3).all())
+        self.assertTrue((downlink_delays >= 3e-3).all())
+
+    def test_udp_loss(self):
+        server = STServerThread(port=8960, receive_timeout=0.5, udp=True)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+        proxy = ImpairmentProxy(('localhost', 8960), Impairment(loss=0.3),
+                                Impairment(), seed=1,
+                                transport=STS_TRANSPORT_UDP)
+        proxy.start()
+        prober = ST_NTPClient(transport=STS_TRANSPORT_UDP)
+        try:
+            prober.connect('localhost', proxy.get_port())
+            prober.request(nb_trials=10)
+        finally:
+            prober.close()
+            proxy.stop()
+            client = ST_NTPClient()
+            client.connect('localhost', 8960)
+            client.shutdown_server()
+            client.close()
+            server.join(timeout=1)
+        transits = proxy.get_transits()
+        uplink = transits[transits['direction'] == UPLINK]
+        self.assertEqual(len(uplink), 10)
+        # Seeded: the same packets are dropped at each run
+        nb_dropped = (uplink['ts_sent'] < 0).sum()
+        self.assertEqual(nb_dropped, 3)
+        self.assertEqual(prober.nb_lost, nb_dropped)
+        self.assertEqual(len(get_transit_delays(transits, DOWNLINK)),
+                         10 - nb_dropped)
+
+    def test_udp_reorder(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('localhost', 0))
+        receiver.settimeout(1)
+        proxy = ImpairmentProxy(receiver.getsockname(),
+                                Impairment(delay=1e-3, reorder=0.3,
+                                           reorder_delay=5e-3),
+                                transport=STS_TRANSPORT_UDP)
+        proxy.start()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for seq in range(30):
+                sender.sendto(b'%d' % seq, ('localhost', proxy.get_port()))
+                time.sleep(1e-3)
+            received = [int(receiver.recv(16)) for _ in range(30)]
+        finally:
+            sender.close()
+            receiver.close()
+            proxy.stop()
+        self.assertEqual(sorted(received), list(range(30)))
+        self.assertNotEqual(received, list(range(30)))
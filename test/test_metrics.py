@@ -0,0 +1,173 @@
+import unittest
+import time
+import sys
+import os.path as op
+import shutil
+import tempfile
+import urllib.request
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import numpy as np
+
+from polos.metrics import LatencyHistogram, Metrics
+from polos.metrics import read_metrics, parse_metrics_address
+from polos.server import STServerThread, ST_NTPClient, STClient
+from polos.server import STS_WIRE_V1
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = LatencyHistogram('test', 'Test')
+        values = np.concatenate((np.arange(2000),
+                                 np.random.randint(1, 2**36, 10000)))
+        for value in values:
+            index = histogram.get_index(int(value))
+            lower = histogram.get_lower_bound(index)
+            upper = histogram.get_lower_bound(index + 1)
+            self.assertTrue(lower <= value < upper)
+            # Relative precision
+            self.assertLessEqual(upper - lower,
+                                 max(1, value / histogram.sub_bucket_count))
+        # Out of range values are kept
+        histogram.record(2**40)
+        histogram.record(-1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.counts[0], 1)
+
+    def test_quantiles(self):
+        histogram = LatencyHistogram('test', 'Test')
+        self.assertEqual(histogram.get_quantiles([0.5]), [None])
+        self.assertIsNone(histogram.get_max())
+        delays = np.arange(1, 1001) * 1e-6 # 1 us to 1 ms
+        histogram.record_many(delays)
+        self.assertEqual(histogram.get_count(), 1000)
+        self.assertAlmostEqual(histogram.total / 1e9, delays.sum(), 9)
+        p50, p99 = histogram.get_quantiles([0.5, 0.99])
+        self.assertLess(abs(p50 - 500e-6) / 500e-6, 1 / 32)
+        self.assertLess(abs(p99 - 990e-6) / 990e-6, 1 / 32)
+        self.assertLess(abs(histogram.get_max() - 1e-3) / 1e-3, 1 / 32)
+        histogram.reset()
+        self.assertEqual(histogram.get_count(), 0)
+
+    def test_formats(self):
+        metrics = Metrics({'server' : 'test'})
+        histogram = metrics.add_histogram('delay_seconds', 'Delay')
+        for value_ns in (1000, 2000, 3000, 10**6):
+            histogram.record(value_ns)
+        text = metrics.format_text()
+        self.assertTrue(text.startswith('delay_seconds server=test count=4'))
+        self.assertIn('p999=', text)
+
+        prometheus = metrics.format_prometheus().split('\n')
+        self.assertIn('# TYPE polos_delay_seconds histogram', prometheus)
+        self.assertIn('polos_delay_seconds_bucket{server="test",'\
+                      'le="2.048e-06"} 2', prometheus)
+        self.assertIn('polos_delay_seconds_bucket{server="test",'\
+                      'le="+Inf"} 4', prometheus)
+        self.assertIn('polos_delay_seconds_count{server="test"} 4',
+                      prometheus)
+        self.assertIn('polos_delay_seconds_sum{server="test"} 0.001006000',
+                      prometheus)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_metrics_address('localhost:9100'),
+                         ('localhost', 9100))
+        self.assertEqual(parse_metrics_address('/tmp/polos.sock'),
+                         '/tmp/polos.sock')
+
+
+class MetricsEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='polos_metrics_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_server_metrics(self):
+        metrics_path = op.join(self.tmp_dir, 'metrics.sock')
+        server = STServerThread(port=8942, receive_timeout=0.5,
+                                callback1=lambda: time.sleep(1e-3),
+                                metrics_address=metrics_path)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = ST_NTPClient(wire_format=STS_WIRE_V1)
+        try:
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=20)
+            client.serve_metrics(('localhost', 8943))
+            client_text = read_metrics(('localhost', 8943))
+            prometheus = read_metrics(metrics_path, 'prometheus')
+            text = read_metrics(metrics_path)
+            with urllib.request.urlopen('http://localhost:8943/metrics') \
+                 as response:
+                client_http = response.read().decode()
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+        self.assertFalse(op.exists(metrics_path))
+
+        self.assertIn('polos_sts_request_to_reply_seconds_count'\
+                      '{server="STServer"} 20', prometheus)
+        self.assertIn('polos_sts_callback_seconds_count'\
+                      '{server="STServer"} 20', prometheus)
+        for line in text.strip().split('\n'):
+            name = line.split(' ')[0]
+            if name == 'sts_trigger_lateness_seconds':
+                self.assertIn('count=0', line)
+                continue
+            self.assertIn('count=20', line)
+            p50 = float(line.split('p50=')[1].split(' ')[0])
+            if name == 'sts_callback_seconds':
+                self.assertGreaterEqual(p50, 1e-3)
+            else:
+                self.assertGreater(p50, 1e-3)
+        self.assertTrue(client_text.startswith(
+            'client_round_trip_delay_seconds client=ST_NTPClient count=20'))
+        self.assertIn('polos_client_round_trip_delay_seconds_count'\
+                      '{client="ST_NTPClient"} 20', client_http)
+
+    def test_text_request_metrics(self):
+        metrics_path = op.join(self.tmp_dir, 'metrics.sock')
+        server = STServerThread(port=8977, receive_timeout=0.5,
+                                callback1=lambda: time.sleep(1e-3),
+                                metrics_address=metrics_path)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = ST_NTPClient() # legacy text requests
+        try:
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=10)
+            prometheus = read_metrics(metrics_path, 'prometheus')
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+        self.assertIn('polos_sts_request_to_reply_seconds_count'\
+                      '{server="STServer"} 10', prometheus)
+        self.assertIn('polos_sts_callback_seconds_count'\
+                      '{server="STServer"} 10', prometheus)
+
+    def test_trigger_client_metrics(self):
+        server = STServerThread(port=8944, receive_timeout=0.5)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = STClient(lambda: None, wire_format=STS_WIRE_V1)
+        try:
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=10)
+            client.request(nb_trials=5)
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+        histogram = client.metrics.histograms['client_one_way_delay_seconds']
+        self.assertEqual(histogram.get_count(), 15)
@@ -0,0 +1,71 @@
+import unittest
+import time
+import sys
+import os
+import gc
+from multiprocessing import Process, Queue
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import polos
+from polos.server import STServerProcess, ST_NTPClient
+from polos.realtime import apply_realtime_profile, format_profile
+from polos.realtime import GC_FREEZE
+
+def apply_in_child(queue, **options):
+    applied = apply_realtime_profile(**options)
+    queue.put((applied, gc.get_freeze_count() > 0))
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'Linux only')
+class RealtimeProfileTest(unittest.TestCase):
+
+    def run_in_child(self, **options):
+        # Do not alter the test process
+        queue = Queue()
+        child = Process(target=apply_in_child, args=(queue,), kwargs=options)
+        child.start()
+        result = queue.get(timeout=10)
+        child.join(timeout=5)
+        return result
+
+    def test_report(self):
+        cpu = min(os.sched_getaffinity(0))
+        applied, gc_frozen = self.run_in_child(cpus=[cpu],
+                                               prefault_size=2**20)
+        self.assertEqual(set(applied),
+                         {'affinity', 'scheduler', 'mlockall', 'gc',
+                          'prefault'})
+        self.assertEqual(applied['affinity'], {cpu})
+        self.assertEqual(applied['gc'], GC_FREEZE)
+        self.assertTrue(gc_frozen)
+        self.assertEqual(applied['prefault'], 2**20)
+        # Not permitted everywhere: applied or reported as failed
+        self.assertIn(applied['scheduler'], (50, None))
+        self.assertIn(applied['mlockall'], (True, None))
+        self.assertIn('scheduler=', format_profile(applied))
+
+    def test_nothing_requested(self):
+        applied, gc_frozen = self.run_in_child(priority=None, lock=False,
+                                               gc_mode=None, prefault_size=0)
+        self.assertEqual(applied, {})
+        self.assertFalse(gc_frozen)
+
+    def test_server(self):
+        server = STServerProcess(port=8904, receive_timeout=0.5,
+                                 realtime={'cpus' : [0], 'priority' : None})
+        server.start()
+        time.sleep(0.5) # wait a bit to let server update
+        client = ST_NTPClient()
+        try:
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=10)
+            self.assertEqual(client.get_status()[0], polos.STATUS_OK)
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+            if server.is_alive():
+                server.terminate()
+        self.assertEqual(server.exitcode, 0)
@@ -0,0 +1,73 @@
+import unittest
+import time
+import sys
+import os.path as op
+import shutil
+import tempfile
+from subprocess import run
+from multiprocessing import Process
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import numpy as np
+
+from polos.selftest import StampCallback, run_selftest
+from polos.selftest import summarize, format_summary
+
+class SelfTestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='polos_selftest_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stamp_callback(self):
+        callback = StampCallback(3)
+        callback()
+        # Written from another process
+        stamper = Process(target=callback)
+        stamper.start()
+        stamper.join()
+        for _ in range(2):
+            callback()
+        stamps = callback.get_stamps()
+        self.assertEqual(len(stamps), 3)
+        self.assertTrue((np.diff(stamps) > 0).all())
+        self.assertLessEqual(stamps[-1],
+                             time.clock_gettime_ns(time.CLOCK_MONOTONIC))
+        callback.reset()
+        self.assertEqual(len(callback.get_stamps()), 0)
+
+    def test_selftest(self):
+        results = run_selftest(nb_triggers=50, port=8955)
+        for name in ('skew', 'trigger_delay_error', 'estimated_delay',
+                     'delay_std'):
+            self.assertEqual(len(results[name]), 50)
+        self.assertTrue((results['estimated_delay'] > 0).all())
+        summary = summarize(results)
+        np.testing.assert_allclose(summary['residual']['mean'],
+                                   summary['skew']['mean'] - \
+                                   summary['trigger_delay_error']['mean'])
+        # Same host: triggers a lot closer than a network delay
+        self.assertLess(abs(summary['skew']['p50']), 1e-3)
+        self.assertEqual(len(format_summary(summary).split('\n')), 6)
+
+    def test_warm_selftest(self):
+        results = run_selftest(nb_triggers=20, port=8967, warm=True)
+        # Trigger only: no spread of delays within a request
+        self.assertTrue((results['delay_std'] == 0).all())
+        self.assertLess(abs(summarize(results)['skew']['p50']), 1e-3)
+
+    def test_script(self):
+        npz_fn = op.join(self.tmp_dir, 'selftest.npz')
+        run(['polos_trigger_selftest', '-n', '20', '-p', '8956',
+             '-o', npz_fn], check=True)
+        with np.load(npz_fn) as results:
+            self.assertEqual(len(results['skew']), 20)
+        # Unreachable bound on the skew
+        status = run(['polos_trigger_selftest', '-n', '20', '-p', '8956',
+                      '-m', '1e-12'])
+        self.assertEqual(status.returncode, 1)
@@ -6,18 +6,25 @@ import shutil
 import os
 import os.path as op
 import tempfile
-from glob import glob
+import tracemalloc
 
 import logging
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger('polos')
 
 from multiprocessing import Value
+from threading import Timer
 import numpy as np
 
 import polos
 from polos.server import STServerProcess, STServerThread, ST_NTPClient, STClient
 from polos.server import TimestampSaver
+from polos.timestamplog import read_timestamp_log, get_log_filename
+from polos.server import STS_TRANSPORT_TCP, STS_TRANSPORT_UDP
+from polos.server import STS_CALLBACK_1, STS_CALLBACK_2, STS_QUIT
+from polos.server import STS_REPLY_OK, STS_REPLY_LATE, STS_REPLY_DEFERRED
+from polos.server import STS_WIRE_TEXT, STS_WIRE_V1, STS_REQUEST_V1, STS_REPLY_V1
+from polos.server import STSTimeoutError
 
 class StatusHolder:
     def __init__(self):
@@ -160,6 +167,497 @@ class SyncTriggerTest(unittest.TestCase):
 
         self.assertEqual(call_counter.nb_calls, nb_request_trials)
                 
+    def test_ntp_query_udp(self):
+
+        class Callback:
+            def __init__(self):
+                self.nb_calls = 0
+
+            def __call__(self):
+                self.nb_calls += 1
+
+        call_counter = Callback()
+
+        server = STServerThread(port=8890, callback1=call_counter,
+                                receive_timeout=0.5, udp=True)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = ST_NTPClient(transport=STS_TRANSPORT_UDP)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+
+        # A late reply from a previous probe must be dropped
+        client.socket.send(client.encode_request(STS_CALLBACK_1))
+        time.sleep(0.05)
+
+        nb_request_trials = 20
+        client.request(nb_trials=nb_request_trials)
+        self.check_status(client, polos.STATUS_OK, '')
+        self.assertEqual(client.nb_lost, 0)
+        self.assertTrue(abs(client.offset) < ST_NTPClient.CLOCK_OFFSET_TOLERANCE)
+
+        client.shutdown_server()
+        client.close()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+        self.assertEqual(call_counter.nb_calls, nb_request_trials + 1)
+
+    def test_wire_formats(self):
+
+        class Callback:
+            def __init__(self):
+                self.nb_calls = 0
+
+            def __call__(self):
+                self.nb_calls += 1
+
+        call_counter = Callback()
+
+        server = STServerThread(port=8891, callback2=call_counter,
+                                receive_timeout=0.5, udp=True)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        # Legacy text clients keep working, over TCP and UDP
+        for transport in [STS_TRANSPORT_TCP, STS_TRANSPORT_UDP]:
+            client = ST_NTPClient(transport=transport,
+                                  wire_format=STS_WIRE_TEXT)
+            self.to_close.append(client)
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=5)
+            self.check_status(client, polos.STATUS_OK, '')
+            client.close()
+
+        # Binary requests coalesced or split in the TCP stream
+        client = socket.create_connection(('localhost', server.get_port()))
+        self.to_close.append(client)
+        requests = b''.join(STS_REQUEST_V1.pack(STS_WIRE_V1,
+                                                STS_CALLBACK_2[0], 0, 0, seq,
+                                                0) \
+                            for seq in range(1, 4))
+        client.sendall(requests[:20])
+        time.sleep(0.05)
+        client.sendall(requests[20:])
+        replies = b''
+        while len(replies) < 3 * STS_REPLY_V1.size:
+            replies += client.recv(STS_REPLY_V1.size)
+        for seq in range(1, 4):
+            reply = STS_REPLY_V1.unpack_from(replies,
+                                             (seq - 1) * STS_REPLY_V1.size)
+            version, command, status, rseq, ts_rcv, ts_cbk, ts_tr = reply
+            self.assertEqual(version, STS_WIRE_V1)
+            self.assertEqual(command, STS_CALLBACK_2[0])
+            self.assertEqual(rseq, seq)
+            self.assertTrue(ts_rcv <= ts_cbk <= ts_tr)
+        self.assertEqual(call_counter.nb_calls, 3)
+        client.close()
+
+        client = ST_NTPClient()
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_partial_replies(self):
+        # Fake server, sending replies piece by piece
+        listener = socket.create_server(('localhost', 8974))
+        self.to_close.append(listener)
+        client = ST_NTPClient(wire_format=STS_WIRE_V1)
+        self.to_close.append(client)
+        client.connect('localhost', 8974)
+        connection, _ = listener.accept()
+        self.to_close.append(connection)
+        def reply_to_last():
+            return STS_REPLY_V1.pack(STS_WIRE_V1, STS_CALLBACK_2[0],
+                                     STS_REPLY_OK, client.seq, 1, 2, 3)
+
+        # Reply split in the stream
+        client.send_request(client.encode_request(STS_CALLBACK_2))
+        reply = reply_to_last()
+        connection.sendall(reply[:10])
+        Timer(0.05, connection.sendall, [reply[10:]]).start()
+        self.assertEqual(client.recv_reply(1)[0], (client.seq, 1, 2, 3))
+
+        # Server stalled, then gone, in the middle of a reply
+        client.send_request(client.encode_request(STS_CALLBACK_2))
+        connection.sendall(reply_to_last()[:10])
+        ts = time.perf_counter()
+        self.assertRaises(STSTimeoutError, client.recv_reply, 0.1)
+        self.assertLess(time.perf_counter() - ts, 0.5)
+        # Late end of the reply: still read in sync
+        connection.sendall(reply_to_last()[10:])
+        self.assertEqual(client.recv_reply(1)[0], (client.seq, 1, 2, 3))
+        connection.sendall(reply_to_last()[:10])
+        ts = time.perf_counter()
+        self.assertRaises(STSTimeoutError, client.wait_trigger_report,
+                          client.seq, 0.1)
+        self.assertLess(time.perf_counter() - ts, 0.5)
+        connection.sendall(reply_to_last()[10:])
+        self.assertEqual(client.recv_reply(1)[0], (client.seq, 1, 2, 3))
+        client.send_request(client.encode_request(STS_CALLBACK_2))
+        connection.sendall(reply_to_last()[:10])
+        connection.close()
+        self.assertRaises(ConnectionError, client.recv_reply, 1)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'),
+                         'Kernel timestamps are only supported on linux')
+    def test_kernel_timestamps(self):
+        server = STServerThread(port=8892, receive_timeout=0.5, udp=True,
+                                kernel_timestamps=True)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        for transport in [STS_TRANSPORT_UDP, STS_TRANSPORT_TCP]:
+            client = ST_NTPClient(transport=transport, kernel_timestamps=True)
+            self.to_close.append(client)
+            client.connect('localhost', server.get_port())
+            self.assertTrue(client.kernel_rx)
+            self.assertTrue(client.kernel_tx)
+            client.request(nb_trials=20)
+            self.check_status(client, polos.STATUS_OK, '')
+            self.assertIsNotNone(client.ts_kernel_origin)
+            self.assertIsNotNone(client.ts_kernel_destination)
+            # Kernel timestamps are taken closer to the wire
+            self.assertGreaterEqual(client.kernel_delay_gain, 0)
+            if transport == STS_TRANSPORT_UDP:
+                client.close()
+
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_ntp_query_burst(self):
+        server = STServerProcess(port=8893, receive_timeout=0.5, udp=True)
+        self.processes.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        nb_request_trials = 200
+        for transport in [STS_TRANSPORT_UDP, STS_TRANSPORT_TCP]:
+            client = ST_NTPClient(transport=transport, wire_format=STS_WIRE_V1)
+            self.to_close.append(client)
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=nb_request_trials, in_flight=8)
+            self.check_status(client, polos.STATUS_OK, '')
+            self.assertEqual(client.nb_lost, 0)
+            self.assertEqual(len(client.delays), nb_request_trials)
+            self.assertTrue((client.delays > 0).all())
+            # Sequence numbers keep going after a burst
+            client.request(nb_trials=5)
+            self.assertEqual(client.seq, nb_request_trials + 5)
+            if transport == STS_TRANSPORT_UDP:
+                client.close()
+
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertEqual(server.exitcode, 0)
+
+    def test_scheduled_triggers(self):
+        class EventRecorder:
+            def __init__(self):
+                self.ts = []
+
+            def __call__(self):
+                self.ts.append(time.time_ns())
+
+        remote_recorder = EventRecorder()
+        server = STServerThread(port=8897, callback1=remote_recorder,
+                                receive_timeout=0.5)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        local_recorder = EventRecorder()
+        client = STClient(local_recorder, wire_format=STS_WIRE_V1)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+
+        # Several pending triggers, requested out of order
+        ts_start = time.time_ns() + 100 * 10**6
+        delays_ms = [60, 20, 40]
+        seqs = [client.schedule_trigger(ts_start + d * 10**6) \
+                for d in delays_ms]
+        reports = [client.wait_trigger_report(seq) for seq in seqs]
+        for delay_ms, report in zip(delays_ms, reports):
+            status, ts_scheduled, ts_cbk_start, ts_cbk_end = report
+            self.assertEqual(status, STS_REPLY_OK)
+            self.assertEqual(ts_scheduled, ts_start + delay_ms * 10**6)
+            self.assertGreaterEqual(ts_cbk_start, ts_scheduled)
+            self.assertLess(ts_cbk_start - ts_scheduled, 10**6)
+            self.assertLessEqual(ts_cbk_start, ts_cbk_end)
+        self.assertEqual(len(remote_recorder.ts), 3)
+        self.assertEqual(remote_recorder.ts, sorted(remote_recorder.ts))
+
+        # Trigger in the past is fired at once
+        seq = client.schedule_trigger(time.time_ns() - 10**6)
+        self.assertEqual(client.wait_trigger_report(seq)[0], STS_REPLY_LATE)
+
+        # Local and remote triggers, same host: no offset
+        ts_scheduled, ts_remote, ts_local = \
+            client.request_at(time.time_ns() + 50 * 10**6)
+        self.assertEqual(len(local_recorder.ts), 1)
+        self.assertLess(abs(remote_recorder.ts[-1] - local_recorder.ts[0]),
+                        10**6)
+        self.assertLess(abs(ts_remote - ts_local), 10**6)
+        self.assertLess(ts_remote - ts_scheduled, 10**6)
+
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_trigger_channels(self):
+        fired = []
+        server = STServerThread(port=8962, callback1=lambda: fired.append(0),
+                                receive_timeout=0.5,
+                                channels={3 : lambda: fired.append(3),
+                                          255 : lambda: fired.append(255)})
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = STClient(lambda: None, channel=3, wire_format=STS_WIRE_V1)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+        # Probes do not fire channels
+        client.request(nb_trials=5)
+        self.assertEqual(fired, [3])
+        client.channel = 255
+        client.request_at(time.time_ns() + 20 * 10**6)
+        self.assertEqual(fired, [3, 255])
+        client.channel = 0
+        client.request(nb_trials=2)
+        self.assertEqual(fired, [3, 255, 0])
+
+        # Channel without callback: error reply, server still serving
+        client.channel = 7
+        self.assertRaises(Exception, client.request, nb_trials=2)
+        self.assertRaises(Exception, client.schedule_trigger, time.time_ns(),
+                          channel=7)
+        client.channel = 3
+        client.request(nb_trials=2)
+        self.assertEqual(fired, [3, 255, 0, 3])
+
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_coalesced_text_requests(self):
+        call_counter = Value('i', 0)
+        def count():
+            call_counter.value += 1
+        server = STServerThread(port=8963, callback1=count,
+                                receive_timeout=0.5)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        # Legacy requests read at once are all served
+        client = socket.create_connection(('localhost', server.get_port()))
+        self.to_close.append(client)
+        client.sendall(STS_CALLBACK_1 * 2 + STS_CALLBACK_2)
+        time.sleep(0.1)
+        self.assertEqual(call_counter.value, 2)
+        # Three unframed replies of three timestamps, run together
+        self.assertEqual(len(client.recv(1024).split(b' ')), 3 * 3 - 2)
+        self.assertTrue(server.is_alive())
+        client.sendall(STS_CALLBACK_1 + STS_QUIT)
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+        self.assertEqual(call_counter.value, 3)
+
+    def test_async_callbacks(self):
+        class SlowCallback:
+            def __init__(self):
+                self.ts = []
+
+            def __call__(self):
+                self.ts.append(time.time_ns())
+                time.sleep(0.02)
+
+        slow_callback = SlowCallback()
+        server = STServerThread(port=8903, callback1=slow_callback,
+                                callback2=slow_callback, receive_timeout=0.5,
+                                async_callbacks=True)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        # Replies do not wait for callbacks
+        client = ST_NTPClient(wire_format=STS_WIRE_V1)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+        client.request(nb_trials=5)
+        self.assertEqual(client.reply_status, STS_REPLY_DEFERRED)
+        self.assertLess(client.round_trip_delay_max, 10e-3)
+        # Reports follow, in request order
+        reports = [client.wait_trigger_report(seq) \
+                   for seq in range(1, client.seq + 1)]
+        for status, ts_receive, ts_start, ts_end in reports:
+            self.assertEqual(status, STS_REPLY_OK)
+            self.assertLessEqual(ts_receive, ts_start)
+            self.assertGreaterEqual(ts_end - ts_start, 20 * 10**6)
+        self.assertEqual(len(slow_callback.ts), len(reports))
+        for report, ts in zip(reports, slow_callback.ts):
+            self.assertLess(abs(report[2] - ts), 10**6)
+
+        # Scheduled triggers are fired by the worker
+        ts_scheduled = time.time_ns() + 50 * 10**6
+        seq = client.schedule_trigger(ts_scheduled)
+        status, ts_sched, ts_start, ts_end = client.wait_trigger_report(seq)
+        self.assertEqual(ts_sched, ts_scheduled)
+        self.assertLess(ts_start - ts_scheduled, 10**6)
+        client.close()
+
+        client = STClient(lambda: None, wire_format=STS_WIRE_V1)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+        client.request(nb_trials=10)
+        self.assertLess(client.delays.max(), 10e-3)
+        self.assertLess(abs(client.remote_callback_at - \
+                            slow_callback.ts[-1] / 1e9), 1e-3)
+        # Probes are not deferred, and run no callback
+        nb_calls = len(slow_callback.ts)
+        self.assertTrue((client.probe(3) < 10e-3).all())
+        self.assertEqual(client.reply_status, STS_REPLY_OK)
+        self.assertEqual(len(slow_callback.ts), nb_calls)
+
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_warm_trigger(self):
+        call_counters = [Value('i', 0), Value('i', 0)]
+        def make_callback(counter):
+            def callback():
+                counter.value += 1
+            return callback
+        server = STServerThread(port=8966, receive_timeout=0.5,
+                                callback1=make_callback(call_counters[0]),
+                                callback2=make_callback(call_counters[1]))
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = STClient(lambda: None, wire_format=STS_WIRE_V1)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+        delays = client.probe(5)
+        self.assertEqual(len(delays), 5)
+        self.assertTrue((delays > 0).all())
+        self.assertEqual(list(client.delay_history), list(delays))
+
+        client.keep_warm(interval=0.01)
+        self.assertGreaterEqual(len(client.delay_history),
+                                STClient.ESTIMATE_SIZE)
+        time.sleep(0.1)
+        self.assertGreater(len(client.delay_history), STClient.ESTIMATE_SIZE)
+        # Probes fire no callback, the trigger goes out at once
+        self.assertEqual([c.value for c in call_counters], [0, 0])
+        ts_start = time.perf_counter()
+        client.request()
+        self.assertLess(time.perf_counter() - ts_start, 10e-3)
+        self.assertEqual(len(client.delays), 1)
+        self.assertEqual([c.value for c in call_counters], [1, 0])
+        client.request_at(time.time_ns() + 20 * 10**6)
+        self.assertEqual([c.value for c in call_counters], [2, 0])
+
+        client.stop_warm()
+        client.request()
+        self.assertEqual(len(client.delays), STClient.WARM_TRIALS)
+        self.assertEqual([c.value for c in call_counters],
+                         [3, STClient.WARM_TRIALS - 1])
+
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_reconnection(self):
+        server = STServerThread(port=8940, receive_timeout=0.2)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = STClient(lambda: None, auto_reconnect=True, pool_size=1)
+        self.to_close.append(client)
+        client.connect('localhost', server.get_port())
+        self.assertEqual(len(client.spare_sockets), 1)
+        client.request()
+        self.assertEqual(len(client.delays), STClient.COLD_TRIALS)
+
+        # Connection lost: switch to the spare one, keeping delays
+        client.socket.shutdown(socket.SHUT_RDWR)
+        client.request()
+        self.assertEqual(client.nb_reconnections, 1)
+        self.assertEqual(len(client.delays), STClient.WARM_TRIALS)
+        self.assertEqual(len(client.spare_sockets), 1)
+        self.assertEqual(len(client.delay_history), STClient.HISTORY_SIZE)
+
+        # Server restarted: spare connection is dead too
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+        server = STServerThread(port=8940, receive_timeout=0.2)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+        client.request()
+        self.assertEqual(client.nb_reconnections, 2)
+        self.assertEqual(len(client.delays), STClient.WARM_TRIALS)
+        self.assertLess(client.delays.max(), 10e-3)
+
+        client.shutdown_server()
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+    def test_no_allocation_per_request(self):
+        server = STServerThread(port=8905, receive_timeout=0.5)
+        self.threads.append(server)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        # Client using preallocated buffers too
+        client = socket.create_connection(('localhost', server.get_port()))
+        self.to_close.append(client)
+        request = STS_REQUEST_V1.pack(STS_WIRE_V1, STS_CALLBACK_2[0], 0, 0, 1,
+                                      0)
+        reply = bytearray(STS_REPLY_V1.size)
+        reply_views = [memoryview(reply)[n:] for n in range(len(reply))]
+        def run_requests(nb_requests):
+            for _ in range(nb_requests):
+                client.sendall(request)
+                nb_bytes = 0
+                while nb_bytes < STS_REPLY_V1.size:
+                    nb_bytes += client.recv_into(reply_views[nb_bytes])
+
+        tracemalloc.start()
+        try:
+            run_requests(100) # warm up, with locals of the loop traced
+            snapshot_start = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            run_requests(2000)
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot_end = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        server_filter = [tracemalloc.Filter(True, polos.server.__file__)]
+        stats = snapshot_end.filter_traces(server_filter).compare_to(
+            snapshot_start.filter_traces(server_filter), 'lineno')
+        self.assertEqual(sum(stat.count_diff for stat in stats), 0,
+                         '\n'.join(str(stat) for stat in stats[:5]))
+        # Only a few transient objects (eg timestamps) at a time
+        self.assertLess(peak - current, 1024)
+        self.assertEqual(STS_REPLY_V1.unpack(reply)[3], 1)
+
+        client.sendall(STS_REQUEST_V1.pack(STS_WIRE_V1, STS_QUIT[0], 0, 0, 2,
+                                           0))
+        server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
     def test_remote_trigger_process(self):
         """
         The goal is to emit two *synchronized* triggers:
@@ -256,7 +754,7 @@ class SyncTriggerTest(unittest.TestCase):
         from subprocess import Popen
         
         cmd_server = ['polos_sync_trigger_server', 'TRIGGER_FILE',
-                      '-d', self.tmp_dir]
+                      '-d', self.tmp_dir, '-c', '2']
         if self.verbose:
             cmd_server.extend(['-v', '10'])
 
@@ -276,24 +774,42 @@ class SyncTriggerTest(unittest.TestCase):
         client_proc.wait()
 
         sys.path.insert(0, op.join('..', 'scripts'))
-        from polos.server import server_trigger_fn_prefix, server_dummy_fn_prefix
+        from polos.server import server_trigger_fn_prefix
         from polos.server import client_trigger_fn_prefix as client_prefix
 
-        pat = op.join(self.tmp_dir, server_dummy_fn_prefix + '*')
-        server_dummy_fn = glob(pat)[0]
-        pat = op.join(self.tmp_dir, server_trigger_fn_prefix + '*')
-        server_trigger_fn = glob(pat)[0]
-
-        client_trigger_fn = glob(op.join(self.tmp_dir, client_prefix + '*'))[0]
+        server_trigger_ts = read_timestamp_log(\
+            get_log_filename(self.tmp_dir, server_trigger_fn_prefix))
+        self.assertEqual(len(server_trigger_ts), 1)
+        client_trigger_ts = read_timestamp_log(\
+            get_log_filename(self.tmp_dir, client_prefix))
+        self.assertEqual(len(client_trigger_ts), 1)
 
-        client_ts = TimestampSaver.get_ts_from_filename(client_trigger_fn)
-        server_ts = TimestampSaver.get_ts_from_filename(server_trigger_fn)
+        client_ts = client_trigger_ts[0] / 1e9
+        server_ts = server_trigger_ts[0] / 1e9
 
         tolerance = 1e-3
         if self.verbose:
             print('client ts:', client_ts)
             print('server ts:', server_ts)
         self.assertLess(abs(client_ts-server_ts), tolerance)
+
+        # Other channel of the server (shut down by the request script)
+        server_proc.wait(timeout=1)
+        server_proc = Popen(cmd_server, stdout=sys.stdout, stderr=sys.stderr)
+        self.procs.append(server_proc)
+        time.sleep(0.5) # wait for server to be ready
+        channel_dir = op.join(self.tmp_dir, 'channel')
+        os.makedirs(channel_dir)
+        client_proc = Popen(['polos_sync_trigger_request', 'localhost',
+                             'TRIGGER_FILE', '-d', channel_dir, '-c', '2'],
+                            stdout=sys.stdout, stderr=sys.stderr)
+        self.procs.append(client_proc)
+        client_proc.wait()
+        channel_ts = read_timestamp_log(\
+            get_log_filename(self.tmp_dir, server_trigger_fn_prefix + '-2'))
+        self.assertEqual(len(channel_ts), 1)
+        self.assertEqual(len(read_timestamp_log(\
+            get_log_filename(self.tmp_dir, server_trigger_fn_prefix))), 1)
         
     def test_trigger_with_scripts_gpio(self):
         pass
@@ -0,0 +1,104 @@
+import unittest
+import time
+import sys
+from subprocess import run, PIPE
+from multiprocessing import Process
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import polos
+from polos.statusboard import StatusBoard, SLOT_MESSAGE_SIZE
+from polos.server import STServerProcess, ST_NTPClient
+from polos.supervisor import STServerSupervisor
+
+class StatusBoardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.board = StatusBoard(2)
+
+    def tearDown(self):
+        self.board.close(unlink=True)
+
+    def test_slots(self):
+        slot = self.board.get_slot(1)
+        self.assertIsNone(self.board.read_slot(1)['status'])
+        self.assertEqual(slot.get_status()[0], polos.STATUS_ERROR)
+        slot.set_status(polos.STATUS_OK, 'x' * (SLOT_MESSAGE_SIZE + 10))
+        slot.count_connection()
+        slot.count_request(123)
+        slot.count_request(456)
+        self.assertEqual(slot.get_status(),
+                         (polos.STATUS_OK, 'x' * SLOT_MESSAGE_SIZE))
+        read = self.board.read_slot(1)
+        self.assertEqual((read['nb_connections'], read['nb_requests'],
+                          read['ts_last_request']), (1, 2, 456))
+        self.assertIsNone(self.board.read_slot(0)['status'])
+
+        # Attached from another process, which must not destroy it
+        code = 'from polos.statusboard import StatusBoard;'\
+               'board = StatusBoard(name="%s", create=False);'\
+               'print(board.read_slot(1)["nb_requests"]);'\
+               'board.close()' % self.board.name
+        output = run([sys.executable, '-c', code], stdout=PIPE, check=True)
+        self.assertEqual(output.stdout.strip(), b'2')
+        reader = StatusBoard(name=self.board.name, create=False)
+        self.assertEqual(reader.nb_slots, 2)
+        self.assertEqual(reader.read_slot(1)['nb_requests'], 2)
+        reader.close()
+
+    def test_seqlock(self):
+        slot = self.board.get_slot(0)
+        def write_all():
+            for nb in range(1, 20001):
+                slot.count_request(nb)
+        writer = Process(target=write_all)
+        writer.start()
+        nb_reads = 0
+        while writer.is_alive() or nb_reads == 0:
+            read = self.board.read_slot(0)
+            # Never torn
+            self.assertEqual(read['nb_requests'], read['ts_last_request'])
+            nb_reads += 1
+        writer.join()
+        self.assertEqual(self.board.read_slot(0)['nb_requests'], 20000)
+
+    def test_server_process(self):
+        server = STServerProcess(port=8957, receive_timeout=0.5,
+                                 status_handler=self.board.get_slot(0))
+        self.assertEqual(self.board.read_slot(0)['message'], 'Not started')
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+        client = ST_NTPClient()
+        try:
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=5)
+            time.sleep(0.1)
+            # Live state of the server process
+            read = self.board.read_slot(0)
+            self.assertEqual(read['status'], polos.STATUS_OK)
+            self.assertEqual(read['pid'], server.pid)
+            self.assertEqual(read['nb_connections'], 1)
+            self.assertEqual(read['nb_requests'], 5)
+            self.assertLess(abs(read['ts_last_request'] - time.time_ns()),
+                            1e9)
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+        self.assertEqual(self.board.read_slot(0)['message'], 'Finished')
+
+    def test_supervisor(self):
+        supervisor = STServerSupervisor(port=8958, nb_workers=2,
+                                        status_board=self.board)
+        supervisor.start()
+        try:
+            time.sleep(0.5) # wait a bit to let workers update
+            reads = self.board.read_all()
+            self.assertEqual(sorted(read['pid'] for read in reads),
+                             sorted(worker.pid \
+                                    for worker in supervisor.workers))
+            self.assertEqual(supervisor.get_status()[0], polos.STATUS_OK)
+        finally:
+            supervisor.stop()
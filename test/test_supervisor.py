@@ -0,0 +1,156 @@
+import unittest
+import time
+import sys
+import os
+import signal
+import socket
+import shutil
+import tempfile
+from threading import Thread
+from multiprocessing import Array, Value
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import polos
+from polos.server import ST_NTPClient, TimestampSaver
+from polos.timestamplog import read_timestamp_log, get_log_filename
+from polos.supervisor import STServerSupervisor, SharedStatus
+
+class PidRecorder:
+    """ Record the pid of the process running the callback """
+    def __init__(self, size=1000):
+        self.pids = Array('i', size)
+        self.nb_calls = Value('i', 0)
+
+    def __call__(self):
+        with self.nb_calls.get_lock():
+            self.pids[self.nb_calls.value] = os.getpid()
+            self.nb_calls.value += 1
+
+
+class SharedStatusTest(unittest.TestCase):
+
+    def test_truncated_message(self):
+        status = SharedStatus()
+        self.assertEqual(status.get_status()[0], polos.STATUS_ERROR)
+        status.set_status(polos.STATUS_OK, 'x' * 1000)
+        self.assertEqual(status.get_status(),
+                         (polos.STATUS_OK,
+                          'x' * (SharedStatus.MESSAGE_SIZE - 1)))
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'Linux only')
+class SupervisorTest(unittest.TestCase):
+
+    def wait_status(self, supervisor, expected_status, timeout=2):
+        deadline = time.perf_counter() + timeout
+        while supervisor.get_status()[0] != expected_status and \
+              time.perf_counter() < deadline:
+            time.sleep(0.05)
+        return supervisor.get_status()
+
+    def test_sharded_server(self):
+        recorder = PidRecorder()
+        supervisor = STServerSupervisor(port=8908, nb_workers=3,
+                                        callback1=recorder,
+                                        receive_timeout=0.2,
+                                        check_interval=0.05)
+        supervisor.start()
+        try:
+            status, message = self.wait_status(supervisor, polos.STATUS_OK)
+            self.assertEqual(status, polos.STATUS_OK, message)
+            self.assertIn('3/3 workers serving', message)
+            worker_pids = {worker.pid for worker in supervisor.workers}
+
+            nb_clients = 20
+            for _ in range(nb_clients):
+                client = ST_NTPClient()
+                client.connect('localhost', supervisor.get_port())
+                client.request(nb_trials=2)
+                self.assertEqual(client.get_status()[0], polos.STATUS_OK)
+                client.close()
+            self.assertEqual(recorder.nb_calls.value, 2 * nb_clients)
+            serving_pids = set(recorder.pids[:recorder.nb_calls.value])
+            # Connections are spread over workers
+            self.assertTrue(serving_pids.issubset(worker_pids))
+            self.assertGreater(len(serving_pids), 1)
+
+            # A worker killed is restarted
+            os.kill(supervisor.workers[0].pid, signal.SIGKILL)
+            time.sleep(0.3)
+            status, message = self.wait_status(supervisor, polos.STATUS_OK)
+            self.assertEqual(status, polos.STATUS_OK, message)
+            self.assertEqual(supervisor.nb_restarts, 1)
+            self.assertNotIn(supervisor.workers[0].pid, worker_pids)
+        finally:
+            supervisor.stop()
+        self.assertFalse(supervisor.is_alive())
+        self.assertFalse(any(worker.is_alive() \
+                             for worker in supervisor.workers))
+        self.assertEqual(supervisor.get_status()[0], polos.STATUS_ERROR)
+
+    def test_crashing_worker(self):
+        # Port already taken without SO_REUSEPORT: workers cannot bind it
+        blocker = socket.create_server(('', 8975))
+        supervisor = STServerSupervisor(port=8975, nb_workers=1,
+                                        check_interval=0.02)
+        supervisor.start()
+        try:
+            deadline = time.perf_counter() + 5
+            while not supervisor.given_up[0] and \
+                  time.perf_counter() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(supervisor.given_up[0])
+            # Restarted with backoff, then given up
+            self.assertEqual(supervisor.nb_restarts,
+                             STServerSupervisor.MAX_CRASHES)
+            crash_times = list(supervisor.crash_times[0])
+            self.assertGreater(crash_times[-1] - crash_times[-2],
+                               crash_times[2] - crash_times[1])
+            status, message = supervisor.get_status()
+            self.assertEqual(status, polos.STATUS_ERROR)
+            self.assertIn('1 given up', message)
+            time.sleep(0.1)
+            self.assertEqual(supervisor.nb_restarts,
+                             STServerSupervisor.MAX_CRASHES)
+        finally:
+            supervisor.stop()
+            blocker.close()
+        self.assertFalse(supervisor.is_alive())
+
+    def test_timestamp_logs(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        saver = TimestampSaver(tmp_dir, 'trigger')
+        saver.close() # workers write their own log
+        supervisor = STServerSupervisor(port=8976, nb_workers=2,
+                                        callback1=saver,
+                                        receive_timeout=0.2,
+                                        check_interval=0.05)
+        supervisor.start()
+        try:
+            status, message = self.wait_status(supervisor, polos.STATUS_OK)
+            self.assertEqual(status, polos.STATUS_OK, message)
+            def run_clients(nb_clients):
+                for _ in range(nb_clients):
+                    client = ST_NTPClient()
+                    client.connect('localhost', supervisor.get_port())
+                    client.request(nb_trials=50)
+                    client.close()
+            # Workers serving in parallel
+            threads = [Thread(target=run_clients, args=(5,)) \
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            supervisor.stop()
+        # No timestamp lost between concurrent workers
+        timestamps = [read_timestamp_log(get_log_filename(tmp_dir, 'trigger',
+                                                          iworker)) \
+                      for iworker in range(2)]
+        self.assertEqual(sum(len(ts) for ts in timestamps), 50 * 20)
+        self.assertEqual(len(read_timestamp_log(saver.filename)), 0)
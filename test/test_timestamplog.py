@@ -0,0 +1,94 @@
+import unittest
+import time
+import sys
+import os
+import os.path as op
+import shutil
+import tempfile
+from subprocess import run
+from multiprocessing import Process
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import numpy as np
+
+from polos.timestamplog import TimestampLog, read_timestamp_log
+from polos.timestamplog import get_log_filename, convert_timestamp_directory
+from polos.server import TimestampSaver
+
+class TimestampLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='polos_timestamplog_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append(self):
+        log_fn = op.join(self.tmp_dir, 'test.tslog')
+        log = TimestampLog(log_fn, capacity=2)
+        self.assertIsNone(log.get_last())
+        for ts in range(10, 60, 10):
+            log.append(ts)
+        self.assertGreaterEqual(log.capacity, 5)
+        self.assertEqual(len(log), 5)
+        self.assertEqual(log.get_last(), 50)
+        self.assertEqual((log[0], log[-2]), (10, 40))
+        with self.assertRaises(IndexError):
+            log[5]
+        np.testing.assert_array_equal(log.get_range(1, 3), [20, 30])
+        np.testing.assert_array_equal(log.get_between(15, 40), [20, 30])
+        log.close()
+
+        # Reopened and appended to
+        log = TimestampLog(log_fn, capacity=2)
+        log()
+        self.assertEqual(len(log), 6)
+        self.assertLess(abs(log.get_last() - time.time_ns()), 1e9)
+        log.close()
+        timestamps = read_timestamp_log(log_fn)
+        np.testing.assert_array_equal(timestamps[:5], [10, 20, 30, 40, 50])
+
+        not_a_log_fn = op.join(self.tmp_dir, 'not_a_log')
+        with open(not_a_log_fn, 'wb') as fout:
+            fout.write(b'0' * 64)
+        with self.assertRaises(ValueError):
+            TimestampLog(not_a_log_fn)
+
+    def test_other_process(self):
+        saver = TimestampSaver(self.tmp_dir, 'server')
+        self.assertIsNone(saver.get_ts())
+        def append_all():
+            # More than the preallocated capacity
+            for _ in range(TimestampLog.DEFAULT_CAPACITY + 10):
+                saver()
+        writer = Process(target=append_all)
+        writer.start()
+        writer.join()
+        self.assertEqual(len(saver), TimestampLog.DEFAULT_CAPACITY + 10)
+        self.assertLess(abs(saver.get_ts() - time.time()), 1)
+        self.assertEqual(saver.get_last(), saver[-1])
+        saver.close()
+
+    def test_convert(self):
+        timestamps = [1700000000.25, 1600000000.5, 1700000001.75]
+        for ts in timestamps:
+            open(op.join(self.tmp_dir, 'st-server_' + str(ts)), 'a').close()
+        open(op.join(self.tmp_dir, 'sts-dummy_1.5'), 'a').close()
+        self.assertEqual(convert_timestamp_directory(self.tmp_dir,
+                                                     'st-server',
+                                                     remove=True), 3)
+        log_fn = get_log_filename(self.tmp_dir, 'st-server')
+        np.testing.assert_array_equal(read_timestamp_log(log_fn),
+                                      [round(ts * 1e9) \
+                                       for ts in sorted(timestamps)])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['st-server.tslog', 'sts-dummy_1.5'])
+
+        run(['polos_convert_timestamps', self.tmp_dir, 'sts-dummy',
+             op.join(self.tmp_dir, 'dummy.tslog')], check=True)
+        np.testing.assert_array_equal(\
+            read_timestamp_log(op.join(self.tmp_dir, 'dummy.tslog')),
+            [1500000000])
@@ -0,0 +1,159 @@
+import unittest
+import time
+import sys
+import os.path as op
+import shutil
+import tempfile
+import json
+from subprocess import run
+
+import logging
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger('polos')
+
+import numpy as np
+
+from polos.tracing import Tracer, read_trace, write_chrome_trace
+from polos.tracing import STAGE_SELECT, STAGE_RECV, STAGE_DISPATCH
+from polos.tracing import STAGE_CALLBACK, STAGE_SEND, STAGE_CLIENT_SEND
+from polos.tracing import STAGE_CLIENT_RECV, STAGE_CLIENT_SPIN
+from polos.tracing import STAGE_LOCAL_CALLBACK
+from polos.server import STServerThread, ST_NTPClient, STClient
+from polos.server import STS_WIRE_V1
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='polos_tracing_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ring_buffer(self):
+        tracer = Tracer('test', size=3, offset=1.5)
+        for ispan in range(5):
+            tracer.trace(STAGE_RECV, ispan * 10, ispan * 10 + 5, ispan)
+        name, spans, offset = tracer.get_trace()
+        self.assertEqual((name, offset), ('test', 1.5))
+        np.testing.assert_array_equal(spans['arg'], [2, 3, 4])
+        np.testing.assert_array_equal(spans['end'] - spans['start'], 5)
+        # Mapped to wall-clock time
+        self.assertLess(abs(spans['start'][0] - \
+                            (tracer.anchor_wall - tracer.anchor_perf + 20)),
+                        1)
+
+        trace_fn = op.join(self.tmp_dir, 'trace.npz')
+        tracer.dump(trace_fn)
+        name, read_spans, offset = read_trace(trace_fn)
+        self.assertEqual((name, offset), ('test', 1.5))
+        np.testing.assert_array_equal(read_spans, spans)
+
+    def test_chrome_trace(self):
+        tracer = Tracer('server')
+        tracer.trace_request(7, 1000, 2000, 5000, 5500)
+        tracer.trace_request(8, 6000, 6500, 6500, 7000) # no callback
+        client_tracer = Tracer('client', offset=-1e-3)
+        client_tracer.trace(STAGE_CLIENT_SEND, 0, 500, 7)
+
+        json_fn = op.join(self.tmp_dir, 'trace.json')
+        write_chrome_trace(json_fn, [tracer.get_trace(),
+                                     client_tracer.get_trace()])
+        with open(json_fn) as fin:
+            events = json.load(fin)['traceEvents']
+        self.assertEqual([e['args']['name'] for e in events \
+                          if e['ph'] == 'M'], ['server', 'client'])
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual([(e['name'], e['dur']) for e in spans],
+                         [('dispatch', 1), ('callback', 3), ('send', 0.5),
+                          ('dispatch', 0.5), ('send', 0.5),
+                          ('client_send', 0.5)])
+        self.assertEqual(spans[0]['args']['arg'], 7)
+        # Offset applied, in us
+        self.assertAlmostEqual(spans[-1]['ts'],
+                               (client_tracer.anchor_wall - \
+                                client_tracer.anchor_perf) / 1e3 - 1e3, 0)
+
+    def test_trigger_path(self):
+        server_trace_fn = op.join(self.tmp_dir, 'server.npz')
+        server_tracer = Tracer('server', filename=server_trace_fn)
+        server = STServerThread(port=8947, receive_timeout=0.5,
+                                callback1=lambda: time.sleep(1e-3),
+                                tracer=server_tracer)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        ntp_tracer = Tracer('ntp_client')
+        ntp_client = ST_NTPClient(tracer=ntp_tracer, wire_format=STS_WIRE_V1)
+        client_tracer = Tracer('client')
+        client = STClient(lambda: None, tracer=client_tracer,
+                          wire_format=STS_WIRE_V1)
+        try:
+            ntp_client.connect('localhost', server.get_port())
+            ntp_client.request(nb_trials=5)
+            ntp_client.close()
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=10)
+            client.shutdown_server()
+        finally:
+            ntp_client.close()
+            client.close()
+            server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+        self.assertEqual(ntp_tracer.offset, ntp_client.offset)
+
+        _, server_spans, _ = read_trace(server_trace_fn)
+        stages = server_spans['stage']
+        for stage in (STAGE_SELECT, STAGE_RECV, STAGE_DISPATCH, STAGE_SEND):
+            self.assertIn(stage, stages)
+        # All requests run a callback: the 5 probes and the trigger run
+        # the slow callback1
+        callbacks = server_spans[stages == STAGE_CALLBACK]
+        self.assertEqual(len(callbacks), 15)
+        slow = callbacks['end'] - callbacks['start'] >= 1e6
+        np.testing.assert_array_equal(np.flatnonzero(slow),
+                                      [0, 1, 2, 3, 4, 14])
+
+        client_spans = client_tracer.get_spans()
+        client_stages = list(client_spans['stage'])
+        self.assertEqual(client_stages.count(STAGE_CLIENT_SEND), 11)
+        self.assertEqual(client_stages.count(STAGE_CLIENT_RECV), 10)
+        self.assertEqual(client_stages.count(STAGE_CLIENT_SPIN), 1)
+        self.assertEqual(client_stages.count(STAGE_LOCAL_CALLBACK), 1)
+        # Same host: the trigger request is received after being sent
+        trigger_seq = client.seq - 1
+        ts_sent = client_spans[(client_spans['stage'] == STAGE_CLIENT_SEND) & \
+                               (client_spans['arg'] == trigger_seq)]['start']
+        ts_callback = callbacks['start'][-1]
+        self.assertLess(ts_sent[0], ts_callback)
+
+        client_trace_fn = op.join(self.tmp_dir, 'client.npz')
+        client_tracer.dump(client_trace_fn)
+        json_fn = op.join(self.tmp_dir, 'merged.json')
+        run(['polos_merge_traces', json_fn, server_trace_fn,
+             client_trace_fn], check=True)
+        with open(json_fn) as fin:
+            events = json.load(fin)['traceEvents']
+        self.assertEqual(len([e for e in events if e['ph'] == 'X']),
+                         len(server_spans) + len(client_spans))
+
+    def test_text_requests(self):
+        server_tracer = Tracer('server')
+        server = STServerThread(port=8978, receive_timeout=0.5,
+                                callback1=lambda: time.sleep(1e-3),
+                                tracer=server_tracer)
+        server.start()
+        time.sleep(0.2) # wait a bit to let server update
+
+        client = ST_NTPClient() # legacy text requests
+        try:
+            client.connect('localhost', server.get_port())
+            client.request(nb_trials=5)
+            client.shutdown_server()
+        finally:
+            client.close()
+            server.join(timeout=1)
+        self.assertFalse(server.is_alive())
+
+        stages = list(server_tracer.get_spans()['stage'])
+        for stage in (STAGE_DISPATCH, STAGE_CALLBACK, STAGE_SEND):
+            self.assertEqual(stages.count(stage), 5)